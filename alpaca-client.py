@@ -1,12 +1,21 @@
 import requests
 import json
 import argparse
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-def send_prompt(url, instruction, input_text=None):
+PAIRS_FILE = os.path.join(os.path.dirname(__file__), 'fine-tuning', 'commandpairs.jsonl')
+
+def send_prompt(url, instruction, input_text=None, adapter=None):
     # Prepare the request data
     data = {'instruction': instruction}
     if input_text is not None:
         data['input'] = input_text
+    if adapter is not None:
+        data['adapter'] = adapter
 
     # Send the POST request to the Alpaca web service
     response = requests.post(url, json=data)
@@ -20,15 +29,183 @@ def send_prompt(url, instruction, input_text=None):
         print(f"Request failed. Status code: {response.status_code}")
         print(response.text)
 
+def stream_prompt(url, instruction, input_text=None, adapter=None):
+    # Prepare the request data
+    data = {'instruction': instruction}
+    if input_text is not None:
+        data['input'] = input_text
+    if adapter is not None:
+        data['adapter'] = adapter
+
+    # Send the POST request to the streaming endpoint and read events as they arrive
+    with requests.post(url, json=data, stream=True) as response:
+        if not response.ok:
+            print(f"Request failed. Status code: {response.status_code}")
+            print(response.text)
+            return
+
+        started = False
+        for line in response.iter_lines(decode_unicode=True):
+            # Server-Sent Events are "data: <json>" lines separated by blank lines
+            if not line or not line.startswith('data: '):
+                continue
+            event = json.loads(line[len('data: '):])
+            if event.get('done'):
+                break
+
+            token = event['token']
+            # Skip the whitespace between "### Response:" and the answer
+            if not started:
+                token = token.lstrip()
+                started = bool(token)
+            print(token, end='', flush=True)
+        print()
+
+def load_prompts(path, count):
+    # Instructions to replay, repeated if the file has fewer than count
+    prompts = []
+    with open(path, 'r') as f:
+        for line in f:
+            prompts.append(json.loads(line)['prompt'])
+            if len(prompts) >= count:
+                break
+    return [prompts[index % len(prompts)] for index in range(count)]
+
+# One keep-alive connection per benchmark thread, reused for all of its requests
+sessions = threading.local()
+
+def session():
+    if not hasattr(sessions, 'session'):
+        sessions.session = requests.Session()
+    return sessions.session
+
+def timed_request(url, instruction, adapter=None, stream=False, scheduled=None):
+    # Sends one request and times it. Latency counts from `scheduled` when given, so requests the client sent late still count as late.
+    start = time.perf_counter() if scheduled is None else scheduled
+    data = {'instruction': instruction}
+    if adapter is not None:
+        data['adapter'] = adapter
+    result = {'status': None, 'latency': None, 'ttft': None, 'tokens': None}
+    try:
+        with session().post(url, json=data, stream=stream) as response:
+            result['status'] = response.status_code
+            if stream and response.ok:
+                result['tokens'] = 0
+                for line in response.iter_lines(decode_unicode=True):
+                    if not line or not line.startswith('data: '):
+                        continue
+                    event = json.loads(line[len('data: '):])
+                    if event.get('done'):
+                        break
+                    if result['ttft'] is None:
+                        result['ttft'] = time.perf_counter() - start
+                    result['tokens'] += 1
+            else:
+                # Read the whole body so the connection can be reused
+                response.content
+    except requests.RequestException as e:
+        result['error'] = str(e)
+    result['latency'] = time.perf_counter() - start
+    return result
+
+def percentile(values, fraction):
+    # Nearest-rank percentile of a sorted list
+    if not values:
+        return None
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+def summarize(values):
+    values = sorted(values)
+    if not values:
+        return None
+    return {
+        'mean': sum(values) / len(values),
+        'p50': percentile(values, 0.50),
+        'p95': percentile(values, 0.95),
+        'p99': percentile(values, 0.99),
+        'max': values[-1],
+    }
+
+def benchmark(url, prompts, concurrency, rate=None, adapter=None, stream=False):
+    # Closed loop: `concurrency` requests in flight at all times.
+    # Open loop with a rate: requests are sent on a fixed schedule whether or not earlier ones have finished, up to `concurrency` at once.
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        if rate:
+            futures = []
+            for index, instruction in enumerate(prompts):
+                scheduled = start + index / rate
+                time.sleep(max(0, scheduled - time.perf_counter()))
+                futures.append(executor.submit(timed_request, url, instruction, adapter, stream, scheduled))
+            results = [future.result() for future in futures]
+        else:
+            results = list(executor.map(lambda instruction: timed_request(url, instruction, adapter, stream), prompts))
+    elapsed = time.perf_counter() - start
+
+    ok = [result for result in results if result['status'] == 200]
+    statuses = {}
+    for result in results:
+        key = str(result['status']) if result['status'] is not None else 'error'
+        statuses[key] = statuses.get(key, 0) + 1
+    summary = {
+        'url': url,
+        'requests': len(results),
+        'concurrency': concurrency,
+        'rate': rate,
+        'stream': stream,
+        'elapsed': elapsed,
+        'statuses': statuses,
+        'throughput': len(ok) / elapsed,
+        'latency': summarize([result['latency'] for result in ok]),
+    }
+    if stream:
+        summary['ttft'] = summarize([result['ttft'] for result in ok if result['ttft'] is not None])
+        summary['tokens_per_second'] = sum(result['tokens'] for result in ok) / elapsed
+    return summary, results
+
+def print_summary(summary):
+    mode = f"{summary['rate']} req/s (up to {summary['concurrency']} in flight)" if summary['rate'] else f"concurrency {summary['concurrency']}"
+    print(f"Requests:    {summary['requests']} at {mode}{', streaming' if summary['stream'] else ''}")
+    print(f"Statuses:    {', '.join(f'{status}: {count}' for status, count in sorted(summary['statuses'].items()))}")
+    print(f"Elapsed:     {summary['elapsed']:.2f}s")
+    print(f"Throughput:  {summary['throughput']:.2f} req/s")
+    if summary['stream']:
+        print(f"Tokens:      {summary['tokens_per_second']:.1f} tokens/s")
+    for name in ('latency', 'ttft'):
+        stats = summary.get(name)
+        if stats:
+            label = 'Latency:' if name == 'latency' else 'First token:'
+            print(f"{label:<12} p50 {stats['p50'] * 1000:.0f} ms, p95 {stats['p95'] * 1000:.0f} ms, p99 {stats['p99'] * 1000:.0f} ms, max {stats['max'] * 1000:.0f} ms")
+
 if __name__ == '__main__':
     # Set up command-line argument parser
     parser = argparse.ArgumentParser(description='Alpaca Web Service Client')
     parser.add_argument('-u', '--url', type=str, default='http://127.0.0.1:5791/alpaca', help='URL of the Alpaca web service')
-    parser.add_argument('-i', '--instruction', type=str, required=True, help='Instruction for the Alpaca web service')
+    parser.add_argument('-i', '--instruction', type=str, default=None, help='Instruction for the Alpaca web service')
     parser.add_argument('--input', type=str, default=None, help='Input text for the Alpaca web service (optional)')
+    parser.add_argument('--adapter', type=str, default=None, help='LoRA adapter to answer with (optional, defaults to the server\'s default)')
+    parser.add_argument('--stream', action='store_true', help='Print the response token by token as it is generated')
+    parser.add_argument('--benchmark', type=int, default=0, metavar='N', help='Instead of sending one instruction, replay N prompts from --pairs and report latency and throughput')
+    parser.add_argument('--concurrency', type=int, default=8, help='Benchmark requests in flight at once, or at most with --rate')
+    parser.add_argument('--rate', type=float, default=None, help='Send benchmark requests at this many per second regardless of how fast they are answered, rather than at a fixed concurrency')
+    parser.add_argument('--pairs', type=str, default=PAIRS_FILE, help='JSONL file to take benchmark prompts from')
+    parser.add_argument('--output', type=str, default=None, help='Write the benchmark summary and every request\'s timings to this JSON file')
 
     # Parse command-line arguments
     args = parser.parse_args()
+    if not args.benchmark and args.instruction is None:
+        parser.error('the following arguments are required: -i/--instruction')
 
+    url = args.url.rstrip('/') + '/stream' if args.stream else args.url
+    if args.benchmark:
+        prompts = load_prompts(args.pairs, args.benchmark)
+        summary, results = benchmark(url, prompts, args.concurrency, args.rate, args.adapter, args.stream)
+        print_summary(summary)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump({'summary': summary, 'results': results}, f, indent=2)
     # Send the instruction and input to the Alpaca web service
-    send_prompt(args.url, args.instruction, args.input)
+    elif args.stream:
+        stream_prompt(url, args.instruction, args.input, args.adapter)
+    else:
+        send_prompt(args.url, args.instruction, args.input, args.adapter)
@@ -1,117 +1,315 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
+from werkzeug.serving import WSGIRequestHandler
 import torch
 from peft import PeftModel
 import transformers
 import logging
-from transformers import LlamaTokenizer, LlamaForCausalLM, GenerationConfig
+import argparse
+import atexit
+from transformers import LlamaTokenizer, LlamaForCausalLM, GenerationConfig, LogitsProcessor, LogitsProcessorList, StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
 import os
+import json
+import random
+import threading
+import time
+from concurrent.futures import TimeoutError
+from contextlib import contextmanager
+from alpaca_adapters import AdapterRegistry
+from alpaca_batching import BatchScheduler
+from alpaca_cpu import CPU_MODES, load_dtype, prepare_cpu_model
+from alpaca_grammar import CommandGrammar
+from alpaca_logging import AsyncLogHandler
+from alpaca_merge import DEFAULT_OUTPUT as DEFAULT_MERGED_MODEL, is_reusable, load_merged
+from alpaca_metrics import Registry
+from alpaca_prefix_cache import PrefixCache
+from alpaca_prompt import PREAMBLE, PREAMBLE_WITH_INPUT, generate_prompt
+from alpaca_serve import notify, serve_forked
 
 
-# Set up logging
+# Served on /metrics. Allocated before --workers forks, so every worker adds to the same totals.
+metrics = Registry()
+SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+TOKENS = (8, 16, 32, 64, 128, 256, 512, 1024, 2048)
+requests_total = metrics.counter('alpaca_requests_total', 'Generation requests by outcome', 'outcome', ('ok', 'rejected', 'timeout', 'not_ready', 'unknown_adapter'))
+in_flight = metrics.gauge('alpaca_requests_in_flight', 'Generation requests admitted and not yet answered')
+request_seconds = metrics.histogram('alpaca_request_seconds', 'Time to answer a generation request', SECONDS, 'endpoint', ('/alpaca', '/alpaca/stream'))
+queue_wait_seconds = metrics.histogram('alpaca_queue_wait_seconds', 'Time a request waited for its batch to start', SECONDS)
+tokenize_seconds = metrics.histogram('alpaca_tokenize_seconds', 'Time to build and tokenize the prompts of a generate call', SECONDS)
+prefill_seconds = metrics.histogram('alpaca_prefill_seconds', 'Time from the start of a generate call to its first logits', SECONDS)
+decode_seconds = metrics.histogram('alpaca_decode_seconds', 'Time from the first logits of a generate call to its end', SECONDS)
+tokens_per_second = metrics.histogram('alpaca_tokens_per_second', 'Output tokens per second of a generate call, across its batch', (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+prompt_tokens = metrics.histogram('alpaca_prompt_tokens', 'Prompt length of a request in tokens', TOKENS)
+output_tokens = metrics.histogram('alpaca_output_tokens', 'Tokens generated for a request', TOKENS)
+log_records_dropped = metrics.counter('alpaca_log_records_dropped_total', 'Log records dropped because the log writer fell behind')
+
+def resident_memory_bytes():
+    # Of the process answering the scrape, from /proc on Linux
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return None
+
+metrics.function_gauge('process_resident_memory_bytes', 'Resident memory of the process answering the scrape', resident_memory_bytes)
+metrics.function_gauge('alpaca_cuda_memory_allocated_bytes', 'GPU memory allocated by tensors', lambda: torch.cuda.memory_allocated() if torch.cuda.is_available() else None)
+
+# Set up logging. Records are written by a background thread, so requests don't wait on the log file.
 log_file = 'alpaca-web.log' # '/var/log/alpaca-web.log'
-logging.basicConfig(filename=log_file, level=logging.INFO, format='%(asctime)s - %(message)s')
+log_writer = logging.FileHandler(log_file)
+log_writer.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+log_handler = AsyncLogHandler(log_writer, on_drop=log_records_dropped.inc)
+# The writer adds the timestamp
+log_handler.setFormatter(logging.Formatter('%(message)s'))
+logging.basicConfig(level=logging.INFO, handlers=[log_handler])
 
-print("Loading tokenizer")
-tokenizer = LlamaTokenizer.from_pretrained("decapoda-research/llama-7b-hf")
+parser = argparse.ArgumentParser(description='Alpaca Web Service')
+parser.add_argument('--max-batch-size', type=int, default=8, help='Maximum number of requests generated together. 1 disables batching.')
+parser.add_argument('--batch-window', type=float, default=10, help='Milliseconds to wait for more requests before starting a batch')
+parser.add_argument('--prefix-cache-mb', type=int, default=512, help='Memory cap for cached prompt prefixes in MB. 0 disables the prefix cache.')
+parser.add_argument('--merged-model', type=str, default=DEFAULT_MERGED_MODEL, help='Merged model built by alpaca_merge.py. Used instead of applying the LoRA at startup when it matches BASE_MODEL, LORA_WEIGHTS and the dtype for this device.')
+parser.add_argument('--verify-merged', action='store_true', help='Check the merged model against its checksums even if its files look unchanged')
+parser.add_argument('--draft-model', type=str, default=None, help='Small model sharing the LLaMA tokenizer for speculative decoding. Requests then decode with a single beam, one at a time.')
+parser.add_argument('--draft-lookahead', type=int, default=5, help='Most tokens the draft model proposes before the main model checks them')
+parser.add_argument('--max-commands', type=int, default=5, help='Most command lines a response may have. Responses are constrained to plain command lines. 0 turns the constraint off.')
+parser.add_argument('--workers', type=int, default=1, help='Worker processes to serve with. They are forked after loading and share the model weights. 1 serves from a single process.')
+parser.add_argument('--max-queue', type=int, default=32, help='Requests admitted at once, split evenly between the workers. Requests beyond this get a 503 with Retry-After. 0 admits everything.')
+parser.add_argument('--retry-after', type=int, default=2, help='Seconds clients are told to wait before retrying when the queue is full')
+parser.add_argument('--request-timeout', type=float, default=60, help='Seconds a request may spend generating, and waiting for a batch. 0 for no limit.')
+parser.add_argument('--adapter', action='append', default=[], metavar='NAME=PATH', help='Extra LoRA adapter to serve on top of the base model, chosen with "adapter" in the request. Can be repeated.')
+parser.add_argument('--max-adapters', type=int, default=4, help='Most adapters kept loaded at once, including the default one. Others are loaded when requested.')
+parser.add_argument('--warmup-rounds', type=int, default=3, help='Most rounds of warm-up requests to run before reporting ready. Stops earlier once latency settles. 0 skips warm-up.')
+parser.add_argument('--log-sample', type=float, default=1.0, help='Fraction of requests whose instruction, input and response are written to the log')
+parser.add_argument('--stub-model', action='store_true', help='Serve a small model with random weights instead of LLaMA, to benchmark the server and clients without the real weights. Responses are nonsense.')
+parser.add_argument('--cpu-mode', choices=CPU_MODES, default='fp32', help='Precision to run in when no GPU is used. int8 quantizes the linear layers and needs about a quarter of the memory of fp32.')
+args = parser.parse_args()
+# The default adapter always stays loaded, so serving another one needs room for two
+if args.adapter and args.max_adapters < 2:
+    parser.error("--max-adapters must be at least 2 to serve --adapter alongside the default adapter")
 
 BASE_MODEL = "decapoda-research/llama-7b-hf"
 LORA_WEIGHTS = "tloen/alpaca-lora-7b"
+# Name requests use for LORA_WEIGHTS
+DEFAULT_ADAPTER = "alpaca"
 
-if torch.cuda.is_available():
-    print("CUDA found")
-    device = "cuda"
-else:
-    print("No CUDA devices found.")
-    device = "cpu"
-
-try:
-    if torch.backends.mps.is_available():
-        device = "mps"
-except:
-    pass
-
-
-if device == "cuda":
-    num_devices = torch.cuda.device_count()
-    bits8 = False
-    for i in range(num_devices):
-        device_name = torch.cuda.get_device_name(i)
-        cc_major, cc_minor = torch.cuda.get_device_capability(i)
-        if cc_major <= 7 and cc_minor < 5:
-            print(f"GPU needs compute capability 7.5 or great for 16-bit mode. Installed device supports {cc_major}.{cc_minor}. Falling back to 8-bit mode.")
-            bits8 = True
-
-        device_memory = torch.cuda.get_device_properties(i).total_memory / (1024**3)
-
-        if device_memory < 12:
-            print("GPU needs at least 12GB of VRAM to run. Installed device has {device_memory}GB. Falling back to CPU. Except slow responses.")
-            device = "cpu"
-        elif device_memory < 24 and not bits8:
-            print(f"At least 24GB of VRAM is recommended to run in 16-bit mode. Installed device has {device_memory}GB. Falling back to 8-bit mode.")
-
-print("Loading Llama...")
-if device == "cuda":
-    model = LlamaForCausalLM.from_pretrained(
-        BASE_MODEL,
-        load_in_8bit=bits8,
-        torch_dtype=torch.float16,
-        device_map="auto",
-    )
-    model = PeftModel.from_pretrained(
-        model, LORA_WEIGHTS, torch_dtype=torch.float16, force_download=True
-    )
-elif device == "mps":
-    model = LlamaForCausalLM.from_pretrained(
-        BASE_MODEL,
-        device_map={"": device},
-        torch_dtype=torch.float16,
-    )
-    model = PeftModel.from_pretrained(
-        model,
-        LORA_WEIGHTS,
-        device_map={"": device},
-        torch_dtype=torch.float16,
-    )
-else:
-    model = LlamaForCausalLM.from_pretrained(
-        BASE_MODEL, device_map={"": device}, low_cpu_mem_usage=True
-    )
-    model = PeftModel.from_pretrained(
-        model,
-        LORA_WEIGHTS,
-        device_map={"": device},
-    )
-print("Llama loaded.")
+# Set by load_model(), which runs in the background while the port is already open
+tokenizer = None
+model = None
+device = None
+# Set unless the LoRA has been merged into the model, which leaves no adapter to switch
+adapters = None
+draft_model = None
+
+def load_model():
+    global tokenizer, model, device, adapters, draft_model
+    print("Loading tokenizer")
+    if args.stub_model:
+        # Only needed for benchmarking, so it isn't packaged
+        from alpaca_stub import stub_model, stub_tokenizer
+        tokenizer = stub_tokenizer()
+    else:
+        tokenizer = LlamaTokenizer.from_pretrained("decapoda-research/llama-7b-hf")
+    # Batched requests are left-padded so every prompt ends right where generation starts
+    if tokenizer.pad_token_id is None:
+        tokenizer.pad_token_id = 0
+    tokenizer.padding_side = "left"
+
+    if torch.cuda.is_available():
+        print("CUDA found")
+        device = "cuda"
+    else:
+        print("No CUDA devices found.")
+        device = "cpu"
+
+    try:
+        if torch.backends.mps.is_available():
+            device = "mps"
+    except:
+        pass
+
+
+    if device == "cuda":
+        num_devices = torch.cuda.device_count()
+        bits8 = False
+        for i in range(num_devices):
+            device_name = torch.cuda.get_device_name(i)
+            cc_major, cc_minor = torch.cuda.get_device_capability(i)
+            if cc_major <= 7 and cc_minor < 5:
+                print(f"GPU needs compute capability 7.5 or great for 16-bit mode. Installed device supports {cc_major}.{cc_minor}. Falling back to 8-bit mode.")
+                bits8 = True
 
-def generate_prompt(instruction, input=None):
-    if input:
-        return f"""Below is an instruction that describes a task, paired with an input that provides further context. Write a response that appropriately completes the request.
+            device_memory = torch.cuda.get_device_properties(i).total_memory / (1024**3)
 
-### Instruction:
-{instruction}
+            if device_memory < 12:
+                print("GPU needs at least 12GB of VRAM to run. Installed device has {device_memory}GB. Falling back to CPU. Except slow responses.")
+                device = "cpu"
+            elif device_memory < 24 and not bits8:
+                print(f"At least 24GB of VRAM is recommended to run in 16-bit mode. Installed device has {device_memory}GB. Falling back to 8-bit mode.")
 
-### Input:
-{input}
+    if args.workers > 1 and device != "cpu":
+        # A CUDA or MPS context set up here can't be used by the forked workers
+        raise RuntimeError(f"--workers {args.workers} only works on CPU, and the model would run on {device}. Serve with --workers 1.")
 
-### Response:"""
+    # The merged model has to be stored in the dtype this device runs in, so it can be memory-mapped as is
+    merged_dtype = load_dtype(args.cpu_mode) if device == "cpu" else "float16"
+    use_merged = not args.stub_model and is_reusable(args.merged_model, BASE_MODEL, LORA_WEIGHTS, merged_dtype, verify=args.verify_merged)
+    if not use_merged and not args.stub_model and os.path.exists(args.merged_model):
+        print(f"{args.merged_model} was not built from {BASE_MODEL} and {LORA_WEIGHTS} in {merged_dtype}, or has changed since. Ignoring it. Rebuild it with alpaca_merge.py --dtype {merged_dtype}.")
+
+    print("Loading Llama...")
+    if args.stub_model:
+        print("Using a stub model with random weights.")
+        model = stub_model(tokenizer, DEFAULT_ADAPTER).to(device)
+    elif use_merged:
+        print(f"Loading merged model from {args.merged_model}")
+        if device == "cuda":
+            model = load_merged(args.merged_model, merged_dtype, load_in_8bit=bits8, device_map="auto")
+        else:
+            model = load_merged(args.merged_model, merged_dtype, device_map={"": device})
+    elif device == "cuda":
+        model = LlamaForCausalLM.from_pretrained(
+            BASE_MODEL,
+            load_in_8bit=bits8,
+            torch_dtype=torch.float16,
+            device_map="auto",
+        )
+        model = PeftModel.from_pretrained(
+            model, LORA_WEIGHTS, torch_dtype=torch.float16, force_download=True, adapter_name=DEFAULT_ADAPTER
+        )
+    elif device == "mps":
+        model = LlamaForCausalLM.from_pretrained(
+            BASE_MODEL,
+            device_map={"": device},
+            torch_dtype=torch.float16,
+        )
+        model = PeftModel.from_pretrained(
+            model,
+            LORA_WEIGHTS,
+            device_map={"": device},
+            torch_dtype=torch.float16,
+            adapter_name=DEFAULT_ADAPTER,
+        )
+    else:
+        model = LlamaForCausalLM.from_pretrained(
+            BASE_MODEL, device_map={"": device}, low_cpu_mem_usage=True, torch_dtype=getattr(torch, merged_dtype)
+        )
+        model = PeftModel.from_pretrained(
+            model,
+            LORA_WEIGHTS,
+            device_map={"": device},
+            adapter_name=DEFAULT_ADAPTER,
+        )
+    print("Llama loaded.")
+
+    if device != "cpu":
+        model.half()
     else:
-        return f"""Below is an instruction that describes a task. Write a response that appropriately completes the request.
+        print(f"Running on CPU in {args.cpu_mode} mode")
+        model = prepare_cpu_model(model, args.cpu_mode)
+    model.eval()
+
+    if isinstance(model, PeftModel):
+        adapters = AdapterRegistry(model, DEFAULT_ADAPTER, None if args.stub_model else LORA_WEIGHTS, max_resident=args.max_adapters)
+        for spec in args.adapter:
+            name, path = spec.split("=", 1)
+            print(f"Loading adapter {name} from {path}")
+            adapters.register(name, path)
+    elif args.adapter:
+        print("Extra adapters need the LoRA applied at startup, not merged. Ignoring --adapter.")
+
+    if torch.__version__ >= "2":
+        model = torch.compile(model)
+
+    if args.draft_model:
+        # Proposes tokens that the main model then checks in a single forward pass
+        print(f"Loading draft model {args.draft_model}")
+        draft_model = LlamaForCausalLM.from_pretrained(
+            args.draft_model,
+            device_map="auto" if device == "cuda" else {"": device},
+            low_cpu_mem_usage=True,
+            torch_dtype=getattr(torch, merged_dtype),
+        )
+        if device == "cpu":
+            draft_model = prepare_cpu_model(draft_model, args.cpu_mode)
+        draft_model.eval()
+        # Always propose --draft-lookahead tokens, rather than adapting the count or stopping early when unsure
+        draft_model.generation_config.num_assistant_tokens = args.draft_lookahead
+        draft_model.generation_config.num_assistant_tokens_schedule = "constant"
+        draft_model.generation_config.assistant_confidence_threshold = 0
+
+
+# Set in __main__ unless the prefix cache is disabled
+prefix_cache = None
+
+def cached_prefix(input_ids, num_beams=1, adapter=DEFAULT_ADAPTER):
+    # Key/value cache for the longest already prefilled prefix of the prompt, so prefill only covers the rest
+    # Assisted generation can't start from a cached prefix: the draft model would have to match it
+    # The cached prefixes were computed with the default adapter, other adapters produce different keys and values
+    if prefix_cache is None or draft_model is not None or adapter != DEFAULT_ADAPTER:
+        return None
+    past_key_values = prefix_cache.lookup(input_ids[0])
+    if past_key_values is not None and num_beams > 1:
+        # Beam search runs num_beams copies of the prompt
+        past_key_values.batch_repeat_interleave(num_beams)
+    return past_key_values
 
-### Instruction:
-{instruction}
+# Set in __main__ unless --max-commands is 0
+grammar = None
 
-### Response:"""
+class StepTimer(LogitsProcessor):
+    # Notes when logits are first produced, which is when the prompt has been prefilled
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.first = None
 
-if device != "cpu":
-    model.half()
-model.eval()
-if torch.__version__ >= "2":
-    model = torch.compile(model)
+    def __call__(self, input_ids, scores):
+        if self.first is None:
+            self.first = time.perf_counter()
+        return scores
 
+class StopWhenSet(StoppingCriteria):
+    # Ends generation once the event is set, such as when the client of a stream has gone away
+    def __init__(self, event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+def logits_processors(input_ids, timer):
+    # The grammar keeps the output to plain command lines and ends it once --max-commands lines are complete
+    processors = LogitsProcessorList([timer])
+    if grammar is not None:
+        processors.append(grammar.processor(input_ids.shape[1]))
+    return processors
+
+def record_generation(timer, prompt_lengths, output_lengths):
+    # Called once a generate call has finished, with the prompt and output length of each request in it
+    end = time.perf_counter()
+    first = timer.first or end
+    prefill_seconds.observe(first - timer.start)
+    decode_seconds.observe(end - first)
+    tokens_per_second.observe(sum(output_lengths) / max(end - timer.start, 1e-9))
+    for length in prompt_lengths:
+        prompt_tokens.observe(length)
+    for length in output_lengths:
+        output_tokens.observe(length)
+
+@contextmanager
+def adapter_arguments(names, num_beams=1):
+    # generate() arguments picking the adapter for each row, which stay loaded until generation is done
+    if adapters is None:
+        yield {}
+        return
+    adapters.acquire(names)
+    try:
+        # Beam search runs num_beams rows per request
+        yield {"adapter_names": [name for name in names for _ in range(num_beams)]}
+    finally:
+        adapters.release(names)
 
 def evaluate(
     instruction,
     input=None,
+    adapter=DEFAULT_ADAPTER,
     temperature=0.1,
     top_p=0.75,
     top_k=40,
@@ -119,51 +317,487 @@ def evaluate(
     max_new_tokens=128,
     **kwargs,
 ):
+    start = time.perf_counter()
     prompt = generate_prompt(instruction, input)
     inputs = tokenizer(prompt, return_tensors="pt")
     input_ids = inputs["input_ids"].to(device)
+    tokenize_seconds.observe(time.perf_counter() - start)
+    # Speculative decoding checks a single sequence, so the draft model replaces beam search
+    if draft_model is not None:
+        num_beams = 1
+    past_key_values = cached_prefix(input_ids, num_beams, adapter)
     generation_config = GenerationConfig(
         temperature=temperature,
         top_p=top_p,
         top_k=top_k,
         num_beams=num_beams,
+        max_time=args.request_timeout or None,
         **kwargs,
     )
-    with torch.no_grad():
+    with torch.no_grad(), adapter_arguments([adapter], num_beams) as adapter_kwargs:
+        # Started once the adapters are loaded, so prefill doesn't include waiting for them
+        timer = StepTimer()
         generation_output = model.generate(
             input_ids=input_ids,
+            past_key_values=past_key_values,
+            assistant_model=draft_model,
+            logits_processor=logits_processors(input_ids, timer),
             generation_config=generation_config,
             return_dict_in_generate=True,
             output_scores=True,
             max_new_tokens=max_new_tokens,
+            **adapter_kwargs,
         )
     s = generation_output.sequences[0]
-    output = tokenizer.decode(s)
+    record_generation(timer, [input_ids.shape[1]], [len(s) - input_ids.shape[1]])
+    output = tokenizer.decode(s, skip_special_tokens=True)
     return output.split("### Response:")[1].strip()
 
+
+def evaluate_batch(
+    requests,
+    temperature=0.1,
+    top_p=0.75,
+    top_k=40,
+    num_beams=4,
+    max_new_tokens=128,
+    **kwargs,
+):
+    # Same as evaluate(), but for a list of (instruction, input, adapter) requests in one generate call
+    if len(requests) == 1:
+        # A lone request has no padding, so it can use the prefix cache
+        instruction, input, adapter = requests[0]
+        return [evaluate(instruction, input, adapter, temperature, top_p, top_k, num_beams, max_new_tokens, **kwargs)]
+
+    names = [adapter for _, _, adapter in requests]
+    # A batch using a single adapter can't be split any further
+    if adapters is not None and len(set(names)) > 1 and len(set(names) | {DEFAULT_ADAPTER}) > adapters.max_resident:
+        # More adapters than can be loaded at once, so generate a batch per adapter
+        results = [None] * len(requests)
+        for name in set(names):
+            indexes = [index for index, adapter in enumerate(names) if adapter == name]
+            outputs = evaluate_batch([requests[index] for index in indexes], temperature, top_p, top_k, num_beams, max_new_tokens, **kwargs)
+            for index, output in zip(indexes, outputs):
+                results[index] = output
+        return results
+
+    start = time.perf_counter()
+    prompts = [generate_prompt(instruction, input) for instruction, input, _ in requests]
+    inputs = tokenizer(prompts, return_tensors="pt", padding=True)
+    input_ids = inputs["input_ids"].to(device)
+    attention_mask = inputs["attention_mask"].to(device)
+    tokenize_seconds.observe(time.perf_counter() - start)
+    generation_config = GenerationConfig(
+        temperature=temperature,
+        top_p=top_p,
+        top_k=top_k,
+        num_beams=num_beams,
+        pad_token_id=tokenizer.pad_token_id,
+        max_time=args.request_timeout or None,
+        **kwargs,
+    )
+    with torch.no_grad(), adapter_arguments(names, num_beams) as adapter_kwargs:
+        timer = StepTimer()
+        generation_output = model.generate(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            logits_processor=logits_processors(input_ids, timer),
+            generation_config=generation_config,
+            return_dict_in_generate=True,
+            max_new_tokens=max_new_tokens,
+            **adapter_kwargs,
+        )
+    # Rows are padded to the longest output
+    generated = generation_output.sequences[:, input_ids.shape[1]:]
+    record_generation(timer, attention_mask.sum(dim=1).tolist(), (generated != tokenizer.pad_token_id).sum(dim=1).tolist())
+    outputs = tokenizer.batch_decode(generation_output.sequences, skip_special_tokens=True)
+    return [output.split("### Response:")[1].strip() for output in outputs]
+
+
+def evaluate_stream(
+    instruction,
+    input=None,
+    adapter=DEFAULT_ADAPTER,
+    temperature=0.1,
+    top_p=0.75,
+    top_k=40,
+    max_new_tokens=128,
+    **kwargs,
+):
+    # Like evaluate(), but yields decoded text as it is generated. Beam search can't stream, so this decodes with a single beam.
+    start = time.perf_counter()
+    prompt = generate_prompt(instruction, input)
+    inputs = tokenizer(prompt, return_tensors="pt")
+    input_ids = inputs["input_ids"].to(device)
+    tokenize_seconds.observe(time.perf_counter() - start)
+    past_key_values = cached_prefix(input_ids, adapter=adapter)
+    generation_config = GenerationConfig(
+        temperature=temperature,
+        top_p=top_p,
+        top_k=top_k,
+        num_beams=1,
+        max_time=args.request_timeout or None,
+        **kwargs,
+    )
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    stop = threading.Event()
+
+    def generate():
+        try:
+            with torch.no_grad(), adapter_arguments([adapter]) as adapter_kwargs:
+                timer = StepTimer()
+                sequences = model.generate(
+                    input_ids=input_ids,
+                    past_key_values=past_key_values,
+                    assistant_model=draft_model,
+                    logits_processor=logits_processors(input_ids, timer),
+                    generation_config=generation_config,
+                    max_new_tokens=max_new_tokens,
+                    streamer=streamer,
+                    stopping_criteria=StoppingCriteriaList([StopWhenSet(stop)]),
+                    **adapter_kwargs,
+                )
+            record_generation(timer, [input_ids.shape[1]], [sequences.shape[1] - input_ids.shape[1]])
+        except Exception:
+            # Unblock the consumer, otherwise it waits on the streamer forever
+            logging.exception("Streaming generation failed")
+            streamer.end()
+
+    thread = threading.Thread(target=generate, daemon=True)
+    thread.start()
+    try:
+        for text in streamer:
+            # The streamer hands out an empty string whenever a token doesn't complete any text yet
+            if text:
+                yield text
+    finally:
+        # Closed early when the client goes away. Stop generating for it, and only return once
+        # the model is free, so the request's admission slot isn't released while it still runs.
+        stop.set()
+        thread.join()
+
+# Set in __main__ when batching is enabled
+scheduler = None
+# This worker's share of --max-queue, set in start_worker() unless --max-queue is 0
+admission = None
+
 app = Flask(__name__)
+# Keep connections open between requests, so clients don't reconnect for every one
+WSGIRequestHandler.protocol_version = "HTTP/1.1"
+
+def admit():
+    # Takes an admission slot if one is free
+    if admission is not None and not admission.acquire(blocking=False):
+        return False
+    in_flight.inc()
+    return True
+
+def release():
+    in_flight.dec()
+    if admission is not None:
+        admission.release()
+
+def sampled():
+    # Whether this request's text goes to the log, see --log-sample
+    return random.random() < args.log_sample
+
+def known_adapter(name):
+    return name == DEFAULT_ADAPTER or (adapters is not None and name in adapters)
+
+def unknown_adapter(name):
+    requests_total.inc(value='unknown_adapter')
+    return jsonify({'error': f'Unknown adapter {name}.'}), 404
+
+def not_ready():
+    requests_total.inc(value='not_ready')
+    response = jsonify({'error': f'Model is {stage}, retry later.'})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(args.retry_after)
+    return response
+
+def busy():
+    requests_total.inc(value='rejected')
+    response = jsonify({'error': 'Too many requests in progress, retry later.'})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(args.retry_after)
+    return response
 
 # Define the endpoint
 @app.route('/alpaca', methods=['POST'])
 def alpaca():
+    start = time.perf_counter()
+    if not ready.is_set():
+        return not_ready()
+
     # Extract instruction and input from the request data
     data = request.get_json()
     instruction = data.get('instruction', '')
     input_text = data.get('input', None)
+    adapter = data.get('adapter', DEFAULT_ADAPTER)
 
     # Log the request data
-    logging.info(f'request: instruction="{instruction}", input="{input_text}"')
+    logged = sampled()
+    if logged:
+        logging.info(f'request: instruction="{instruction}", input="{input_text}", adapter="{adapter}"')
+
+    if not known_adapter(adapter):
+        return unknown_adapter(adapter)
 
-    # Use the evaluate function to generate the response
-    response = evaluate(instruction, input_text)
+    if not admit():
+        logging.info('rejected: queue full')
+        return busy()
+
+    # Use the evaluate function to generate the response, batched with other requests if enabled
+    try:
+        if scheduler:
+            # Generation stops after --request-timeout, but a request may wait for the batch ahead of it first
+            response = scheduler((instruction, input_text, adapter), timeout=args.request_timeout * 2 or None)
+        else:
+            response = evaluate(instruction, input_text, adapter)
+    except TimeoutError:
+        logging.info('timed out waiting for a batch')
+        requests_total.inc(value='timeout')
+        return jsonify({'error': 'Request timed out.'}), 504
+    finally:
+        release()
+    requests_total.inc(value='ok')
+    request_seconds.observe(time.perf_counter() - start, '/alpaca')
 
     # Log the response data
-    logging.info(f'response: "{response}"')
+    if logged:
+        logging.info(f'response: "{response}"')
 
     # Return the response as JSON
     return jsonify({'response': response})
 
+@app.route('/alpaca/stream', methods=['POST'])
+def alpaca_stream():
+    # Same request as /alpaca, but the response is sent as Server-Sent Events while it is generated
+    start = time.perf_counter()
+    if not ready.is_set():
+        return not_ready()
+    data = request.get_json()
+    instruction = data.get('instruction', '')
+    input_text = data.get('input', None)
+    adapter = data.get('adapter', DEFAULT_ADAPTER)
+
+    logged = sampled()
+    if logged:
+        logging.info(f'request: instruction="{instruction}", input="{input_text}", adapter="{adapter}"')
+
+    if not known_adapter(adapter):
+        return unknown_adapter(adapter)
+
+    if not admit():
+        logging.info('rejected: queue full')
+        return busy()
+
+    def events():
+        tokens = []
+        for text in evaluate_stream(instruction, input_text, adapter):
+            tokens.append(text)
+            yield f"data: {json.dumps({'token': text})}\n\n"
+
+        response = ''.join(tokens).strip()
+        if logged:
+            logging.info(f'response: "{response}"')
+
+        # Final event carries the whole response so clients don't have to reassemble it
+        yield f"data: {json.dumps({'done': True, 'response': response})}\n\n"
+
+    def finished():
+        release()
+        requests_total.inc(value='ok')
+        request_seconds.observe(time.perf_counter() - start, '/alpaca/stream')
+
+    response = Response(stream_with_context(events()), mimetype='text/event-stream')
+    # Called once the stream is finished or the client has gone away
+    response.call_on_close(finished)
+    return response
+
+@app.route('/metrics')
+def prometheus_metrics():
+    # Totals across all workers, in the Prometheus text format
+    return Response(metrics.render(), content_type=metrics.content_type)
+
+@app.route('/healthz')
+def healthz():
+    # Answers as soon as the process is up, whether or not the model is ready
+    return jsonify({'status': stage})
+
+@app.route('/ready')
+def ready_check():
+    # Only 200 once the model is loaded and warmed up, so traffic is only routed here then
+    return jsonify({'status': stage}), 200 if ready.is_set() else 503
+
+@app.route('/admin/adapters', methods=['GET'])
+def list_adapters():
+    if not ready.is_set():
+        return not_ready()
+    if adapters is None:
+        return jsonify({'adapters': [{'name': DEFAULT_ADAPTER, 'path': LORA_WEIGHTS, 'resident': True}]})
+    return jsonify({'adapters': adapters.adapters()})
+
+def adapters_fixed():
+    # Why adapters can't be changed at runtime, or None if they can
+    if not ready.is_set():
+        return f'Model is {stage}.'
+    if adapters is None:
+        return 'The LoRA is merged into the model, so no other adapters can be loaded.'
+    if args.workers > 1:
+        return 'Every worker has its own adapters, so they can only be changed with --adapter at startup.'
+    return None
+
+@app.route('/admin/adapters', methods=['POST'])
+def add_adapter():
+    # Registers and loads an adapter: {"name": ..., "path": ...}
+    data = request.get_json()
+    reason = adapters_fixed()
+    if reason:
+        return jsonify({'error': reason}), 409
+    name = data.get('name')
+    path = data.get('path')
+    if not name or not path:
+        return jsonify({'error': 'Both name and path are required.'}), 400
+
+    logging.info(f'loading adapter {name} from {path}')
+    try:
+        adapters.register(name, path)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 409
+    except Exception as e:
+        logging.exception(f'Loading adapter {name} failed')
+        return jsonify({'error': f'Loading adapter {name} failed: {e}'}), 400
+    return jsonify({'adapters': adapters.adapters()})
+
+@app.route('/admin/adapters/<name>', methods=['DELETE'])
+def remove_adapter(name):
+    reason = adapters_fixed()
+    if reason:
+        return jsonify({'error': reason}), 409
+    logging.info(f'unloading adapter {name}')
+    try:
+        adapters.unregister(name)
+    except KeyError:
+        return unknown_adapter(name)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 409
+    return jsonify({'adapters': adapters.adapters()})
+
+def start_worker(index=0):
+    # Threads don't survive a fork, so every worker starts its own batch scheduler and log writer
+    global scheduler, admission
+    metrics.use_slot(index)
+    if args.max_queue > 0:
+        # Each worker admits its own share, so a worker that dies holding slots takes them with it
+        admission = threading.BoundedSemaphore(max(1, args.max_queue // args.workers))
+    if args.workers > 1:
+        log_handler.start()
+        # Split the cores between the workers rather than have each of them use all of them
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // args.workers))
+    if draft_model is not None:
+        # Assisted generation only handles one sequence at a time
+        print("Speculative decoding is on, requests are not batched.")
+    elif args.max_batch_size > 1:
+        print(f"Batching up to {args.max_batch_size} requests with a {args.batch_window}ms window.")
+        scheduler = BatchScheduler(evaluate_batch, max_batch_size=args.max_batch_size, batch_window=args.batch_window / 1000, on_wait=queue_wait_seconds.observe)
+
+def worker_exited(index):
+    # A worker that died mid-request never answered it, so its requests are no longer in flight
+    in_flight.reset(index)
+
+def prepare_generation():
+    global prefix_cache, grammar
+    if args.prefix_cache_mb > 0:
+        # Prefill the two fixed preambles once, every prompt starts with one of them
+        print("Prefilling prompt preambles.")
+        prefix_cache = PrefixCache(model, tokenizer, device, max_bytes=args.prefix_cache_mb * 1024**2)
+        prefix_cache.add(PREAMBLE, pinned=True)
+        prefix_cache.add(PREAMBLE_WITH_INPUT, pinned=True)
+
+    if args.max_commands > 0:
+        # The tokenizer and the model config don't always agree on the end of sequence token, so either ends a response
+        eos_token_ids = {tokenizer.eos_token_id}
+        model_eos = model.generation_config.eos_token_id
+        eos_token_ids.update(model_eos if isinstance(model_eos, list) else [model_eos])
+        grammar = CommandGrammar(tokenizer, args.max_commands, sorted(i for i in eos_token_ids if i is not None))
+
+# Typical requests: a bare instruction, one with the system context shsh sends and one with a longer input
+WARMUP_REQUESTS = [
+    ("List the files in the current directory", None),
+    ("Show how much disk space is left", "Shell:/bin/bash\nLSB:Distributor ID: Ubuntu\nDescription: Ubuntu 22.04.2 LTS\nRelease: 22.04\nCodename: jammy\nHostname:host\nUsername:user"),
+    ("Find out why the web server failed to start and restart it", "Shell:/bin/bash\nLSB:Distributor ID: Ubuntu\nDescription: Ubuntu 22.04.2 LTS\nRelease: 22.04\nCodename: jammy\nHostname:host\nUsername:user\nJournal:nginx[812]: bind() to 0.0.0.0:80 failed (98: Address already in use)\nsystemd[1]: nginx.service: Failed with result 'exit-code'.\nsystemd[1]: Failed to start A high performance web server and a reverse proxy server.\nIP:lo UNKNOWN 127.0.0.1/8 ::1/128\neth0 UP 10.0.0.5/24 fe80::1/64\nLSBLK:sda 476.94G\nsdb 1863.02G"),
+]
+
+def warm_up(rounds):
+    # Runs the warm-up requests through every path a request can take, so compiling and other first-use costs are paid before traffic arrives.
+    # Stops once a round is no more than 10% faster than the one before, i.e. latency has settled.
+    previous = None
+    for round in range(1, rounds + 1):
+        start = time.perf_counter()
+        for instruction, input in WARMUP_REQUESTS:
+            evaluate(instruction, input, max_new_tokens=16)
+            for _ in evaluate_stream(instruction, input, max_new_tokens=16):
+                pass
+        if args.max_batch_size > 1 and draft_model is None:
+            evaluate_batch([(instruction, input, DEFAULT_ADAPTER) for instruction, input in WARMUP_REQUESTS], max_new_tokens=16)
+        elapsed = time.perf_counter() - start
+        print(f"Warm-up round {round} took {elapsed:.2f}s.")
+        if previous is not None and elapsed > previous * 0.9:
+            break
+        previous = elapsed
+
+# Reported by /healthz: loading, warming up or ready
+stage = "loading"
+# Set once the model is loaded and warmed up. Requests before then get a 503.
+ready = threading.Event()
+
+def start_up():
+    global stage
+    try:
+        notify("STATUS=Loading model")
+        load_model()
+        prepare_generation()
+        stage = "warming up"
+        notify("STATUS=Warming up")
+        warm_up(args.warmup_rounds)
+        # Leave warm-up and compiling out of the metrics
+        metrics.reset()
+    except Exception as e:
+        # Exit so the service manager restarts us, rather than serving 503s forever
+        logging.exception("Startup failed")
+        print(f"Startup failed: {e} See the log for details.")
+        os._exit(1)
+
+def mark_ready():
+    global stage
+    stage = "ready"
+    ready.set()
+    print("Ready.")
+
 if __name__ == '__main__':
-    # Start the Flask application
-    print("Starting flask.")
-    app.run(host='127.0.0.1', port="5791")
+    log_handler.start()
+    # Write out queued records on exit
+    atexit.register(log_handler.stop)
+
+    if args.workers > 1:
+        # The workers are forked from a loaded and warmed up model, so they can serve straight away
+        metrics.allocate(args.workers)
+        start_up()
+        mark_ready()
+        # Tells systemd it is ready once the port is open
+        serve_forked(app, '127.0.0.1', 5791, args.workers, start_worker, worker_exited)
+    else:
+        def start_up_in_background():
+            start_up()
+            start_worker()
+            mark_ready()
+            # The port has been open all along
+            notify("READY=1\nSTATUS=Ready")
+
+        # Open the port right away, /healthz and /ready answer while the model loads
+        threading.Thread(target=start_up_in_background, name="start-up", daemon=True).start()
+
+        # Start the Flask application
+        print("Starting flask.")
+        app.run(host='127.0.0.1', port="5791")
@@ -0,0 +1,117 @@
+import threading
+from collections import Counter, OrderedDict
+
+
+class AdapterRegistry:
+    """
+    LoRA adapters served on top of a single resident base model.
+
+    Adapters are registered by name and path. At most `max_resident` of them are kept
+    loaded; a request for one that isn't is loaded on demand, unloading the least recently
+    used adapter nobody is generating with. The default adapter always stays loaded.
+
+    Generation doesn't switch the model's active adapter: every generate() call names an
+    adapter per row, so a single batch can mix adapters. Loading and unloading change the
+    model, so they wait until nothing is generating, and generation waits for them.
+    """
+
+    def __init__(self, model, default, default_path=None, max_resident=4):
+        self.model = model
+        self.default = default
+        self.max_resident = max_resident
+        self.paths = {default: default_path}
+        # Resident adapters, least recently used first
+        self.resident = OrderedDict([(default, None)])
+        self.in_use = Counter()
+        self.changing = False
+        self.condition = threading.Condition()
+
+    def __contains__(self, name):
+        return name in self.paths
+
+    def adapters(self):
+        with self.condition:
+            return [{"name": name, "path": path, "resident": name in self.resident} for name, path in self.paths.items()]
+
+    def _exclusive(self):
+        # Called with the condition held. Waits until the model can be changed.
+        self.condition.wait_for(lambda: not self.changing)
+        self.changing = True
+        self.condition.wait_for(lambda: not any(self.in_use.values()))
+
+    def _done(self):
+        self.changing = False
+        self.condition.notify_all()
+
+    def _load(self, name, keep=()):
+        # Called during _exclusive(). Unloads least recently used adapters to make room.
+        while len(self.resident) >= self.max_resident:
+            evictable = [resident for resident in self.resident if resident != self.default and resident not in keep]
+            if not evictable:
+                raise RuntimeError(f"Can't load adapter {name}: more than {self.max_resident} adapters needed at once")
+            self.model.delete_adapter(evictable[0])
+            del self.resident[evictable[0]]
+        self.model.load_adapter(self.paths[name], adapter_name=name)
+        self.resident[name] = None
+
+    def register(self, name, path):
+        # Registers and loads an adapter, so a bad path fails here rather than on its first request
+        with self.condition:
+            if name in self.paths:
+                raise ValueError(f"Adapter {name} is already registered")
+            self._exclusive()
+            try:
+                self.paths[name] = path
+                self._load(name)
+            except Exception:
+                del self.paths[name]
+                raise
+            finally:
+                self._done()
+
+    def unregister(self, name):
+        with self.condition:
+            if name == self.default:
+                raise ValueError("The default adapter can't be removed")
+            if name not in self.paths:
+                raise KeyError(name)
+            self._exclusive()
+            try:
+                if name in self.resident:
+                    self.model.delete_adapter(name)
+                    del self.resident[name]
+                del self.paths[name]
+            finally:
+                self._done()
+
+    def acquire(self, names):
+        # Makes sure every adapter in names is loaded and keeps it loaded until release(names)
+        wanted = set(names)
+        with self.condition:
+            for name in wanted:
+                if name not in self.paths:
+                    raise KeyError(name)
+            while True:
+                self.condition.wait_for(lambda: not self.changing)
+                missing = [name for name in wanted if name not in self.resident]
+                if not missing:
+                    break
+                self._exclusive()
+                try:
+                    for name in missing:
+                        # Unregistered while waiting
+                        if name not in self.paths:
+                            raise KeyError(name)
+                        self._load(name, keep=wanted)
+                finally:
+                    self._done()
+            for name in names:
+                self.in_use[name] += 1
+            for name in wanted:
+                self.resident.move_to_end(name)
+
+    def release(self, names):
+        with self.condition:
+            for name in names:
+                self.in_use[name] -= 1
+            self.condition.notify_all()
@@ -0,0 +1,88 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+
+
+class BatchScheduler:
+    """
+    Collects concurrent requests and hands them to a batched generate function.
+
+    Requests are gathered for up to `batch_window` seconds after the first one
+    arrives, or until `max_batch_size` are waiting, whichever comes first. The
+    batch is then run through `generate_batch(items)`, which must return one
+    result per item in the same order. Requests that arrive while a batch is
+    generating are queued and picked up as soon as it finishes, without waiting
+    out another window if a full batch is already waiting.
+
+    If given, `on_wait(seconds)` is called for every request when its batch starts, with
+    how long it waited in the queue.
+    """
+
+    def __init__(self, generate_batch, max_batch_size=8, batch_window=0.01, on_wait=None):
+        self.generate_batch = generate_batch
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self.on_wait = on_wait
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="batch-scheduler", daemon=True)
+        self.thread.start()
+
+    def submit(self, item) -> Future:
+        # Queue a single request and return a future for its result
+        future = Future()
+        future.submitted = time.monotonic()
+        self.queue.put((item, future))
+        return future
+
+    def __call__(self, item, timeout=None):
+        # Blocking convenience wrapper used by the request handlers
+        future = self.submit(item)
+        try:
+            return future.result(timeout=timeout)
+        except TimeoutError:
+            # Nobody is waiting for it any more, so it is dropped unless it is already generating
+            future.cancel()
+            raise
+
+    def _collect(self):
+        # Block until at least one request is waiting
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.batch_window
+
+        # Keep filling the batch until it is full or the window closes
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0:
+                    batch.append(self.queue.get_nowait())
+                else:
+                    batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+
+            # Drop requests whose callers have already gone away
+            batch = [(item, future) for item, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            if self.on_wait is not None:
+                started = time.monotonic()
+                for _, future in batch:
+                    self.on_wait(started - future.submitted)
+
+            try:
+                results = self.generate_batch([item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
@@ -0,0 +1,44 @@
+"""
+Lower precision CPU inference for alpaca-web.py.
+
+    fp32  full precision, the original CPU path
+    bf16  weights and activations in bfloat16, half the memory of fp32
+    int8  linear layers quantized to int8 with dynamic activation quantization, about a
+          quarter of the memory of fp32. Embeddings and norms stay in fp32.
+"""
+import gc
+
+import torch
+from peft import PeftModel
+
+CPU_MODES = ["fp32", "bf16", "int8"]
+
+
+def load_dtype(mode):
+    # dtype to load the weights in before prepare_cpu_model converts them
+    return "bfloat16" if mode == "bf16" else "float32"
+
+
+def prepare_cpu_model(model, mode):
+    if mode == "fp32":
+        return model
+    if mode == "bf16":
+        return model.to(torch.bfloat16)
+    if mode == "int8":
+        # The LoRA has to be folded into the base weights first: quantization replaces the
+        # linear layers the adapter wraps
+        if isinstance(model, PeftModel):
+            model = model.merge_and_unload()
+        # Quantization kernels differ by CPU: fbgemm needs x86 with AVX2, qnnpack covers ARM
+        if "fbgemm" not in torch.backends.quantized.supported_engines:
+            torch.backends.quantized.engine = "qnnpack"
+        # In place, so the fp32 weights aren't held twice while quantizing
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        # The remaining fp32 tensors may still point into the memory-mapped checkpoint, which
+        # keeps every page of it that quantizing read resident. Copying them releases the mapping.
+        for tensor in list(model.parameters()) + list(model.buffers()):
+            tensor.data = tensor.data.clone()
+        # The replaced fp32 layers sit in reference cycles until the next collection
+        gc.collect()
+        return model
+    raise ValueError(f"Unknown CPU mode {mode!r}")
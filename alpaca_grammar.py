@@ -0,0 +1,193 @@
+"""
+Constrained decoding for alpaca-web.py: the response can only be console commands.
+
+The grammar the output has to follow:
+
+    response = ("\\n" | " ")* line ("\\n" line)* ["\\n"]      at most max_commands lines
+    line     = " "* command-start rest-of-line
+    command-start is anything but a digit, list marker, quote marker, comment, backtick, space or newline
+    rest-of-line  is anything but a newline, with backticks in closed pairs
+    no control characters other than tabs anywhere
+
+That rules out numbered or bulleted lists, code fences, blank lines between commands and
+leading prose markers, while backtick command substitution still works as long as it is
+closed on its line. Newlines before the first command are allowed and not counted, as
+the Alpaca LoRA usually starts its response on the line after "### Response:". Once
+max_commands lines are complete, end of sequence is the only token allowed, so
+generation stops as soon as the grammar is complete.
+"""
+import torch
+from transformers import LogitsProcessor
+
+# Characters a command line can't start with. A backtick would start a code fence.
+BAD_LINE_START = set("0123456789-*+#>|`")
+# Where a token starts: in the middle of a line, at the start of one, before the first command,
+# or between the backticks of a command substitution
+MID_LINE, LINE_START, RESPONSE_START, IN_BACKTICKS = 0, 1, 2, 3
+STATES = (MID_LINE, LINE_START, RESPONSE_START, IN_BACKTICKS)
+
+
+def token_texts(tokenizer):
+    # Text each token in the vocabulary adds to the output, None for special tokens
+    special = set(tokenizer.all_special_ids)
+    texts = []
+    for token_id, piece in enumerate(tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))):
+        if token_id in special or piece is None:
+            texts.append(None)
+        elif piece.startswith("<0x") and piece.endswith(">") and len(piece) == 6:
+            # SentencePiece byte fallback; bytes beyond ASCII are parts of multibyte characters
+            value = int(piece[3:5], 16)
+            texts.append(chr(value) if value < 0x80 else "�")
+        else:
+            text = tokenizer.convert_tokens_to_string([piece])
+            # SentencePiece drops the word boundary marker when a piece is decoded on its own
+            if piece.startswith("▁") and not text.startswith(" "):
+                text = " " + text
+            texts.append(text)
+    return texts
+
+
+def scan(text, state):
+    """
+    Runs text through the grammar from one of STATES.
+    Returns (valid, newlines, state afterwards, whether text has command characters).
+    """
+    newlines = 0
+    content = False
+    for char in text:
+        if char < " " and char not in "\t\n":
+            return False, 0, state, False
+        if state in (LINE_START, RESPONSE_START):
+            if char in " \t" or (char == "\n" and state == RESPONSE_START):
+                continue
+            if char == "\n" or char in BAD_LINE_START:
+                return False, 0, state, False
+            state = MID_LINE
+            content = True
+        elif state == IN_BACKTICKS:
+            # A command substitution has to be closed on the line it was opened on
+            if char == "\n":
+                return False, 0, state, False
+            if char == "`":
+                state = MID_LINE
+            content = True
+        elif char == "\n":
+            newlines += 1
+            state = LINE_START
+        else:
+            if char == "`":
+                state = IN_BACKTICKS
+            content = True
+    return True, newlines, state, content
+
+
+class CommandGrammar:
+    """
+    Per-token grammar tables for a tokenizer, computed once. processor() returns the
+    logits processor for a single generate() call.
+
+    The grammar state after some output is (state, commands still allowed, any command
+    text yet), and advance() moves it on by one token.
+    """
+
+    def __init__(self, tokenizer, max_commands=5, eos_token_id=None):
+        self.max_commands = max_commands
+        if eos_token_id is None:
+            eos_token_id = tokenizer.eos_token_id
+        # Any of these ends the response
+        self.eos_token_ids = [eos_token_id] if isinstance(eos_token_id, int) else list(eos_token_id)
+
+        # Indexed by the state the token starts in
+        self.scans = tuple([] for _ in STATES)
+        for text in token_texts(tokenizer):
+            for state in STATES:
+                self.scans[state].append(scan(text, state) if text is not None else (False, 0, state, False))
+
+        self.valid = [torch.tensor([result[0] for result in scans]) for scans in self.scans]
+        self.newlines = [torch.tensor([result[1] for result in scans]) for scans in self.scans]
+        self.ends_at_line_start = [torch.tensor([result[2] == LINE_START for result in scans]) for scans in self.scans]
+        # A vocabulary padded beyond the tokenizer gets its extra logits masked
+        self.vocab_size = len(self.scans[0])
+        # Grammar state before any output
+        self.start = (RESPONSE_START, max_commands, False)
+        # Only a handful of grammar states occur, so each one's mask is built once
+        self.masks = {}
+
+    def advance(self, grammar_state, token_id):
+        # Grammar state after token_id
+        if token_id >= self.vocab_size:
+            return grammar_state
+        state, remaining, content = grammar_state
+        _, newlines, state, has_content = self.scans[state][token_id]
+        return state, remaining - newlines, content or has_content
+
+    def state(self, token_ids):
+        # Grammar state after token_ids
+        grammar_state = self.start
+        for token_id in token_ids:
+            grammar_state = self.advance(grammar_state, token_id)
+        return grammar_state
+
+    def allowed(self, grammar_state, vocab_size, device):
+        key = (grammar_state, vocab_size, str(device))
+        if key not in self.masks:
+            state, remaining, content = grammar_state
+            mask = torch.zeros(vocab_size, dtype=torch.bool)
+            if remaining > 0:
+                newlines = self.newlines[state]
+                # Tokens may complete the last allowed line, but not run past it
+                fits = (newlines < remaining) | ((newlines == remaining) & self.ends_at_line_start[state])
+                mask[:self.vocab_size] = self.valid[state] & fits
+            # The response can't end inside a command substitution
+            if (content or remaining <= 0) and state != IN_BACKTICKS:
+                mask[self.eos_token_ids] = True
+            self.masks[key] = mask.to(device)
+        return self.masks[key]
+
+    def processor(self, prompt_length):
+        return CommandLogitsProcessor(self, prompt_length)
+
+
+class CommandLogitsProcessor(LogitsProcessor):
+    """
+    Masks the tokens the grammar doesn't allow next. Keeps the grammar state after every
+    output token of each row, so each call only advances a row over its new tokens.
+
+    generate() doesn't tell logits processors how it reorders rows: beam search continues
+    each row from whichever beam scored best, and assisted decoding drops the draft tokens
+    the model rejects. So each row continues from the row of the last call that shares the
+    longest start of output with it, found with one tensor comparison.
+    """
+
+    def __init__(self, grammar, prompt_length):
+        self.grammar = grammar
+        self.prompt_length = prompt_length
+        # Output tokens of each row in the last call, and its grammar states: states[row][n] is the state after n tokens
+        self.tokens = None
+        self.states = None
+
+    def __call__(self, input_ids, scores):
+        tokens = input_ids[:, self.prompt_length:]
+        if self.tokens is None or not self.tokens.shape[1] or not tokens.shape[1]:
+            parents = [0] * len(tokens)
+            shared = [0] * len(tokens)
+            previous = [[self.grammar.start]]
+        else:
+            width = min(self.tokens.shape[1], tokens.shape[1])
+            # Length of the output each row has in common with each row of the last call
+            same = tokens[:, None, :width] == self.tokens[None, :, :width].to(tokens.device)
+            common = same.int().cumprod(dim=2).sum(dim=2)
+            shared, parents = (values.tolist() for values in common.max(dim=1))
+            previous = self.states
+
+        states = []
+        for row, token_ids in enumerate(tokens.tolist()):
+            row_states = previous[parents[row]][:shared[row] + 1]
+            for token_id in token_ids[shared[row]:]:
+                row_states.append(self.grammar.advance(row_states[-1], token_id))
+            states.append(row_states)
+            mask = self.grammar.allowed(row_states[-1], scores.shape[-1], scores.device)
+            scores[row] = scores[row].masked_fill(~mask, float("-inf"))
+        self.tokens = tokens
+        self.states = states
+        return scores
@@ -0,0 +1,42 @@
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+
+class AsyncLogHandler(QueueHandler):
+    """
+    Hands log records to a background thread that writes them with `handler`, so request
+    threads never wait on the log file. The queue is bounded: when the writer falls
+    behind, records are dropped and counted instead of blocking requests.
+
+    Threads don't survive a fork, so every forked worker calls start() again. A worker
+    gets a fresh queue, leaving the records queued before the fork to the parent.
+    """
+
+    def __init__(self, handler, max_queue=10000, on_drop=None):
+        super().__init__(queue.Queue(max_queue))
+        self.handler = handler
+        self.max_queue = max_queue
+        self.on_drop = on_drop
+        self.listener = None
+        self.pid = os.getpid()
+
+    def start(self):
+        if os.getpid() != self.pid:
+            self.pid = os.getpid()
+            self.queue = queue.Queue(self.max_queue)
+        self.listener = QueueListener(self.queue, self.handler)
+        self.listener.start()
+
+    def stop(self):
+        # Writes out whatever is still queued
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if self.on_drop is not None:
+                self.on_drop()
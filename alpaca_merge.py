@@ -0,0 +1,106 @@
+"""
+Build step for alpaca-web.py: merges the LoRA adapter into the base model once and saves
+the result as safetensors, so the server can load it memory-mapped instead of loading the
+base model and applying the adapter on every start.
+
+    python alpaca_merge.py --output alpaca-merged --dtype float16
+"""
+import argparse
+import hashlib
+import json
+import os
+import time
+
+import torch
+from peft import PeftModel
+from transformers import LlamaForCausalLM, LlamaTokenizer
+
+# Same models alpaca-web.py serves
+BASE_MODEL = "decapoda-research/llama-7b-hf"
+LORA_WEIGHTS = "tloen/alpaca-lora-7b"
+DEFAULT_OUTPUT = "alpaca-merged"
+MANIFEST_FILE = "alpaca-merge.json"
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def merge(base_model, lora_weights, output, dtype="float16"):
+    # Apply the adapter, fold it into the base weights and save plain safetensors
+    torch_dtype = getattr(torch, dtype)
+    model = LlamaForCausalLM.from_pretrained(base_model, torch_dtype=torch_dtype, low_cpu_mem_usage=True)
+    model = PeftModel.from_pretrained(model, lora_weights, torch_dtype=torch_dtype)
+    model = model.merge_and_unload()
+    model.save_pretrained(output, safe_serialization=True)
+
+    # The manifest records what the artifact was built from and checksums of its weights
+    files = {}
+    for name in sorted(os.listdir(output)):
+        if name.endswith(".safetensors"):
+            path = os.path.join(output, name)
+            stat = os.stat(path)
+            files[name] = {"sha256": file_sha256(path), "size": stat.st_size, "mtime": stat.st_mtime}
+    manifest = {"base_model": base_model, "lora_weights": lora_weights, "dtype": dtype, "files": files}
+    with open(os.path.join(output, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=4)
+    return manifest
+
+
+def is_reusable(path, base_model, lora_weights, dtype, verify=False):
+    """
+    Whether the artifact at path was built from base_model and lora_weights in dtype and
+    its weights are intact. Files whose size and modification time still match the
+    manifest are trusted without rehashing, unless verify is set; anything else is
+    checked against its recorded checksum.
+    """
+    try:
+        with open(os.path.join(path, MANIFEST_FILE), "r") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return False
+
+    if (manifest.get("base_model"), manifest.get("lora_weights"), manifest.get("dtype")) != (base_model, lora_weights, dtype):
+        return False
+    if not manifest.get("files"):
+        return False
+
+    for name, recorded in manifest["files"].items():
+        file_path = os.path.join(path, name)
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return False
+        if stat.st_size != recorded["size"]:
+            return False
+        if verify or stat.st_mtime != recorded["mtime"]:
+            if file_sha256(file_path) != recorded["sha256"]:
+                return False
+    return True
+
+
+def load_merged(path, dtype, **kwargs):
+    # safetensors files are memory-mapped, so weights are only paged in as they are used
+    return LlamaForCausalLM.from_pretrained(path, torch_dtype=getattr(torch, dtype), low_cpu_mem_usage=True, **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge the Alpaca LoRA into the base model for fast alpaca-web.py starts")
+    parser.add_argument("--base-model", type=str, default=BASE_MODEL, help="Base model to merge into")
+    parser.add_argument("--lora-weights", type=str, default=LORA_WEIGHTS, help="LoRA adapter to merge")
+    parser.add_argument("--output", type=str, default=DEFAULT_OUTPUT, help="Directory to write the merged model to")
+    parser.add_argument("--dtype", choices=["float16", "bfloat16", "float32"], default="float16", help="dtype to store the weights in. alpaca-web.py uses float16 on GPUs and float32 on CPU.")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    merge(args.base_model, args.lora_weights, args.output, args.dtype)
+    LlamaTokenizer.from_pretrained(args.base_model).save_pretrained(args.output)
+    print(f"Merged model written to {args.output} in {time.perf_counter() - start:.1f}s.")
+
+
+if __name__ == "__main__":
+    main()
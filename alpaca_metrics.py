@@ -0,0 +1,200 @@
+"""
+Prometheus metrics for alpaca-web.py.
+
+Values live in shared memory, allocated before --workers forks, with a slot for each
+worker. A worker only ever writes to its own slot, so no lock is shared between processes
+and a worker killed mid-update can't block the others. /metrics sums the slots, so it
+reports totals across all workers whichever of them answers the scrape. Gauges backed by a
+function are the exception: they are evaluated by the process answering the scrape.
+"""
+import math
+import multiprocessing
+import threading
+
+
+def format_value(value):
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in labels)
+    return "{" + pairs + "}"
+
+
+class Metric:
+    """
+    Base class for metrics with an optional single label, whose values are fixed up front
+    so the shared memory can be allocated before forking.
+    """
+    type = None
+
+    def __init__(self, registry, name, help, label=None, values=(), size=1):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = tuple(values) if label else (None,)
+        self.size = size
+        self.registry = registry
+        # Values of one slot
+        self.width = size * len(self.values)
+        self.allocate(registry.slots)
+
+    def allocate(self, slots):
+        self.data = multiprocessing.RawArray('d', slots * self.width)
+
+    def offset(self, value):
+        return self.registry.slot * self.width + self.values.index(value) * self.size
+
+    def labels(self, value, extra=()):
+        labels = [(self.label, value)] if self.label else []
+        return format_labels(labels + list(extra))
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        values = list(self.data)
+        data = [sum(values[index::self.width]) for index in range(self.width)]
+        for index, value in enumerate(self.values):
+            lines += self.samples(value, data[index * self.size:(index + 1) * self.size])
+        return lines
+
+    def samples(self, value, data):
+        return [f"{self.name}{self.labels(value)} {format_value(data[0])}"]
+
+    def reset(self, slot=None):
+        # Zeroes every slot, or just the given one
+        start, end = (0, len(self.data)) if slot is None else (slot * self.width, (slot + 1) * self.width)
+        for index in range(start, end):
+            self.data[index] = 0
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, value=None):
+        with self.registry.lock:
+            self.data[self.offset(value)] += amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def inc(self, amount=1, value=None):
+        with self.registry.lock:
+            self.data[self.offset(value)] += amount
+
+    def dec(self, amount=1, value=None):
+        self.inc(-amount, value)
+
+    def set(self, amount, value=None):
+        with self.registry.lock:
+            self.data[self.offset(value)] = amount
+
+
+class FunctionGauge:
+    # A gauge read from a function when scraped, such as the scraping process's memory use
+    type = "gauge"
+
+    def __init__(self, name, help, function):
+        self.name = name
+        self.help = help
+        self.function = function
+
+    def allocate(self, slots):
+        pass
+
+    def reset(self, slot=None):
+        pass
+
+    def render(self):
+        value = self.function()
+        if value is None:
+            return []
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}", f"{self.name} {format_value(value)}"]
+
+
+class Histogram(Metric):
+    """
+    Cumulative histogram over the given bucket upper bounds. Stored as one count per
+    bucket plus +Inf, followed by the sum and the count of observations.
+    """
+    type = "histogram"
+
+    def __init__(self, registry, name, help, buckets, label=None, values=()):
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        super().__init__(registry, name, help, label, values, size=len(self.buckets) + 2)
+
+    def observe(self, amount, value=None):
+        offset = self.offset(value)
+        bucket = next(index for index, bound in enumerate(self.buckets) if amount <= bound)
+        with self.registry.lock:
+            self.data[offset + bucket] += 1
+            self.data[offset + len(self.buckets)] += amount
+            self.data[offset + len(self.buckets) + 1] += 1
+
+    def samples(self, value, data):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, data):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{self.labels(value, [('le', format_value(bound))])} {format_value(cumulative)}")
+        lines.append(f"{self.name}_sum{self.labels(value)} {format_value(data[-2])}")
+        lines.append(f"{self.name}_count{self.labels(value)} {format_value(data[-1])}")
+        return lines
+
+
+class Registry:
+    """
+    Metrics rendered together in the Prometheus text exposition format. Starts with a
+    single slot; allocate() makes one per worker before forking, and each worker picks its
+    own with use_slot().
+    """
+
+    content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self.metrics = []
+        self.slots = 1
+        self.slot = 0
+        # Only guards the threads of this process, which share its slot
+        self.lock = threading.Lock()
+
+    def allocate(self, slots):
+        # Replaces every value with zeroed memory for `slots` processes
+        self.slots = slots
+        for metric in self.metrics:
+            metric.allocate(slots)
+
+    def use_slot(self, slot):
+        # Called in a worker after the fork. A lock held by another thread at fork time would never be released in the child.
+        self.slot = slot
+        self.lock = threading.Lock()
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, label=None, values=()):
+        return self.add(Counter(self, name, help, label, values))
+
+    def gauge(self, name, help, label=None, values=()):
+        return self.add(Gauge(self, name, help, label, values))
+
+    def function_gauge(self, name, help, function):
+        return self.add(FunctionGauge(name, help, function))
+
+    def histogram(self, name, help, buckets, label=None, values=()):
+        return self.add(Histogram(self, name, help, buckets, label, values))
+
+    def reset(self, slot=None):
+        for metric in self.metrics:
+            metric.reset(slot)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
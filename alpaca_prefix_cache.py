@@ -0,0 +1,86 @@
+import copy
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+def cache_nbytes(past_key_values) -> int:
+    # Size of all key/value tensors held by a cache
+    nbytes = 0
+    for layer in past_key_values:
+        for tensor in layer:
+            if torch.is_tensor(tensor):
+                nbytes += tensor.numel() * tensor.element_size()
+    return nbytes
+
+
+class PrefixCache:
+    """
+    Keeps the `past_key_values` of shared prompt prefixes so they are only prefilled once.
+
+    Entries are looked up by token ids: `lookup(input_ids)` returns the longest cached
+    prefix that the prompt starts with, so a prefix matches no matter how the rest of
+    the prompt was built. Least recently used entries are evicted once the total size
+    of the cached tensors goes over `max_bytes`. Pinned entries (the static Alpaca
+    preambles) are never evicted.
+    """
+
+    def __init__(self, model, tokenizer, device, max_bytes=512 * 1024**2):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # prefix text -> (input_ids, past_key_values, nbytes, pinned)
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def add(self, text, pinned=False):
+        # Prefill the prefix once and keep its key/value cache
+        with self.lock:
+            if text in self.entries:
+                self.entries.move_to_end(text)
+                return
+
+        input_ids = self.tokenizer(text, return_tensors="pt")["input_ids"].to(self.device)
+        with torch.no_grad():
+            past_key_values = self.model(input_ids=input_ids, use_cache=True).past_key_values
+        nbytes = cache_nbytes(past_key_values)
+
+        with self.lock:
+            if text in self.entries:
+                # Another request prefilled it at the same time
+                self.nbytes -= self.entries[text][2]
+            self.entries[text] = (input_ids[0], past_key_values, nbytes, pinned)
+            self.nbytes += nbytes
+            self._evict()
+
+    def lookup(self, input_ids):
+        """
+        Returns a private copy of the cache for the longest stored prefix of input_ids
+        (a 1-D tensor), or None when no stored prefix matches.
+        """
+        with self.lock:
+            best = None
+            for text, (prefix_ids, past_key_values, _, _) in self.entries.items():
+                length = prefix_ids.shape[0]
+                # The whole prompt can't be cached, generate needs at least one new token to run
+                if length >= input_ids.shape[0] or (best and length <= best[1].shape[0]):
+                    continue
+                if torch.equal(input_ids[:length], prefix_ids):
+                    best = (text, prefix_ids, past_key_values)
+            if best is None:
+                return None
+            self.entries.move_to_end(best[0])
+            # generate() appends to the cache in place, so every request needs its own copy
+            return copy.deepcopy(best[2])
+
+    def _evict(self):
+        # Drop least recently used unpinned entries until the cache fits
+        for text in list(self.entries):
+            if self.nbytes <= self.max_bytes:
+                break
+            _, _, nbytes, pinned = self.entries[text]
+            if not pinned:
+                del self.entries[text]
+                self.nbytes -= nbytes
@@ -0,0 +1,19 @@
+# The fixed text every Alpaca prompt starts with. The prefix cache in alpaca-web.py precomputes these.
+PREAMBLE_WITH_INPUT = "Below is an instruction that describes a task, paired with an input that provides further context. Write a response that appropriately completes the request.\n\n"
+PREAMBLE = "Below is an instruction that describes a task. Write a response that appropriately completes the request.\n\n"
+
+
+def generate_prompt(instruction, input=None):
+    if input:
+        return f"""{PREAMBLE_WITH_INPUT}### Instruction:
+{instruction}
+
+### Input:
+{input}
+
+### Response:"""
+    else:
+        return f"""{PREAMBLE}### Instruction:
+{instruction}
+
+### Response:"""
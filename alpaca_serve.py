@@ -0,0 +1,108 @@
+"""
+Pre-fork serving for alpaca-web.py.
+
+The model is loaded once in the parent process, which then binds the listening socket and
+forks the workers. Each worker serves requests from the shared socket with its own
+threaded WSGI server. The weights are only ever read after loading, so the workers share
+the parent's copy of them through copy-on-write instead of each loading the model.
+"""
+import os
+import signal
+import socket
+import threading
+import time
+
+from werkzeug.serving import make_server
+
+
+def exit_with_parent(fd):
+    # Reading the pipe only returns once the parent, the last process holding its write end, has exited
+    os.read(fd, 1)
+    os.kill(os.getpid(), signal.SIGTERM)
+
+
+def serve_forked(app, host, port, workers, start_worker, worker_exited=None):
+    """
+    Serves app on host:port from `workers` forked processes until SIGTERM or SIGINT.
+    start_worker(index) is called in each worker after the fork, to start anything that
+    doesn't survive one, such as threads. Workers that exit are restarted, after
+    worker_exited(index) is called in the parent. Workers exit when the parent does, even
+    if it is killed. Readiness is reported to systemd once the port is open.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(128)
+    sock.set_inheritable(True)
+    parent_alive, parent_alive_writer = os.pipe()
+    # Connections are queued from here on, so clients are no longer refused
+    notify("READY=1\nSTATUS=Ready")
+
+    children = {}
+    stopping = False
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                os.close(parent_alive_writer)
+                # Workers forked after the parent set up stop() would otherwise run it too
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.default_int_handler)
+                threading.Thread(target=exit_with_parent, args=(parent_alive,), name="exit-with-parent", daemon=True).start()
+                start_worker(index)
+                server = make_server(host, port, app, threaded=True, fd=sock.fileno())
+                server.serve_forever()
+                status = 0
+            except KeyboardInterrupt:
+                status = 0
+            finally:
+                # Never fall back into the parent's code
+                os._exit(status)
+        children[pid] = index
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    for index in range(workers):
+        spawn(index)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print(f"Serving on http://{host}:{port} with {workers} workers.")
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index = children.pop(pid, None)
+        if index is not None and worker_exited is not None:
+            worker_exited(index)
+        if index is not None and not stopping:
+            print(f"Worker {pid} exited with status {status}, restarting it.")
+            # Don't spin if workers die straight away
+            time.sleep(1)
+            spawn(index)
+    sock.close()
+    os.close(parent_alive)
+    os.close(parent_alive_writer)
+
+
+def notify(state):
+    # Reports startup progress to systemd when running as a Type=notify service
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address:
+        return
+    if address.startswith("@"):
+        # Abstract socket namespace
+        address = "\0" + address[1:]
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        sock.connect(address)
+        sock.sendall(state.encode())
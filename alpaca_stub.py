@@ -0,0 +1,48 @@
+"""
+Stand-in model for alpaca-web.py --stub-model.
+
+A LLaMA with a few small layers and random weights, with a LoRA on top, and a byte-level
+tokenizer built in memory. Nothing is downloaded, so the server, the load-testing client
+and their overhead can be benchmarked on any machine. Requests go through the same code
+as with the real model: tokenizing, batching, the prefix cache, the command grammar,
+adapters and streaming. The responses are nonsense.
+"""
+import torch
+from peft import LoraConfig, get_peft_model
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+SPECIAL_TOKENS = ["<unk>", "<s>", "</s>"]
+
+
+def stub_tokenizer():
+    # One token per byte, so any text can be encoded
+    vocab = {token: index for index, token in enumerate(SPECIAL_TOKENS + sorted(pre_tokenizers.ByteLevel.alphabet()))}
+    backend = Tokenizer(models.BPE(vocab=vocab, merges=[], unk_token="<unk>"))
+    backend.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    backend.decoder = decoders.ByteLevel()
+    return PreTrainedTokenizerFast(tokenizer_object=backend, unk_token="<unk>", bos_token="<s>", eos_token="</s>")
+
+
+def stub_base_model(tokenizer, seed=0):
+    # The same random weights for the same seed, so adapters trained on it by alpaca_train.py --stub-model fit
+    torch.manual_seed(seed)
+    config = LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=256,
+        intermediate_size=688,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        max_position_embeddings=2048,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=0,
+    )
+    return LlamaForCausalLM(config)
+
+
+def stub_model(tokenizer, adapter_name, seed=0):
+    model = stub_base_model(tokenizer, seed)
+    # Same shape as the Alpaca LoRA, so adapter handling is exercised too
+    lora = LoraConfig(r=16, lora_alpha=16, target_modules=["q_proj", "v_proj"], init_lora_weights=False)
+    return get_peft_model(model, lora, adapter_name=adapter_name)
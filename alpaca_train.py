@@ -0,0 +1,330 @@
+"""
+Trains a LoRA adapter on fine-tuning/commandpairs.jsonl for alpaca-web.py to serve.
+
+Each pair becomes an Alpaca prompt with the description as the instruction and the
+command as the response. The pairs are tokenized once into memory-mapped arrays in
+--data: tokens.bin holds every token back to back, offsets.npy where each example starts
+and prompt_lengths.npy how many of its tokens are prompt. Later runs reuse them as long
+as the pairs file, the tokenizer and --max-length are unchanged.
+
+Command pairs are short, so padding each example to the longest in its batch spends most
+of the compute on padding. Examples are instead packed back to back into rows of up to
+--seq-len tokens. A block-diagonal causal mask keeps each example from attending to the
+others in its row, position ids restart at 0 for each example, and only the response
+tokens count towards the loss. Throughput is reported in real tokens per second, so
+--no-packing gives a fair comparison.
+
+--stub-model trains on the random model alpaca-web.py --stub-model serves, so the whole
+path runs on a CPU:
+
+    python alpaca_train.py --stub-model --max-steps 50 --output commands-lora-stub
+    python alpaca-web.py --stub-model --adapter commands=commands-lora-stub
+"""
+import argparse
+import itertools
+import json
+import math
+import os
+import random
+import time
+
+import numpy as np
+import torch
+from peft import LoraConfig, get_peft_model
+from transformers import LlamaForCausalLM, LlamaTokenizer, get_linear_schedule_with_warmup
+
+from alpaca_merge import BASE_MODEL, file_sha256
+from alpaca_prompt import generate_prompt
+from alpaca_stub import stub_base_model, stub_tokenizer
+
+DEFAULT_PAIRS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fine-tuning", "commandpairs.jsonl")
+DEFAULT_DATA = "commands-train-data"
+DEFAULT_OUTPUT = "commands-lora"
+META_FILE = "meta.json"
+# Label of tokens left out of the loss
+IGNORE_INDEX = -100
+
+
+def read_pairs(path):
+    with open(path, "r") as f:
+        for line in f:
+            if line.strip():
+                pair = json.loads(line)
+                yield pair["prompt"].strip(), pair["completion"].strip()
+
+
+def tokenize(pairs_path, data, tokenizer, tokenizer_name, max_length, chunk=1000):
+    """
+    Tokenizes every pair into data, a chunk of pairs at a time so memory doesn't grow with
+    the dataset. Examples are cut at max_length tokens; ones whose prompt alone is that
+    long are skipped.
+    """
+    os.makedirs(data, exist_ok=True)
+    dtype = np.uint16 if len(tokenizer) <= 2**16 else np.int32
+    offsets = [0]
+    prompt_lengths = []
+    skipped = 0
+    pairs = read_pairs(pairs_path)
+    with open(os.path.join(data, "tokens.bin"), "wb") as f:
+        while True:
+            batch = list(itertools.islice(pairs, chunk))
+            if not batch:
+                break
+            prompts = [generate_prompt(description) for description, _ in batch]
+            prompt_ids = tokenizer(prompts)["input_ids"]
+            # The response starts on the line after "### Response:", as in the Alpaca training data
+            full_ids = tokenizer([prompt + "\n" + command for prompt, (_, command) in zip(prompts, batch)])["input_ids"]
+            for prompt, ids in zip(prompt_ids, full_ids):
+                if len(prompt) >= max_length:
+                    skipped += 1
+                    continue
+                ids = (ids + [tokenizer.eos_token_id])[:max_length]
+                f.write(np.asarray(ids, dtype=dtype).tobytes())
+                offsets.append(offsets[-1] + len(ids))
+                prompt_lengths.append(len(prompt))
+    np.save(os.path.join(data, "offsets.npy"), np.asarray(offsets, dtype=np.int64))
+    np.save(os.path.join(data, "prompt_lengths.npy"), np.asarray(prompt_lengths, dtype=np.int32))
+
+    meta = {
+        "pairs_sha256": file_sha256(pairs_path),
+        "tokenizer": tokenizer_name,
+        "max_length": max_length,
+        "dtype": np.dtype(dtype).name,
+        "examples": len(prompt_lengths),
+        "tokens": offsets[-1],
+        "skipped": skipped,
+    }
+    with open(os.path.join(data, META_FILE), "w") as f:
+        json.dump(meta, f, indent=4)
+    return meta
+
+
+def is_tokenized(data, pairs_path, tokenizer_name, max_length):
+    # Whether data holds pairs_path tokenized the same way
+    try:
+        with open(os.path.join(data, META_FILE), "r") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return (meta.get("tokenizer"), meta.get("max_length")) == (tokenizer_name, max_length) and meta.get("pairs_sha256") == file_sha256(pairs_path)
+
+
+class TokenData:
+    """Tokenized examples in data, memory-mapped rather than read in."""
+
+    def __init__(self, data):
+        with open(os.path.join(data, META_FILE), "r") as f:
+            self.meta = json.load(f)
+        self.tokens = np.memmap(os.path.join(data, "tokens.bin"), dtype=self.meta["dtype"], mode="r")
+        self.offsets = np.load(os.path.join(data, "offsets.npy"), mmap_mode="r")
+        self.prompt_lengths = np.load(os.path.join(data, "prompt_lengths.npy"), mmap_mode="r")
+        self.lengths = np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.prompt_lengths)
+
+    def example(self, index):
+        # Tokens of the example and how many of them are prompt
+        return self.tokens[self.offsets[index]:self.offsets[index + 1]], int(self.prompt_lengths[index])
+
+
+def pack(lengths, order, seq_len):
+    # Rows of example indexes, filled in the given order until the next example doesn't fit
+    rows = []
+    row = []
+    used = 0
+    for index in order:
+        length = int(lengths[index])
+        if row and used + length > seq_len:
+            rows.append(row)
+            row = []
+            used = 0
+        row.append(index)
+        used += length
+    if row:
+        rows.append(row)
+    return rows
+
+
+def make_batch(data, rows, pad_token_id, dtype):
+    """
+    input_ids, labels, position_ids and a 4D additive attention mask for rows of packed
+    examples, padded to the longest row. Each example attends only to itself, causally,
+    with position ids from 0. Prompt tokens and padding get IGNORE_INDEX labels. Padding
+    is a block of its own, so no row of the mask is empty.
+    """
+    width = max(sum(int(data.lengths[index]) for index in row) for row in rows)
+    input_ids = torch.full((len(rows), width), pad_token_id, dtype=torch.long)
+    labels = torch.full((len(rows), width), IGNORE_INDEX, dtype=torch.long)
+    position_ids = torch.zeros((len(rows), width), dtype=torch.long)
+    blocks = torch.full((len(rows), width), -1, dtype=torch.long)
+    for row_index, row in enumerate(rows):
+        start = 0
+        for block, index in enumerate(row):
+            tokens, prompt_length = data.example(index)
+            end = start + len(tokens)
+            ids = torch.from_numpy(tokens.astype(np.int64))
+            input_ids[row_index, start:end] = ids
+            # The model shifts labels by one, so the last prompt token learns to predict the first response token
+            labels[row_index, start + prompt_length:end] = ids[prompt_length:]
+            position_ids[row_index, start:end] = torch.arange(len(tokens))
+            blocks[row_index, start:end] = block
+            start = end
+        position_ids[row_index, start:] = torch.arange(width - start)
+    causal = torch.ones((width, width), dtype=torch.bool).tril()
+    allowed = (blocks[:, :, None] == blocks[:, None, :]) & causal
+    attention_mask = torch.zeros(allowed.shape, dtype=dtype).masked_fill_(~allowed, torch.finfo(dtype).min)
+    return input_ids, labels, position_ids, attention_mask[:, None]
+
+
+def epoch_rows(data, epochs, seq_len, packing, seed):
+    # The rows of every epoch, each from its own shuffle of the examples
+    rng = random.Random(seed)
+    all_rows = []
+    for _ in range(epochs):
+        order = list(range(len(data)))
+        rng.shuffle(order)
+        all_rows.append(pack(data.lengths, order, seq_len) if packing else [[index] for index in order])
+    return all_rows
+
+
+def train(model, data, args, device, pad_token_id):
+    all_rows = epoch_rows(data, args.epochs, args.seq_len, not args.no_packing, args.seed)
+    steps = sum(math.ceil(len(rows) / args.batch_size) for rows in all_rows) // args.gradient_accumulation
+    if args.max_steps:
+        steps = min(steps, args.max_steps)
+    steps = max(steps, 1)
+    parameters = [parameter for parameter in model.parameters() if parameter.requires_grad]
+    optimizer = torch.optim.AdamW(parameters, lr=args.learning_rate, weight_decay=0.0)
+    scheduler = get_linear_schedule_with_warmup(optimizer, int(steps * args.warmup), steps)
+    dtype = next(model.parameters()).dtype
+    print(f"{len(data)} examples in {sum(len(rows) for rows in all_rows) // args.epochs} rows per epoch, {steps} optimizer steps")
+
+    model.train()
+    step = 0
+    micro_steps = 0
+    losses = []
+    # Real tokens and all positions, padding included, since the last report and overall
+    tokens = positions = total_tokens = total_positions = 0
+    start = report_start = time.perf_counter()
+    for rows in all_rows:
+        for batch_start in range(0, len(rows), args.batch_size):
+            batch_rows = rows[batch_start:batch_start + args.batch_size]
+            input_ids, labels, position_ids, attention_mask = (
+                tensor.to(device) for tensor in make_batch(data, batch_rows, pad_token_id, dtype)
+            )
+            loss = model(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids, labels=labels).loss
+            (loss / args.gradient_accumulation).backward()
+            losses.append(loss.item())
+            batch_tokens = sum(int(data.lengths[index]) for row in batch_rows for index in row)
+            tokens += batch_tokens
+            positions += input_ids.numel()
+            micro_steps += 1
+            if micro_steps % args.gradient_accumulation:
+                continue
+
+            torch.nn.utils.clip_grad_norm_(parameters, 1.0)
+            optimizer.step()
+            scheduler.step()
+            optimizer.zero_grad()
+            step += 1
+            if step % args.log_every == 0 or step == steps:
+                elapsed = time.perf_counter() - report_start
+                print(f"step {step}/{steps}: loss {sum(losses) / len(losses):.4f}, {tokens / elapsed:.0f} tokens/s, {1 - tokens / positions:.0%} padding")
+                total_tokens += tokens
+                total_positions += positions
+                losses = []
+                tokens = positions = 0
+                report_start = time.perf_counter()
+            if step == steps:
+                break
+        if step == steps:
+            break
+
+    elapsed = time.perf_counter() - start
+    total_tokens += tokens
+    total_positions += positions
+    print(f"Trained {step} steps in {elapsed:.1f}s: {total_tokens / elapsed:.0f} tokens/s, {1 - total_tokens / max(total_positions, 1):.0%} padding")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train a LoRA adapter on command pairs for alpaca-web.py")
+    parser.add_argument("--pairs", type=str, default=DEFAULT_PAIRS, help="Command pairs to train on, as written by make_questions.py or dedupe_pairs.py")
+    parser.add_argument("--data", type=str, default=DEFAULT_DATA, help="Directory for the tokenized pairs. Reused while the pairs, tokenizer and --max-length are unchanged.")
+    parser.add_argument("--output", type=str, default=DEFAULT_OUTPUT, help="Directory to save the adapter to")
+    parser.add_argument("--base-model", type=str, default=BASE_MODEL, help="Base model to train the adapter for")
+    parser.add_argument("--stub-model", action="store_true", help="Train on the random model alpaca-web.py --stub-model serves, to try training without the real weights")
+    parser.add_argument("--tokenize-only", action="store_true", help="Tokenize the pairs into --data and stop")
+    parser.add_argument("--max-length", type=int, default=256, help="Tokens an example is cut to")
+    parser.add_argument("--seq-len", type=int, default=512, help="Tokens in a row of packed examples")
+    parser.add_argument("--no-packing", action="store_true", help="One example per row, padded to the longest in the batch, to compare with packing")
+    parser.add_argument("--batch-size", type=int, default=4, help="Rows per forward pass")
+    parser.add_argument("--gradient-accumulation", type=int, default=1, help="Forward passes per optimizer step")
+    parser.add_argument("--gradient-checkpointing", action="store_true", help="Recompute activations in the backward pass to save memory")
+    parser.add_argument("--epochs", type=int, default=3, help="Passes over the pairs")
+    parser.add_argument("--max-steps", type=int, default=0, help="Stop after this many optimizer steps. 0 for no limit.")
+    parser.add_argument("--learning-rate", type=float, default=3e-4, help="Peak learning rate")
+    parser.add_argument("--warmup", type=float, default=0.05, help="Fraction of the steps to warm the learning rate up over")
+    parser.add_argument("--lora-r", type=int, default=16, help="LoRA rank")
+    parser.add_argument("--lora-alpha", type=int, default=16, help="LoRA scaling")
+    parser.add_argument("--lora-dropout", type=float, default=0.05, help="Dropout on the LoRA input")
+    parser.add_argument("--target-modules", nargs="+", default=["q_proj", "v_proj"], help="Modules to put LoRA on")
+    parser.add_argument("--log-every", type=int, default=10, help="Optimizer steps between progress reports")
+    parser.add_argument("--seed", type=int, default=42, help="Seed for shuffling and LoRA initialization")
+    args = parser.parse_args()
+
+    if args.max_length > args.seq_len:
+        parser.error("--max-length can't be more than --seq-len")
+
+    # The same tokenizer class alpaca-web.py serves with, so the adapter is trained on the token ids it will see
+    tokenizer = stub_tokenizer() if args.stub_model else LlamaTokenizer.from_pretrained(args.base_model)
+    # Pairs tokenized by another tokenizer class, even from the same files, are tokenized again
+    tokenizer_name = "stub" if args.stub_model else f"{type(tokenizer).__name__}:{args.base_model}"
+    if tokenizer.pad_token_id is None:
+        tokenizer.pad_token_id = 0
+
+    if is_tokenized(args.data, args.pairs, tokenizer_name, args.max_length):
+        print(f"Using the tokenized pairs in {args.data}")
+    else:
+        start = time.perf_counter()
+        meta = tokenize(args.pairs, args.data, tokenizer, tokenizer_name, args.max_length)
+        print(f"Tokenized {meta['examples']} pairs into {meta['tokens']} tokens in {time.perf_counter() - start:.1f}s, skipped {meta['skipped']} with prompts over {args.max_length} tokens")
+    if args.tokenize_only:
+        return
+    data = TokenData(args.data)
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    if args.stub_model:
+        model = stub_base_model(tokenizer).to(device)
+    else:
+        # The LoRA weights themselves stay in float32
+        model = LlamaForCausalLM.from_pretrained(
+            args.base_model,
+            torch_dtype=torch.float16 if device == "cuda" else torch.float32,
+            device_map={"": device},
+            low_cpu_mem_usage=True,
+        )
+    model.config.use_cache = False
+    if args.gradient_checkpointing:
+        model.gradient_checkpointing_enable()
+        model.enable_input_require_grads()
+
+    torch.manual_seed(args.seed)
+    lora = LoraConfig(
+        r=args.lora_r,
+        lora_alpha=args.lora_alpha,
+        lora_dropout=args.lora_dropout,
+        target_modules=args.target_modules,
+        bias="none",
+        task_type="CAUSAL_LM",
+    )
+    model = get_peft_model(model, lora)
+    model.print_trainable_parameters()
+
+    train(model, data, args, device, tokenizer.pad_token_id)
+    model.save_pretrained(args.output)
+    print(f"Saved the adapter to {args.output}. Serve it with: python alpaca-web.py --adapter commands={args.output}" + (" --stub-model" if args.stub_model else ""))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Resident memory of serving several LoRA adapters from one alpaca-web.py process, against
+running one process per adapter.
+
+Loads the base model with every adapter in one process, then the base model with a single
+adapter in a fresh process per adapter, the way one alpaca-web.py per adapter would. Each
+process generates a few tokens with every adapter it has before it is measured, so the
+weights it uses are paged in. Adapters are given as paths, or created with random weights
+with --random.
+
+    python benchmarks/adapter_memory.py --random 4
+    python benchmarks/adapter_memory.py --base-model /models/llama --adapters /models/lora-a /models/lora-b
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from alpaca_merge import BASE_MODEL, LORA_WEIGHTS
+
+
+def rss_mb():
+    # Current resident set size, from /proc on Linux
+    with open('/proc/self/statm', 'r') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024**2
+
+
+def make_random_adapters(base_model, count, directory):
+    # Same shape as the Alpaca LoRA: rank 16 on the query and value projections
+    import torch
+    from peft import LoraConfig, get_peft_model
+    from transformers import LlamaForCausalLM
+
+    paths = []
+    for index in range(count):
+        torch.manual_seed(index)
+        model = LlamaForCausalLM.from_pretrained(base_model, low_cpu_mem_usage=True)
+        model = get_peft_model(model, LoraConfig(r=16, lora_alpha=16, target_modules=["q_proj", "v_proj"], init_lora_weights=False))
+        path = os.path.join(directory, f"adapter-{index}")
+        model.save_pretrained(path)
+        paths.append(path)
+    return paths
+
+
+def measure(base_model, adapter_paths):
+    # Runs in its own process: loads the base model with the adapters and prints its resident memory
+    import torch
+    from peft import PeftModel
+    from transformers import AutoTokenizer, LlamaForCausalLM
+
+    tokenizer = AutoTokenizer.from_pretrained(base_model)
+    model = LlamaForCausalLM.from_pretrained(base_model, low_cpu_mem_usage=True)
+    model = PeftModel.from_pretrained(model, adapter_paths[0], adapter_name="adapter-0")
+    for index, path in enumerate(adapter_paths[1:], 1):
+        model.load_adapter(path, adapter_name=f"adapter-{index}")
+    model.eval()
+
+    input_ids = tokenizer("List the files in this directory", return_tensors="pt")["input_ids"]
+    for index in range(len(adapter_paths)):
+        with torch.no_grad():
+            model.generate(input_ids=input_ids, max_new_tokens=4, do_sample=False, adapter_names=[f"adapter-{index}"])
+    print(json.dumps({"rss_mb": rss_mb()}))
+
+
+def run(base_model, adapter_paths):
+    command = [sys.executable, __file__, '--measure', '--base-model', base_model, '--adapters'] + adapter_paths
+    output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])["rss_mb"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare memory of one process serving several adapters with one process per adapter')
+    parser.add_argument('--base-model', type=str, default=BASE_MODEL, help='Base model')
+    parser.add_argument('--adapters', nargs='+', default=[LORA_WEIGHTS], help='LoRA adapters to serve')
+    parser.add_argument('--random', type=int, default=0, help='Create this many adapters with random weights instead')
+    parser.add_argument('--measure', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(args.base_model, args.adapters)
+        return
+
+    adapter_paths = args.adapters
+    if args.random:
+        adapter_paths = make_random_adapters(args.base_model, args.random, tempfile.mkdtemp())
+
+    shared = run(args.base_model, adapter_paths)
+    separate = [run(args.base_model, [path]) for path in adapter_paths]
+
+    print(f"{len(adapter_paths)} adapters")
+    print(f"One process, all adapters:   {shared:8.0f} MB")
+    print(f"One process per adapter:     {sum(separate):8.0f} MB in total ({sum(separate) / len(separate):.0f} MB each)")
+    print(f"Saved:                       {sum(separate) - shared:8.0f} MB ({(1 - shared / sum(separate)) * 100:.0f}%)")
+
+
+if __name__ == '__main__':
+    main()
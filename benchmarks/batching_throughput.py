@@ -0,0 +1,67 @@
+"""
+Throughput comparison for alpaca-web.py request batching.
+
+Start the server once with batching disabled and once with it enabled, and run
+this script against each:
+
+    python alpaca-web.py --max-batch-size 1
+    python benchmarks/batching_throughput.py --requests 64 --concurrency 8
+
+    python alpaca-web.py --max-batch-size 8 --batch-window 10
+    python benchmarks/batching_throughput.py --requests 64 --concurrency 8
+
+Prompts are replayed from fine-tuning/commandpairs.jsonl.
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+PAIRS_FILE = os.path.join(os.path.dirname(__file__), '..', 'fine-tuning', 'commandpairs.jsonl')
+
+
+def load_prompts(path, count):
+    prompts = []
+    with open(path, 'r') as f:
+        for line in f:
+            prompts.append(json.loads(line)['prompt'])
+            if len(prompts) >= count:
+                break
+    return prompts
+
+
+def timed_request(url, instruction):
+    start = time.perf_counter()
+    response = requests.post(url, json={'instruction': instruction})
+    response.raise_for_status()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure alpaca-web.py throughput under concurrent load')
+    parser.add_argument('-u', '--url', type=str, default='http://127.0.0.1:5791/alpaca', help='URL of the Alpaca web service')
+    parser.add_argument('--requests', type=int, default=64, help='Total number of requests to send')
+    parser.add_argument('--concurrency', type=int, default=8, help='Number of requests in flight at once')
+    parser.add_argument('--pairs', type=str, default=PAIRS_FILE, help='JSONL file to take prompts from')
+    args = parser.parse_args()
+
+    prompts = load_prompts(args.pairs, args.requests)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        latencies = list(executor.map(lambda p: timed_request(args.url, p), prompts))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    print(f"Requests:    {len(latencies)} at concurrency {args.concurrency}")
+    print(f"Elapsed:     {elapsed:.2f}s")
+    print(f"Throughput:  {len(latencies) / elapsed:.2f} req/s")
+    print(f"Mean latency: {sum(latencies) / len(latencies):.3f}s")
+    print(f"Max latency:  {latencies[-1]:.3f}s")
+
+
+if __name__ == '__main__':
+    main()
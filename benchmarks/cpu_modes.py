@@ -0,0 +1,117 @@
+"""
+Tokens/sec and resident memory of the alpaca-web.py CPU modes (--cpu-mode).
+
+Each mode runs in its own process so memory numbers don't carry over between modes.
+The model is loaded the way alpaca-web.py loads it on CPU, then greedily generates
+--tokens tokens for each of --requests prompts from fine-tuning/commandpairs.jsonl.
+Resident memory is measured after generation, when every weight has been paged in;
+peak includes loading.
+
+    python benchmarks/cpu_modes.py --requests 5 --tokens 64
+    python benchmarks/cpu_modes.py --modes fp32 int8 --base-model /models/llama --lora-weights /models/lora
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from alpaca_cpu import CPU_MODES, load_dtype, prepare_cpu_model
+from alpaca_merge import BASE_MODEL, LORA_WEIGHTS
+from alpaca_prompt import generate_prompt
+
+PAIRS_FILE = os.path.join(os.path.dirname(__file__), '..', 'fine-tuning', 'commandpairs.jsonl')
+
+
+def rss_mb():
+    # Current resident set size, from /proc on Linux
+    with open('/proc/self/statm', 'r') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024**2
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in KB on Linux and in bytes on macOS
+    return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024
+
+
+def load_instructions(path, count):
+    instructions = []
+    with open(path, 'r') as f:
+        for line in f:
+            instructions.append(json.loads(line)['prompt'])
+            if len(instructions) >= count:
+                break
+    return instructions
+
+
+def run_mode(args):
+    import torch
+    from peft import PeftModel
+    from transformers import AutoTokenizer, LlamaForCausalLM
+
+    torch.set_num_threads(args.threads or torch.get_num_threads())
+    tokenizer = AutoTokenizer.from_pretrained(args.base_model)
+
+    start = time.perf_counter()
+    model = LlamaForCausalLM.from_pretrained(args.base_model, device_map={"": "cpu"}, low_cpu_mem_usage=True, torch_dtype=getattr(torch, load_dtype(args.mode)))
+    if args.lora_weights:
+        model = PeftModel.from_pretrained(model, args.lora_weights, device_map={"": "cpu"})
+    model = prepare_cpu_model(model, args.mode)
+    model.eval()
+    load_time = time.perf_counter() - start
+
+    generated = 0
+    generate_time = 0
+    for instruction in load_instructions(args.pairs, args.requests):
+        inputs = tokenizer(generate_prompt(instruction), return_tensors="pt")
+        start = time.perf_counter()
+        with torch.no_grad():
+            output = model.generate(**inputs, max_new_tokens=args.tokens, min_new_tokens=args.tokens, do_sample=False)
+        generate_time += time.perf_counter() - start
+        generated += output.shape[1] - inputs["input_ids"].shape[1]
+
+    print(json.dumps({
+        "mode": args.mode,
+        "load": load_time,
+        "tokens_per_sec": generated / generate_time,
+        "rss_mb": rss_mb(),
+        "peak_rss_mb": peak_rss_mb(),
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare alpaca-web.py CPU modes')
+    parser.add_argument('--base-model', type=str, default=BASE_MODEL, help='Base model')
+    parser.add_argument('--lora-weights', type=str, default=LORA_WEIGHTS, help='LoRA adapter. Empty to benchmark the base model alone.')
+    parser.add_argument('--modes', nargs='+', choices=CPU_MODES, default=CPU_MODES, help='Modes to compare')
+    parser.add_argument('--requests', type=int, default=5, help='Number of prompts to generate for')
+    parser.add_argument('--tokens', type=int, default=64, help='Tokens to generate per prompt')
+    parser.add_argument('--threads', type=int, default=0, help='Torch threads. 0 keeps the default.')
+    parser.add_argument('--pairs', type=str, default=PAIRS_FILE, help='JSONL file to take prompts from')
+    parser.add_argument('--mode', choices=CPU_MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        run_mode(args)
+        return
+
+    results = []
+    for mode in args.modes:
+        command = [sys.executable, __file__, '--mode', mode, '--base-model', args.base_model, '--lora-weights', args.lora_weights,
+                   '--requests', str(args.requests), '--tokens', str(args.tokens), '--threads', str(args.threads), '--pairs', args.pairs]
+        output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    baseline = results[0]
+    print(f"{args.requests} prompts, {args.tokens} tokens each")
+    for result in results:
+        print(f"{result['mode']:>5}: {result['tokens_per_sec']:7.2f} tokens/sec ({result['tokens_per_sec'] / baseline['tokens_per_sec']:.2f}x), "
+              f"RSS {result['rss_mb']:7.0f} MB, peak {result['peak_rss_mb']:7.0f} MB, load {result['load']:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
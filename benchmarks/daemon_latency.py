@@ -0,0 +1,65 @@
+"""
+Cold vs. warm shsh call latency.
+
+Runs shsh_client.py end to end as shsh.sh does, answering the menu with option 1, first
+with everything done in-process (--no-daemon) and then through a shsh_daemon.py started
+for the benchmark.
+Uses whatever API OPENAI_API_BASE points at; --backend local needs no network.
+
+    python benchmarks/daemon_latency.py --runs 10
+    python benchmarks/daemon_latency.py --runs 10 --backend local
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SHSH = os.path.join(ROOT, 'shsh_client.py')
+
+
+def time_call(prompt, backend, extra_args):
+    with tempfile.NamedTemporaryFile() as selection:
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, SHSH, '--tempfile', selection.name, '--prompt', prompt, '--backend', backend, '--no-cache'] + extra_args,
+            input='1\n', capture_output=True, text=True, check=True,
+        )
+        return time.perf_counter() - start
+
+
+def report(label, latencies):
+    latencies = sorted(latencies)
+    print(f"{label}: median {latencies[len(latencies) // 2] * 1000:.0f} ms, mean {sum(latencies) / len(latencies) * 1000:.0f} ms, max {latencies[-1] * 1000:.0f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare shsh call latency with and without the daemon')
+    parser.add_argument('--runs', type=int, default=10, help='Calls per mode')
+    parser.add_argument('--backend', choices=['openai', 'local'], default='openai', help='shsh.py backend to call')
+    parser.add_argument('--prompt', type=str, default='Show me disk space usage', help='Prompt to send')
+    args = parser.parse_args()
+
+    cold = [time_call(args.prompt, args.backend, ['--no-daemon']) for _ in range(args.runs)]
+
+    socket_path = os.path.join(tempfile.mkdtemp(), 'shsh.sock')
+    daemon = subprocess.Popen([sys.executable, os.path.join(ROOT, 'shsh_daemon.py'), '--socket', socket_path], stdout=subprocess.DEVNULL)
+    try:
+        while not os.path.exists(socket_path):
+            if daemon.poll() is not None:
+                sys.exit("shsh daemon failed to start")
+            time.sleep(0.05)
+        warm = [time_call(args.prompt, args.backend, ['--socket', socket_path]) for _ in range(args.runs)]
+    finally:
+        daemon.terminate()
+        daemon.wait()
+
+    print(f"{args.runs} calls each, {args.backend} backend")
+    report("cold (in-process)", cold)
+    report("warm (daemon)    ", warm)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Scaling of fine-tuning/dedupe_pairs.py to millions of pairs.
+
+Builds synthetic commandpairs.jsonl files of each size given by copying the real pairs
+with some of their words and arguments swapped for random ones, so every size has both
+near duplicates and distinct pairs, then runs dedupe_pairs.py on each one in a fresh
+process and reports wall time, peak memory and the fraction of pairs kept.
+
+    python benchmarks/dedupe_pairs.py --pairs 100000 1000000 3000000
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+FINE_TUNING = os.path.join(os.path.dirname(__file__), '..', 'fine-tuning')
+SCRIPT = os.path.join(FINE_TUNING, 'dedupe_pairs.py')
+
+
+def perturb(rng, text, rate):
+    # Swap some words for random ones, as a different package name or path would
+    return " ".join(f"w{rng.randrange(10**6)}" if rng.random() < rate else word for word in text.split())
+
+
+def write_pairs(path, source, count, rate, seed=0):
+    rng = random.Random(seed)
+    with open(path, 'w') as f:
+        for _ in range(count):
+            pair = rng.choice(source)
+            f.write(json.dumps({"completion": " " + perturb(rng, pair["completion"], rate), "prompt": perturb(rng, pair["prompt"], rate)}) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure how dedupe_pairs.py scales with the number of pairs')
+    parser.add_argument('--pairs', type=int, nargs='+', default=[100000, 1000000], help='Dataset sizes to try')
+    parser.add_argument('--rate', type=float, default=0.3, help='Fraction of words replaced in each copied pair')
+    args = parser.parse_args()
+
+    with open(os.path.join(FINE_TUNING, 'commandpairs.jsonl'), 'r') as f:
+        source = [json.loads(line) for line in f if line.strip()]
+
+    print(f"{'pairs':>10} {'time':>8} {'pairs/s':>9} {'peak RSS':>10} {'kept':>7}")
+    for count in args.pairs:
+        folder = tempfile.mkdtemp()
+        try:
+            input_path = os.path.join(folder, 'commandpairs.jsonl')
+            write_pairs(input_path, source, count, args.rate)
+            command = [sys.executable, os.path.abspath(SCRIPT), '--input', input_path,
+                       '--output', os.path.join(folder, 'deduped.jsonl'), '--prepared', os.path.join(folder, 'prepared.jsonl')]
+            start = time.perf_counter()
+            process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+            _, status, usage = os.wait4(process.pid, 0)
+            elapsed = time.perf_counter() - start
+            if status != 0:
+                raise RuntimeError(f"{' '.join(command)} failed with status {status}")
+            with open(os.path.join(folder, 'deduped.jsonl'), 'r') as f:
+                kept = sum(1 for _ in f)
+            # ru_maxrss is in KB on Linux
+            print(f"{count:>10} {elapsed:>7.1f}s {count / elapsed:>9.0f} {usage.ru_maxrss / 1024:>8.0f}MB {kept / count:>7.1%}")
+        finally:
+            shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Prompt tokens and latency of retrieved vs. static few-shot examples in shsh.py.
+
+Replays descriptions from fine-tuning/commandpairs.jsonl. Each description's own pair
+is left out of its retrieved examples so it can't simply be copied. Token counts are
+computed locally. With --live, both variants are also sent to the API to compare
+latency and how often the answer uses the same program as the reference command.
+
+    python benchmarks/fewshot_tokens.py --requests 200
+    OPENAI_API_KEY=... python benchmarks/fewshot_tokens.py --requests 20 --live
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import shsh
+import shsh_menu
+from shsh_history import ConversationHistory
+from shsh_retrieval import PAIRS_FILE, detect_os, shared_index
+
+SAMPLE_CONTEXT = "Shell:/bin/bash\nLSB:Distributor ID:\tUbuntu\nDescription:\tUbuntu 22.04.2 LTS\nRelease:\t22.04\nCodename:\tjammy\nHostname:host\nUsername:user\n"
+
+
+def load_replay(path, count):
+    # Spread the replay set over the whole file rather than taking the first lines
+    with open(path, 'r') as f:
+        pairs = [json.loads(line) for line in f]
+    step = max(len(pairs) // count, 1)
+    return [(doc, pairs[doc]) for doc in range(0, len(pairs), step)][:count]
+
+
+def answer(messages):
+    start = time.perf_counter()
+    response = shsh.generate_response(messages)
+    return response, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare retrieved and static few-shot examples')
+    parser.add_argument('--requests', type=int, default=200, help='Number of descriptions to replay')
+    parser.add_argument('--example-count', type=int, default=4, help='Maximum number of retrieved examples')
+    parser.add_argument('--example-budget', type=int, default=200, help='Maximum tokens of retrieved examples')
+    parser.add_argument('--live', action='store_true', help='Also send both variants to the API')
+    args = parser.parse_args()
+
+    index = shared_index()
+    os_family = detect_os(SAMPLE_CONTEXT)
+    totals = {'static': [], 'retrieved': []}
+    latencies = {'static': [], 'retrieved': []}
+    matches = {'static': 0, 'retrieved': 0}
+    selection_times = []
+
+    for doc, pair in load_replay(PAIRS_FILE, args.requests):
+        start = time.perf_counter()
+        retrieved = index.examples(pair['prompt'], k=args.example_count, budget=args.example_budget, os_family=os_family, exclude={doc})
+        selection_times.append(time.perf_counter() - start)
+
+        variants = {'static': shsh.examples, 'retrieved': retrieved or shsh.examples}
+        for name, examples_block in variants.items():
+            messages, tokens = shsh.build_messages(examples_block, SAMPLE_CONTEXT, ConversationHistory(), pair['prompt'])
+            totals[name].append(tokens)
+
+            if args.live:
+                response, latency = answer(messages)
+                latencies[name].append(latency)
+                program = pair['completion'].split()[0]
+                matches[name] += any(line.split() and line.split()[0] == program for line in shsh_menu.breakup_response(response))
+
+    count = len(totals['static'])
+    print(f"Requests: {count}")
+    print(f"Example selection: {sum(selection_times) / count * 1000:.2f} ms per request")
+    for name in ('static', 'retrieved'):
+        line = f"{name:>9}: {sum(totals[name]) / count:.1f} prompt tokens per request"
+        if args.live:
+            line += f", {sum(latencies[name]) / count:.2f}s latency, {matches[name] / count * 100:.0f}% same program as reference"
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Generated tokens per request with and without the alpaca-web.py command grammar.
+
+Replays prompts from fine-tuning/commandpairs.jsonl with the settings /alpaca uses
+(4 beams, up to 128 new tokens), once unconstrained and once with the grammar from
+alpaca_grammar.py. Reports tokens generated, latency and how many responses break the
+grammar (numbered lists, code fences, blank lines, more than --max-commands lines).
+
+    python benchmarks/grammar_tokens.py --model decapoda-research/llama-7b-hf --lora-weights tloen/alpaca-lora-7b --requests 20
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import torch
+from transformers import AutoTokenizer, GenerationConfig, LlamaForCausalLM, LogitsProcessorList
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from alpaca_grammar import IN_BACKTICKS, RESPONSE_START, CommandGrammar, scan
+from alpaca_prompt import generate_prompt
+
+PAIRS_FILE = os.path.join(os.path.dirname(__file__), '..', 'fine-tuning', 'commandpairs.jsonl')
+
+
+def load_instructions(path, count):
+    instructions = []
+    with open(path, 'r') as f:
+        for line in f:
+            instructions.append(json.loads(line)['prompt'])
+            if len(instructions) >= count:
+                break
+    return instructions
+
+
+def follows_grammar(response, max_commands):
+    valid, newlines, state, content = scan(response.rstrip(), RESPONSE_START)
+    return valid and content and newlines < max_commands and state != IN_BACKTICKS
+
+
+def run(model, tokenizer, prompts, grammar, args):
+    generation_config = GenerationConfig(temperature=0.1, top_p=0.75, top_k=40, num_beams=args.num_beams, max_new_tokens=args.max_new_tokens)
+    tokens = []
+    latencies = []
+    broken = 0
+    for input_ids in prompts:
+        logits_processor = LogitsProcessorList([grammar.processor(input_ids.shape[1])]) if grammar else None
+        start = time.perf_counter()
+        with torch.no_grad():
+            output = model.generate(input_ids=input_ids, generation_config=generation_config, logits_processor=logits_processor)
+        latencies.append(time.perf_counter() - start)
+        tokens.append(output.shape[1] - input_ids.shape[1])
+        response = tokenizer.decode(output[0, input_ids.shape[1]:], skip_special_tokens=True)
+        broken += not follows_grammar(response, args.max_commands)
+    return tokens, latencies, broken
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare generated tokens with and without the command grammar')
+    parser.add_argument('--model', type=str, default='decapoda-research/llama-7b-hf', help='Base model')
+    parser.add_argument('--lora-weights', type=str, default='tloen/alpaca-lora-7b', help='LoRA adapter. Empty to use the base model alone.')
+    parser.add_argument('--requests', type=int, default=20, help='Number of prompts to replay')
+    parser.add_argument('--max-commands', type=int, default=5, help='Most command lines the grammar allows')
+    parser.add_argument('--num-beams', type=int, default=4, help='Beams per request')
+    parser.add_argument('--max-new-tokens', type=int, default=128, help='Tokens to generate per prompt at most')
+    parser.add_argument('--pairs', type=str, default=PAIRS_FILE, help='JSONL file to take prompts from')
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    model = LlamaForCausalLM.from_pretrained(args.model, low_cpu_mem_usage=True)
+    if args.lora_weights:
+        from peft import PeftModel
+        model = PeftModel.from_pretrained(model, args.lora_weights)
+    model.eval()
+
+    start = time.perf_counter()
+    grammar = CommandGrammar(tokenizer, args.max_commands)
+    print(f"Grammar tables built in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    prompts = [tokenizer(generate_prompt(instruction), return_tensors="pt")["input_ids"] for instruction in load_instructions(args.pairs, args.requests)]
+    for name, constraint in (('unconstrained', None), ('grammar', grammar)):
+        tokens, latencies, broken = run(model, tokenizer, prompts, constraint, args)
+        print(f"{name:>13}: {sum(tokens) / len(tokens):6.1f} tokens per request (max {max(tokens)}), "
+              f"{sum(latencies) / len(latencies) * 1000:7.1f} ms per request, {broken}/{len(prompts)} responses break the grammar")
+
+
+if __name__ == '__main__':
+    main()
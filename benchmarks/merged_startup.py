@@ -0,0 +1,81 @@
+"""
+Model load time of alpaca-web.py with the LoRA applied at startup vs. a merged model
+built by alpaca_merge.py.
+
+Each load runs in a fresh process, the way the server starts, and is repeated --runs
+times. The one-time cost of building the merged model is reported as well. Pass
+--output to keep the merged model somewhere other than a temporary directory.
+
+    python benchmarks/merged_startup.py --runs 3
+    python benchmarks/merged_startup.py --base-model /models/llama --lora-weights /models/lora --dtype float32
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from alpaca_merge import BASE_MODEL, LORA_WEIGHTS, merge
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Each snippet loads the model the same way alpaca-web.py does on CPU and prints the seconds taken
+LORA_LOAD = """
+import sys, time
+start = time.perf_counter()
+import torch
+from peft import PeftModel
+from transformers import LlamaForCausalLM
+dtype = getattr(torch, sys.argv[3])
+model = LlamaForCausalLM.from_pretrained(sys.argv[1], device_map={"": "cpu"}, low_cpu_mem_usage=True, torch_dtype=dtype)
+model = PeftModel.from_pretrained(model, sys.argv[2], device_map={"": "cpu"}, torch_dtype=dtype)
+print(time.perf_counter() - start)
+"""
+
+MERGED_LOAD = """
+import sys, time
+start = time.perf_counter()
+sys.path.insert(0, sys.argv[3])
+from alpaca_merge import load_merged
+model = load_merged(sys.argv[1], sys.argv[2], device_map={"": "cpu"})
+print(time.perf_counter() - start)
+"""
+
+
+def time_load(code, *argv):
+    result = subprocess.run([sys.executable, '-c', code] + list(argv), capture_output=True, text=True, check=True)
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def report(label, seconds):
+    seconds = sorted(seconds)
+    print(f"{label}: median {seconds[len(seconds) // 2]:.2f}s, min {seconds[0]:.2f}s, max {seconds[-1]:.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare alpaca-web.py model load time with and without a merged model')
+    parser.add_argument('--base-model', type=str, default=BASE_MODEL, help='Base model')
+    parser.add_argument('--lora-weights', type=str, default=LORA_WEIGHTS, help='LoRA adapter')
+    parser.add_argument('--dtype', choices=['float16', 'bfloat16', 'float32'], default='float32', help='dtype to load in')
+    parser.add_argument('--output', type=str, default=None, help='Where to build the merged model. Defaults to a temporary directory.')
+    parser.add_argument('--runs', type=int, default=3, help='Loads per variant')
+    args = parser.parse_args()
+
+    output = args.output or os.path.join(tempfile.mkdtemp(), 'merged')
+    start = time.perf_counter()
+    merge(args.base_model, args.lora_weights, output, args.dtype)
+    merge_time = time.perf_counter() - start
+
+    lora = [time_load(LORA_LOAD, args.base_model, args.lora_weights, args.dtype) for _ in range(args.runs)]
+    merged = [time_load(MERGED_LOAD, output, args.dtype, ROOT) for _ in range(args.runs)]
+
+    print(f"{args.runs} loads each, {args.dtype}, including imports")
+    report("base + LoRA", lora)
+    report("merged     ", merged)
+    print(f"One-time merge: {merge_time:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
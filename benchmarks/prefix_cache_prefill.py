@@ -0,0 +1,85 @@
+"""
+Prefill time saved per request by the alpaca-web.py prefix cache, on CPU.
+
+Each prompt from fine-tuning/commandpairs.jsonl is prefilled twice: once in full,
+the way every request was handled before, and once from a copy of the cached
+preamble so only the instruction and input go through the model.
+
+    python benchmarks/prefix_cache_prefill.py --model decapoda-research/llama-7b-hf --requests 20
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from alpaca_prefix_cache import PrefixCache
+from alpaca_prompt import PREAMBLE, PREAMBLE_WITH_INPUT, generate_prompt
+
+PAIRS_FILE = os.path.join(os.path.dirname(__file__), '..', 'fine-tuning', 'commandpairs.jsonl')
+SAMPLE_INPUT = "Shell:/bin/bash\nLSB:Distributor ID: Ubuntu\nDescription: Ubuntu 22.04.2 LTS\nRelease: 22.04\nCodename: jammy"
+
+
+def load_instructions(path, count):
+    instructions = []
+    with open(path, 'r') as f:
+        for line in f:
+            instructions.append(json.loads(line)['prompt'])
+            if len(instructions) >= count:
+                break
+    return instructions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure prefill time saved by the prompt prefix cache')
+    parser.add_argument('--model', type=str, default='decapoda-research/llama-7b-hf', help='Model to prefill with')
+    parser.add_argument('--requests', type=int, default=20, help='Number of prompts to measure')
+    parser.add_argument('--pairs', type=str, default=PAIRS_FILE, help='JSONL file to take prompts from')
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    model = AutoModelForCausalLM.from_pretrained(args.model, low_cpu_mem_usage=True)
+    model.eval()
+
+    cache = PrefixCache(model, tokenizer, "cpu")
+    cache.add(PREAMBLE, pinned=True)
+    cache.add(PREAMBLE_WITH_INPUT, pinned=True)
+
+    full_times = []
+    cached_times = []
+    skipped_tokens = []
+    for index, instruction in enumerate(load_instructions(args.pairs, args.requests)):
+        # Alternate between the two prompt templates
+        prompt = generate_prompt(instruction, SAMPLE_INPUT if index % 2 else None)
+        input_ids = tokenizer(prompt, return_tensors="pt")["input_ids"]
+
+        with torch.no_grad():
+            start = time.perf_counter()
+            model(input_ids=input_ids, use_cache=True)
+            full_times.append(time.perf_counter() - start)
+
+            # The lookup is timed too, it includes copying the cached tensors
+            start = time.perf_counter()
+            past_key_values = cache.lookup(input_ids[0])
+            cached_length = past_key_values.get_seq_length()
+            model(input_ids=input_ids[:, cached_length:], past_key_values=past_key_values, use_cache=True)
+            cached_times.append(time.perf_counter() - start)
+
+        skipped_tokens.append(cached_length)
+
+    full = sum(full_times) / len(full_times) * 1000
+    cached = sum(cached_times) / len(cached_times) * 1000
+    print(f"Requests:               {len(full_times)}")
+    print(f"Cached prefix tokens:   {sum(skipped_tokens) / len(skipped_tokens):.1f} per request")
+    print(f"Full prefill:           {full:.1f} ms per request")
+    print(f"Prefill from cache:     {cached:.1f} ms per request")
+    print(f"Saved:                  {full - cached:.1f} ms per request ({(1 - cached / full) * 100:.0f}%)")
+    print(f"Cache size:             {cache.nbytes / 1024**2:.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
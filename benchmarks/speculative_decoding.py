@@ -0,0 +1,105 @@
+"""
+Acceptance rate and latency of speculative decoding (alpaca-web.py --draft-model) on CPU.
+
+Replays prompts from fine-tuning/commandpairs.jsonl through the main model with greedy
+decoding, first on its own and then assisted by the draft model at each --lookahead.
+Forward passes of both models are counted: every main model pass checks one round of
+draft tokens, so the accepted tokens are those generated beyond one per main model pass,
+and the acceptance rate is accepted over proposed tokens. Greedy speculative decoding
+gives the same output as the main model alone, which is checked too.
+
+    python benchmarks/speculative_decoding.py --requests 20
+    python benchmarks/speculative_decoding.py --model /models/llama-7b --draft-model /models/llama-68m --lookahead 3 5 8
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import torch
+from transformers import AutoTokenizer, GenerationConfig, LlamaForCausalLM
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from alpaca_prompt import generate_prompt
+
+PAIRS_FILE = os.path.join(os.path.dirname(__file__), '..', 'fine-tuning', 'commandpairs.jsonl')
+
+
+def load_instructions(path, count):
+    instructions = []
+    with open(path, 'r') as f:
+        for line in f:
+            instructions.append(json.loads(line)['prompt'])
+            if len(instructions) >= count:
+                break
+    return instructions
+
+
+class ForwardCounter:
+    def __init__(self, model):
+        self.calls = 0
+        model.register_forward_pre_hook(self.count)
+
+    def count(self, module, args):
+        self.calls += 1
+
+
+def run(model, draft_model, lookahead, prompts, max_new_tokens, counters):
+    generation_config = GenerationConfig(do_sample=False, max_new_tokens=max_new_tokens)
+    if draft_model is not None:
+        # Same settings alpaca-web.py uses
+        draft_model.generation_config.num_assistant_tokens = lookahead
+        draft_model.generation_config.num_assistant_tokens_schedule = "constant"
+        draft_model.generation_config.assistant_confidence_threshold = 0
+    for counter in counters:
+        counter.calls = 0
+
+    outputs = []
+    latencies = []
+    generated = 0
+    for input_ids in prompts:
+        start = time.perf_counter()
+        with torch.no_grad():
+            output = model.generate(input_ids=input_ids, generation_config=generation_config, assistant_model=draft_model)
+        latencies.append(time.perf_counter() - start)
+        outputs.append(output[0, input_ids.shape[1]:].tolist())
+        generated += output.shape[1] - input_ids.shape[1]
+    return outputs, latencies, generated
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure speculative decoding acceptance rate and latency')
+    parser.add_argument('--model', type=str, default='JackFram/llama-160m', help='Main model')
+    parser.add_argument('--draft-model', type=str, default='JackFram/llama-68m', help='Draft model sharing the main model\'s tokenizer')
+    parser.add_argument('--lookahead', type=int, nargs='+', default=[3, 5, 8], help='Draft lengths to compare')
+    parser.add_argument('--requests', type=int, default=20, help='Number of prompts to replay')
+    parser.add_argument('--max-new-tokens', type=int, default=64, help='Tokens to generate per prompt at most')
+    parser.add_argument('--pairs', type=str, default=PAIRS_FILE, help='JSONL file to take prompts from')
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    model = LlamaForCausalLM.from_pretrained(args.model, low_cpu_mem_usage=True).eval()
+    draft_model = LlamaForCausalLM.from_pretrained(args.draft_model, low_cpu_mem_usage=True).eval()
+    model_calls = ForwardCounter(model)
+    draft_calls = ForwardCounter(draft_model)
+
+    prompts = [tokenizer(generate_prompt(instruction), return_tensors="pt")["input_ids"] for instruction in load_instructions(args.pairs, args.requests)]
+
+    reference, latencies, generated = run(model, None, 0, prompts, args.max_new_tokens, [model_calls])
+    baseline = sum(latencies) / len(latencies)
+    print(f"{len(prompts)} prompts, {generated / len(prompts):.1f} tokens generated on average")
+    print(f"{'no draft':>12}: {baseline * 1000:7.1f} ms per request, {generated / sum(latencies):6.1f} tokens/sec")
+
+    for lookahead in args.lookahead:
+        outputs, latencies, generated = run(model, draft_model, lookahead, prompts, args.max_new_tokens, [model_calls, draft_calls])
+        accepted = generated - model_calls.calls
+        latency = sum(latencies) / len(latencies)
+        identical = sum(output == expected for output, expected in zip(outputs, reference))
+        print(f"{f'lookahead {lookahead}':>12}: {latency * 1000:7.1f} ms per request ({baseline / latency:.2f}x), {generated / sum(latencies):6.1f} tokens/sec, "
+              f"acceptance {accepted / max(draft_calls.calls, 1) * 100:4.1f}%, {generated / model_calls.calls:.2f} tokens per main model pass, "
+              f"{identical}/{len(prompts)} outputs identical")
+
+
+if __name__ == '__main__':
+    main()
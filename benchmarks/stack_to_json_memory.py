@@ -0,0 +1,103 @@
+"""
+Peak memory and throughput of fine-tuning/stack_to_json.py, reading the whole dump at
+once against --stream.
+
+Builds synthetic Stack Exchange archives (a 7z holding Posts.xml) at each size given,
+with answers spread through the rest of the file after their question as in the real
+dumps, then converts each one in a fresh process per mode and reports its peak resident
+memory and how fast it got through Posts.xml.
+
+    python benchmarks/stack_to_json_memory.py --questions 20000 80000 320000
+"""
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from xml.sax.saxutils import quoteattr
+
+import py7zr
+
+SCRIPT = os.path.join(os.path.dirname(__file__), '..', 'fine-tuning', 'stack_to_json.py')
+
+WORDS = "the a file directory list show find remove copy process disk user network server permission".split()
+COMMANDS = ["ls -la /var/log", "find . -name '*.txt' -delete", "tar -xzf archive.tar.gz", "grep -r pattern .", "df -h"]
+
+
+def paragraph(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def write_posts_xml(path, questions, seed=0):
+    # Each question gets up to three answers, placed at random points after it
+    rng = random.Random(seed)
+    pending = []
+    post_id = 0
+    with open(path, 'w') as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n<posts>\n')
+        for _ in range(questions):
+            post_id += 1
+            question_id = post_id
+            answers = rng.randint(0, 3)
+            body = f"<p>{paragraph(rng, 60)}</p>"
+            f.write(f'  <row Id="{question_id}" PostTypeId="1" AcceptedAnswerId="{question_id + 1 if answers else 0}" Body={quoteattr(body)} />\n')
+            for _ in range(answers):
+                pending.append((rng.random(), question_id))
+            # Write out some of the answers waiting for a place
+            rng.shuffle(pending)
+            while pending and rng.random() < 0.7:
+                _, parent_id = pending.pop()
+                post_id += 1
+                body = f"<p>{paragraph(rng, 30)}</p><pre><code>{rng.choice(COMMANDS)}</code></pre>"
+                f.write(f'  <row Id="{post_id}" PostTypeId="2" ParentId="{parent_id}" Score="{rng.randint(-2, 50)}" Body={quoteattr(body)} />\n')
+        for _, parent_id in pending:
+            post_id += 1
+            body = f"<p>{paragraph(rng, 30)}</p><pre><code>{rng.choice(COMMANDS)}</code></pre>"
+            f.write(f'  <row Id="{post_id}" PostTypeId="2" ParentId="{parent_id}" Score="0" Body={quoteattr(body)} />\n')
+        f.write('</posts>\n')
+    return post_id
+
+
+def run(folder, stream):
+    # Converts the archive in folder in a fresh process, returning its peak RSS in MB and the time it took
+    command = [sys.executable, os.path.abspath(SCRIPT), folder, '--force'] + (['--stream'] if stream else [])
+    start = time.perf_counter()
+    # commands.json is written to the current directory
+    process = subprocess.Popen(command, cwd=folder, stdout=subprocess.DEVNULL)
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    if status != 0:
+        raise RuntimeError(f"{' '.join(command)} failed with status {status}")
+    # ru_maxrss is in KB on Linux
+    return usage.ru_maxrss / 1024, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare memory use of stack_to_json.py with and without --stream')
+    parser.add_argument('--questions', type=int, nargs='+', default=[20000, 80000], help='Dump sizes to try, in questions')
+    parser.add_argument('--modes', nargs='+', choices=['whole', 'stream'], default=['whole', 'stream'], help='Modes to run')
+    args = parser.parse_args()
+
+    print(f"{'questions':>10} {'Posts.xml':>10} {'mode':>7} {'peak RSS':>10} {'time':>8} {'MB/s':>7} {'posts/s':>9}")
+    for questions in args.questions:
+        folder = tempfile.mkdtemp()
+        try:
+            xml_path = os.path.join(folder, 'Posts.xml')
+            posts = write_posts_xml(xml_path, questions)
+            xml_mb = os.path.getsize(xml_path) / 1024**2
+            with py7zr.SevenZipFile(os.path.join(folder, 'synthetic.stackexchange.com.7z'), 'w') as archive:
+                archive.write(xml_path, 'Posts.xml')
+            os.remove(xml_path)
+
+            for mode in args.modes:
+                peak, elapsed = run(folder, mode == 'stream')
+                print(f"{questions:>10} {xml_mb:>8.0f}MB {mode:>7} {peak:>8.0f}MB {elapsed:>7.1f}s {xml_mb / elapsed:>7.1f} {posts / elapsed:>9.0f}")
+        finally:
+            shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    main()
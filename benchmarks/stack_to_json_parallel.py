@@ -0,0 +1,72 @@
+"""
+Scaling of fine-tuning/stack_to_json.py --jobs over many archives.
+
+Builds a folder of synthetic Stack Exchange archives of mixed sizes (see
+stack_to_json_memory.py), then converts the whole folder with each --jobs value and
+reports wall time and the speedup over a single process. The commands.json of every run
+is checked against the single-process one.
+
+    python benchmarks/stack_to_json_parallel.py --archives 16 --questions 20000 --jobs 1 2 4 8
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import py7zr
+
+sys.path.insert(0, os.path.dirname(__file__))
+from stack_to_json_memory import SCRIPT, write_posts_xml
+
+
+def make_archives(folder, count, questions):
+    # Sizes vary from a quarter to the full number of questions, like the real sites
+    for index in range(count):
+        xml_path = os.path.join(folder, 'Posts.xml')
+        write_posts_xml(xml_path, max(1, questions * (1 + index % 4) // 4), seed=index)
+        with py7zr.SevenZipFile(os.path.join(folder, f'site{index}.stackexchange.com.7z'), 'w') as archive:
+            archive.write(xml_path, 'Posts.xml')
+        os.remove(xml_path)
+
+
+def run(folder, jobs, stream):
+    command = [sys.executable, os.path.abspath(SCRIPT), folder, '--force', '--jobs', str(jobs)] + (['--stream'] if stream else [])
+    start = time.perf_counter()
+    subprocess.run(command, cwd=folder, stdout=subprocess.DEVNULL, check=True)
+    elapsed = time.perf_counter() - start
+    with open(os.path.join(folder, 'commands.json'), 'r') as f:
+        return elapsed, sorted(json.load(f))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure how stack_to_json.py --jobs scales with processes')
+    parser.add_argument('--archives', type=int, default=16, help='Number of archives to convert')
+    parser.add_argument('--questions', type=int, default=20000, help='Questions in the largest archive')
+    parser.add_argument('--jobs', type=int, nargs='+', default=[1, 2, 4, os.cpu_count() or 1], help='--jobs values to try')
+    parser.add_argument('--whole', action='store_true', help='Convert without --stream')
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    try:
+        make_archives(folder, args.archives, args.questions)
+        size = sum(os.path.getsize(os.path.join(folder, name)) for name in os.listdir(folder)) / 1024**2
+        print(f"{args.archives} archives, {size:.0f} MB compressed, {os.cpu_count()} cores")
+
+        baseline = None
+        expected = None
+        for jobs in sorted(set(args.jobs)):
+            elapsed, commands = run(folder, jobs, not args.whole)
+            if baseline is None:
+                baseline, expected = elapsed, commands
+            same = "same commands" if commands == expected else "DIFFERENT commands"
+            print(f"--jobs {jobs:>3}: {elapsed:7.1f}s, {baseline / elapsed:5.2f}x, {same}")
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    main()
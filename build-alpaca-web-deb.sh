@@ -11,7 +11,12 @@ cd "${PACKAGE_NAME}-${PACKAGE_VERSION}"
 
 # Copy the Flask application (e.g., app.py) and any other necessary files
 # into the package directory. Adjust the source paths as needed.
+# Only the modules the server imports, not the training script or the stub model
+SERVER_MODULES="alpaca_adapters.py alpaca_batching.py alpaca_cpu.py alpaca_grammar.py alpaca_logging.py alpaca_merge.py alpaca_metrics.py alpaca_prefix_cache.py alpaca_prompt.py alpaca_serve.py"
 cp ../${PACKAGE_NAME}.py .
+for module in ${SERVER_MODULES}; do
+  cp ../${module} .
+done
 
 # Copy the requirements.txt file into the package directory
 cp ../requirements.txt .
@@ -29,6 +34,10 @@ Description=Alpaca Web Service
 After=network.target
 
 [Service]
+# alpaca-web.py reports ready once the model is loaded and warmed up, which can take a while
+Type=notify
+NotifyAccess=main
+TimeoutStartSec=30min
 User=${SERVICE_USER}
 Group=nogroup
 CapabilityBoundingSet=CAP_DAC_OVERRIDE
@@ -44,7 +53,8 @@ EOF
 # Create the install file to specify the installation paths
 # Include the requirements.txt file in the installation paths
 cat <<EOF > "${PACKAGE_NAME}.install"
-app.py /usr/lib/${PACKAGE_NAME}/
+${PACKAGE_NAME}.py /usr/lib/${PACKAGE_NAME}/
+$(for module in ${SERVER_MODULES}; do echo "${module} /usr/lib/${PACKAGE_NAME}/"; done)
 requirements.txt /usr/lib/${PACKAGE_NAME}/
 debian/${PACKAGE_NAME}.service /lib/systemd/system/
 EOF
@@ -0,0 +1,273 @@
+"""
+Removes near-duplicate pairs from commandpairs.jsonl and writes the fine-tuning file.
+
+Pairs are compared on the words of the description and a template of the command
+together. The template keeps the program, its subcommand and flags and masks the other
+arguments, along with the words of the description they appear in, so "sudo apt-get
+install foo" described as "install the foo package" and the same for bar are treated as
+the same pair. Candidate near duplicates are found
+with MinHash and locality-sensitive hashing, which only compares pairs that share a band
+of their signature, so the cost grows linearly with the number of pairs rather than with
+its square. Each candidate is then checked on the exact Jaccard similarity of its
+features. Pairs are taken in order, and each is dropped if it is a near duplicate of a
+pair already kept.
+
+The kept pairs are written to --output, and in the same pass to --prepared in the format
+fine-tuning expects: the prompt ends in "\\n\\n###\\n\\n" and the completion starts with a
+space and ends in a newline.
+
+    python dedupe_pairs.py --threshold 0.6 --clusters clusters.jsonl
+"""
+import argparse
+import json
+import itertools
+import re
+import time
+import zlib
+
+import numpy as np
+
+SEPARATOR = "\n\n###\n\n"
+
+
+# Programs whose first argument picks what they do, so it is part of the template ("apt-get install", "git push")
+SUBCOMMAND_PROGRAMS = frozenset("""
+apt apt-get apt-cache aptitude dpkg yum dnf zypper pacman snap flatpak brew port pip pip3 pipx conda npm yarn pnpm gem
+cargo go git svn hg docker docker-compose podman kubectl helm systemctl service launchctl journalctl ufw firewall-cmd
+nmcli ip diskutil openssl tmux virsh vagrant terraform aws gcloud az heroku composer dotnet mvn gradle rustup nvm
+""".split())
+# Prefixes that run the next word as the program
+WRAPPERS = frozenset(["sudo", "env", "time", "nohup", "nice", "exec", "xargs"])
+SEPARATORS = frozenset(["|", "||", "&&", ";", "&"])
+
+
+def command_template(completion):
+    """
+    Tokens of the command with its arguments masked, and the words of those arguments.
+    Programs, their subcommands and flags are kept, so "sudo apt-get install foo" and
+    "sudo apt-get install bar" have the same template.
+    """
+    tokens = []
+    arguments = set()
+    expect = "program"
+    for token in completion.split():
+        if token in SEPARATORS:
+            expect = "program"
+        elif token.startswith("-"):
+            pass
+        elif expect == "program":
+            if token not in WRAPPERS and "=" not in token:
+                expect = "subcommand" if token in SUBCOMMAND_PROGRAMS else "argument"
+        elif expect == "subcommand":
+            expect = "argument"
+        else:
+            arguments.update(re.findall(r"[a-z0-9']+", token.lower()))
+            token = "<arg>"
+        tokens.append(re.sub(r"\d+", "0", token))
+    return tokens, arguments
+
+
+def features(prompt, completion):
+    """
+    Description words and command template tokens, kept apart so a word in one doesn't
+    match a token in the other. Words of the description that are arguments of the command
+    are masked like the arguments, so "install the foo package" with
+    "sudo apt-get install foo" has the same features as the bar version.
+    """
+    tokens, arguments = command_template(completion)
+    words = ["<arg>" if word in arguments else word for word in re.findall(r"[a-z0-9']+", prompt.lower())]
+    found = {"p:" + word for word in words}
+    found.update("c:" + token for token in tokens)
+    # Command bigrams keep some of the argument order
+    found.update(f"c:{first} {second}" for first, second in zip(tokens, tokens[1:]))
+    return found or {"empty"}
+
+
+def read_pairs(path):
+    # (prompt, completion) of each usable pair in path. Nothing to learn from a pair with an empty side.
+    with open(path, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            pair = json.loads(line)
+            prompt, completion = pair["prompt"].strip(), pair["completion"]
+            if prompt and completion.strip():
+                yield prompt, completion
+
+
+def minhash_signatures(pairs, num_perm=64, seed=0, chunk=100000):
+    """
+    MinHash signature of the features of each pair: for each of num_perm hash functions,
+    the smallest hash of any of its features. Two pairs agree in a position with
+    probability equal to the Jaccard similarity of their features. Pairs are read a chunk
+    at a time and only the signatures are kept, 4 bytes per position, along with the CRC-32
+    of each feature so candidates can be checked exactly. Returns (signatures, hashes,
+    offsets): the feature hashes of pair i are hashes[offsets[i]:offsets[i + 1]].
+    """
+    rng = np.random.default_rng(seed)
+    # Multiply-add-shift hashing: the top 32 bits of (a * x + b) mod 2**64, with a odd.
+    # Cheaper in numpy than a modulo prime and as good for MinHash.
+    a = rng.integers(0, 2**63, size=num_perm, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+    b = rng.integers(0, 2**63, size=num_perm, dtype=np.uint64)
+    shift = np.uint64(32)
+    blocks = []
+    feature_hashes = []
+    feature_counts = []
+    pairs = iter(pairs)
+    while True:
+        sets = [features(prompt, completion) for prompt, completion in itertools.islice(pairs, chunk)]
+        if not sets:
+            break
+        hashes = np.fromiter((zlib.crc32(feature.encode("utf-8")) for found in sets for feature in found), dtype=np.uint64)
+        lengths = np.fromiter((len(found) for found in sets), dtype=np.int64, count=len(sets))
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        permuted = np.empty_like(hashes)
+        block = np.empty((len(sets), num_perm), dtype=np.uint32)
+        for index in range(num_perm):
+            np.multiply(hashes, a[index], out=permuted)
+            permuted += b[index]
+            permuted >>= shift
+            block[:, index] = np.minimum.reduceat(permuted, offsets)
+        blocks.append(block)
+        feature_hashes.append(hashes.astype(np.uint32))
+        feature_counts.append(lengths)
+    if not blocks:
+        return np.empty((0, num_perm), dtype=np.uint32), np.empty(0, dtype=np.uint32), np.zeros(1, dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(np.concatenate(feature_counts))))
+    return np.concatenate(blocks), np.concatenate(feature_hashes), offsets
+
+
+def feature_keys(hashes, offsets, indexes):
+    # The feature hashes of each of indexes, tagged with its position in indexes in the top 32 bits, without repeats
+    starts = offsets[indexes]
+    lengths = offsets[indexes + 1] - starts
+    within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    owners = np.repeat(np.arange(len(indexes), dtype=np.uint64), lengths)
+    keys = np.sort((owners << np.uint64(32)) | hashes[np.repeat(starts, lengths) + within])
+    return keys[np.concatenate(([True], keys[1:] != keys[:-1]))]
+
+
+def jaccard(hashes, offsets, firsts, seconds):
+    # Exact Jaccard similarity of the features of each pair of firsts and seconds
+    keys = np.sort(np.concatenate((feature_keys(hashes, offsets, firsts), feature_keys(hashes, offsets, seconds))))
+    # Neither side repeats a key, so a key seen twice is a feature the pair shares
+    shared = keys[1:][keys[1:] == keys[:-1]]
+    sizes = np.bincount((keys >> np.uint64(32)).astype(np.int64), minlength=len(firsts))
+    intersections = np.bincount((shared >> np.uint64(32)).astype(np.int64), minlength=len(firsts))
+    return intersections / (sizes - intersections)
+
+
+def similar_pairs(signatures, hashes, offsets, bands, threshold):
+    """
+    Pairs of indexes whose features have a Jaccard similarity of at least threshold.
+    Candidates are the pairs whose signatures agree on every row of at least one band.
+    Each band's buckets are linked as a star around their first member, and candidates
+    whose signatures agree on too few positions to reach threshold are dropped right away,
+    so at most one pair per row per band is ever held. The rest are checked exactly, since
+    the estimate from the signatures is often off by 0.1 or more.
+    """
+    rows = signatures.shape[1] // bands
+    count = len(signatures)
+    # Two standard errors of the estimate at its widest, so few pairs that really are similar enough are dropped
+    margin = 1 / np.sqrt(signatures.shape[1])
+    found = []
+    for band in range(bands):
+        block = np.ascontiguousarray(signatures[:, band * rows:(band + 1) * rows])
+        keys = block.view(np.dtype((np.void, block.dtype.itemsize * rows))).ravel()
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        starts = np.concatenate(([True], sorted_keys[1:] != sorted_keys[:-1]))
+        bucket_first = order[np.maximum.accumulate(np.where(starts, np.arange(count), 0))]
+        firsts, seconds = bucket_first[~starts], order[~starts]
+        # Sharing a band only makes a candidate; drop the ones the signatures say can't be similar enough
+        likely = np.empty(len(firsts), dtype=bool)
+        for start in range(0, len(firsts), 100000):
+            end = start + 100000
+            likely[start:end] = (signatures[firsts[start:end]] == signatures[seconds[start:end]]).mean(axis=1) >= threshold - margin
+        found.append(np.unique(firsts[likely].astype(np.int64) * count + seconds[likely]))
+    if not found:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    found = np.unique(np.concatenate(found))
+    firsts, seconds = found // count, found % count
+    similar = np.empty(len(found), dtype=bool)
+    for start in range(0, len(found), 100000):
+        end = start + 100000
+        similar[start:end] = jaccard(hashes, offsets, firsts[start:end], seconds[start:end]) >= threshold
+    return firsts[similar], seconds[similar]
+
+
+def representatives(count, firsts, seconds):
+    """
+    Index of the pair kept for each pair, given similar pairs (first, second) with
+    first < second. Pairs are taken in order and each is dropped in favour of the earliest
+    kept pair it is similar to, so a dropped pair is always close to the one kept for it
+    rather than chained to it through others.
+    """
+    labels = np.arange(count)
+    kept = [True] * count
+    order = np.lexsort((firsts, seconds))
+    for first, second in zip(firsts[order].tolist(), seconds[order].tolist()):
+        if kept[second] and kept[first]:
+            labels[second] = first
+            kept[second] = False
+    return labels
+
+
+def cluster(pairs, threshold=0.6, num_perm=64, bands=16):
+    """
+    Clusters (prompt, completion) pairs whose Jaccard similarity is at least threshold.
+    Returns the cluster label of each pair: the index of the pair kept for it.
+    """
+    signatures, hashes, offsets = minhash_signatures(pairs, num_perm)
+    firsts, seconds = similar_pairs(signatures, hashes, offsets, bands, threshold)
+    return representatives(len(signatures), firsts, seconds)
+
+
+def prepared(prompt, completion):
+    # Same layout as OpenAI's data preparation tool produced for commandpairs_prepared.jsonl
+    if not completion.startswith(" "):
+        completion = " " + completion
+    return {"prompt": prompt + SEPARATOR, "completion": completion + "\n"}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Remove near-duplicate command pairs and write the fine-tuning file')
+    parser.add_argument('--input', type=str, default='commandpairs.jsonl', help='Pairs written by make_questions.py')
+    parser.add_argument('--output', type=str, default='commandpairs_deduped.jsonl', help='Where to write the pairs kept')
+    parser.add_argument('--prepared', type=str, default='commandpairs_prepared.jsonl', help='Where to write the pairs kept in the fine-tuning format')
+    parser.add_argument('--threshold', type=float, default=0.6, help='Jaccard similarity at which two pairs count as near duplicates')
+    parser.add_argument('--num-perm', type=int, default=64, help='MinHash signature length')
+    parser.add_argument('--bands', type=int, default=16, help='LSH bands. More bands find pairs further below the threshold, at more cost.')
+    parser.add_argument('--clusters', type=str, default=None, help='Also write every cluster of more than one pair to this JSONL file, for review')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    labels = cluster(read_pairs(args.input), args.threshold, args.num_perm, args.bands)
+    clustered = time.perf_counter()
+
+    # Second pass over the input rather than holding millions of pairs in memory
+    sizes = np.bincount(labels, minlength=len(labels))
+    members = {}
+    kept = 0
+    with open(args.output, 'w') as output, open(args.prepared, 'w') as prepared_file:
+        for index, (prompt, completion) in enumerate(read_pairs(args.input)):
+            label = int(labels[index])
+            if args.clusters and sizes[label] > 1:
+                members.setdefault(label, []).append((prompt, completion))
+            if label != index:
+                continue
+            output.write(json.dumps({"completion": completion, "prompt": prompt}) + "\n")
+            prepared_file.write(json.dumps(prepared(prompt, completion)) + "\n")
+            kept += 1
+
+    if args.clusters:
+        with open(args.clusters, 'w') as f:
+            for pairs in members.values():
+                f.write(json.dumps({"kept": pairs[0], "removed": pairs[1:]}) + "\n")
+
+    print(f"Kept {kept} of {len(labels)} pairs ({len(labels) - kept} near duplicates removed).")
+    print(f"Clustering {clustered - start:.1f}s, writing {time.perf_counter() - clustered:.1f}s.")
+
+
+if __name__ == '__main__':
+    main()
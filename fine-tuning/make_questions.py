@@ -1,48 +1,224 @@
 import openai
+import argparse
 import json
 import jsonlines
 import os
 import html
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pipeline_state import DEFAULT_STATE_FILE, PipelineState
 
 # Set up OpenAI GPT-3 API Key (replace with your own API key)
 API_KEY = os.environ.get("OPENAI_API_KEY")
 openai.api_key = API_KEY
 
+INSTRUCTIONS = "Without mentioning the name of the command (or sometimes even suggesting an approach), describe what the command does as an imperative. For example, if the command is 'ls', you could say 'list the contents of a directory'. Add some variability to your writing style. Flip a coin to decide to use proper capitalization. Flip a coin to decide to use proper punctuation. If the command is unclear, you aren't at least 99% certain it is a valid terminal command, or a clear description can't be made, or might be something other than a terminal command, or might be a command for something else (like SQL or other), just say '##DONTKNOW##'. Don't guess. Again, be ABSOLUTELY SURE you know what the command is and what it does. Otherwise say '##DONTKNOW##'."
+
+# Tokens each description may take
+MAX_TOKENS = 100
+
 def generate_description(command):
     response = openai.Completion.create(
         engine="text-davinci-003",
-        prompt=f"Without mentioning the name of the command (or sometimes even suggesting an approach), describe what the command does as an imperative. For example, if the command is 'ls', you could say 'list the contents of a directory'. Add some variability to your writing style. Flip a coin to decide to use proper capitalization. Flip a coin to decide to use proper punctuation. If the command is unclear, you aren't at least 99% certain it is a valid terminal command, or a clear description can't be made, or might be something other than a terminal command, or might be a command for something else (like SQL or other), just say '##DONTKNOW##'. Don't guess. Again, be ABSOLUTELY SURE you know what the command is and what it does. Otherwise say '##DONTKNOW##'.\n\nCommand: {command}\n\nDescription:",
-        max_tokens=100
+        prompt=f"{INSTRUCTIONS}\n\nCommand: {command}\n\nDescription:",
+        max_tokens=MAX_TOKENS
     )
     description = response.choices[0].text.strip()
     return description
 
-def generate_descriptions(commands):
-    with jsonlines.open("commandpairs.jsonl", mode='w') as writer:
+def generate_packed_descriptions(commands):
+    # Several commands in one request, one numbered description per command. None if the answer doesn't line up with the commands.
+    numbered = "\n".join(f"{index}. {command}" for index, command in enumerate(commands, 1))
+    response = openai.Completion.create(
+        engine="text-davinci-003",
+        prompt=f"{INSTRUCTIONS}\n\nDo this for each of the numbered commands below, separately. Answer with one line per command, numbered the same way.\n\nCommands:\n{numbered}\n\nDescriptions:\n",
+        max_tokens=MAX_TOKENS * len(commands)
+    )
+    descriptions = {}
+    for line in response.choices[0].text.strip().splitlines():
+        match = re.match(r"\s*(\d+)[.)]\s*(.*)", line)
+        if match:
+            descriptions[int(match.group(1))] = match.group(2).strip()
+    if sorted(descriptions) != list(range(1, len(commands) + 1)):
+        return None
+    return [descriptions[index] for index in range(1, len(commands) + 1)]
+
+class TokenBucket:
+    """
+    Allows `rate` units a second on average, in bursts of up to `capacity`. Shared by all
+    the threads making requests; acquire() blocks until the units are available.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        # More than the capacity would never fit, so it waits for a full bucket and takes the rest on credit.
+        # The bucket goes below zero and later requests wait until that is paid back, which keeps to the rate.
+        needed = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= needed:
+                    self.tokens -= amount
+                    return
+                wait = (needed - self.tokens) / self.rate
+            time.sleep(wait)
+
+# Errors worth trying again: rate limits, timeouts and server-side failures
+RETRYABLE = (openai.error.RateLimitError, openai.error.APIError, openai.error.Timeout, openai.error.APIConnectionError, openai.error.ServiceUnavailableError, openai.error.TryAgain)
+
+class Cancelled(Exception):
+    # The run is stopping, so no more requests are made
+    pass
+
+def with_retries(function, *args, max_retries=5, base_delay=1.0, stop=None):
+    for attempt in range(max_retries + 1):
+        try:
+            return function(*args)
+        except RETRYABLE as e:
+            if attempt == max_retries:
+                raise
+            # Exponential backoff, with jitter so the threads don't all come back at once
+            delay = base_delay * 2 ** attempt * random.uniform(0.5, 1.5)
+            print(f"{type(e).__name__}: {e}. Retrying in {delay:.1f}s.")
+            if stop is None:
+                time.sleep(delay)
+            elif stop.wait(delay):
+                raise Cancelled()
+
+def describe(commands, request_bucket=None, token_bucket=None, max_retries=5, stop=None):
+    # Descriptions for a pack of commands: one request for all of them, falling back to one request each if the answer can't be matched up.
+    # Once stop is set, no further request is made, retries and fallbacks included.
+    def limited(function, argument, count):
+        if stop is not None and stop.is_set():
+            raise Cancelled()
+        if request_bucket is not None:
+            request_bucket.acquire()
+        if token_bucket is not None:
+            # Rough count: about four characters a token for the prompt, plus the most the answer may use
+            described = argument if isinstance(argument, list) else [argument]
+            token_bucket.acquire((len(INSTRUCTIONS) + sum(len(command) for command in described)) // 4 + MAX_TOKENS * count)
+        # The buckets may have kept it waiting
+        if stop is not None and stop.is_set():
+            raise Cancelled()
+        return function(argument)
+
+    if len(commands) > 1:
+        descriptions = with_retries(limited, generate_packed_descriptions, commands, len(commands), max_retries=max_retries, stop=stop)
+        if descriptions is not None:
+            return descriptions
+    return [with_retries(limited, generate_description, command, 1, max_retries=max_retries, stop=stop) for command in commands]
+
+def read_pairs(path):
+    # (command, description) pairs already written, including by runs before the state was kept
+    if not os.path.exists(path):
+        return []
+    with jsonlines.open(path, mode='r') as reader:
+        return [(pair["completion"], pair["prompt"]) for pair in reader.iter(skip_invalid=True)]
+
+def generate_descriptions(commands, output="commandpairs.jsonl", state=None, concurrency=1, pack=1, request_bucket=None, token_bucket=None, max_retries=5):
+    """
+    Appends to output, so an interrupted run keeps what it has done, and skips commands the
+    API was already asked about. Up to `concurrency` requests are in flight at once, each
+    for `pack` commands, within the rate limits of the buckets. Pairs are written in the
+    order of commands whatever order the answers arrive in.
+    """
+    if state is not None:
+        # The output is the log of what has been described: anything in it counts as done, even if the run stopped before recording it
+        recovered = state.record_described(read_pairs(output))
+        if recovered:
+            print(f"Recorded {recovered} commands found in {output} as described.")
+
+    skipped = 0
+    pending = []
+    for command in commands:
+        command = html.unescape(command)
+        if command.startswith("-") or command[0].isdigit():
+            continue
+        if command[0] == "." and command[1] != "/":
+            continue
+        if state is not None and state.command_status(command) is not None:
+            skipped += 1
+            continue
+        pending.append(command)
+    packs = [pending[index:index + pack] for index in range(0, len(pending), pack)]
+
+    # Set when the run stops early, so packs already running don't carry on making requests
+    stop = threading.Event()
+    with jsonlines.open(output, mode='a') as writer, ThreadPoolExecutor(max_workers=concurrency) as executor:
         file_obj = writer._fp
+        futures = [executor.submit(describe, commands, request_bucket, token_bucket, max_retries, stop) for commands in packs]
+
+        # Waiting on the futures in submission order keeps the output in order
+        for commands, future in zip(packs, futures):
+            try:
+                descriptions = future.result()
+            except BaseException:
+                # Everything before this pack is written and recorded; a rerun carries on from here
+                stop.set()
+                for remaining in futures:
+                    remaining.cancel()
+                raise
+
+            for command, description in zip(commands, descriptions):
+                if '##DONTKNOW##' in description:
+                    if state is not None:
+                        state.record_command(command, 'unknown')
+                    continue
+
+                print(f"Command: {command}")
+                print(f"Description: {description}\n")
 
-        for command in commands:
-            command = html.unescape(command)
-            if command.startswith("-") or command[0].isdigit():
-                continue
-            if command[0] == "." and command[1] != "/":
-                continue
-            description = generate_description(command)
+                writer.write({
+                    "completion": command,
+                    "prompt": description
+                })
+                file_obj.flush()
+                # Recorded once the pair is on disk, so a crash in between is caught by reading the output back
+                if state is not None:
+                    state.record_command(command, 'described', description)
 
-            if '##DONTKNOW##' in description:
-                continue
+    if skipped:
+        print(f"Skipped {skipped} commands described in earlier runs.")
 
-            print(f"Command: {command}")
-            print(f"Description: {description}\n")
+def main():
+    parser = argparse.ArgumentParser(description='Ask the API for a description of each command, to use as fine-tuning prompts')
+    parser.add_argument('--commands', type=str, default='commands.json', help='Commands found by stack_to_json.py')
+    parser.add_argument('--output', type=str, default='commandpairs.jsonl', help='JSONL file the command and description pairs are appended to')
+    parser.add_argument('--state', type=str, default=DEFAULT_STATE_FILE, help='Database recording the commands already described, which are skipped')
+    parser.add_argument('--concurrency', type=int, default=1, help='Requests in flight at once')
+    parser.add_argument('--pack', type=int, default=1, help='Commands described per request. Answers that don\'t match up are asked for again one command at a time.')
+    parser.add_argument('--requests-per-minute', type=float, default=0, help='Most requests started per minute, 0 for no limit')
+    parser.add_argument('--tokens-per-minute', type=float, default=0, help='Most prompt and completion tokens per minute, estimated, 0 for no limit')
+    parser.add_argument('--max-retries', type=int, default=5, help='Times to retry a request after a rate limit, timeout or server error')
+    parser.add_argument('--api-base', type=str, default=None, help='Completion API to use instead of OpenAI\'s, such as stub_completions.py')
+    args = parser.parse_args()
 
-            writer.write({
-                "completion": command,
-                "prompt": description
-            })
-            file_obj.flush()
+    if args.api_base:
+        openai.api_base = args.api_base
+    # Per-second buckets holding at most a second's worth, so requests are spread out rather than sent in bursts
+    request_bucket = TokenBucket(args.requests_per_minute / 60) if args.requests_per_minute else None
+    token_bucket = TokenBucket(args.tokens_per_minute / 60) if args.tokens_per_minute else None
 
+    with open(args.commands, 'r') as f:
+        data = json.load(f)
 
+    state = PipelineState(args.state)
+    try:
+        generate_descriptions(data, args.output, state, args.concurrency, args.pack, request_bucket, token_bucket, args.max_retries)
+    finally:
+        state.close()
 
-with open("commands.json", 'r') as f:
-    data = json.load(f)
-    generate_descriptions(data)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+What the fine-tuning pipeline has already done, so reruns only do new work.
+
+stack_to_json.py records every archive it has converted, with its size and modification
+time and the commands found in it. An unchanged archive whose output is still there is
+skipped, and commands.json is rebuilt from what every archive found. make_questions.py
+records every command it has asked the API about, by hash, so a rerun after a crash or a
+budget cutoff picks up where the last one stopped and only pays for new commands.
+
+The state is a SQLite database, pipeline-state.db in the current directory by default.
+"""
+import hashlib
+import os
+import sqlite3
+import time
+
+DEFAULT_STATE_FILE = "pipeline-state.db"
+
+
+def command_hash(command: str) -> str:
+    return hashlib.sha256(command.encode("utf-8")).hexdigest()
+
+
+class PipelineState:
+    def __init__(self, path: str = DEFAULT_STATE_FILE):
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS archives (
+                name TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime_ns INTEGER,
+                output TEXT,
+                done_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS archive_commands (
+                archive TEXT,
+                hash TEXT,
+                command TEXT,
+                PRIMARY KEY (archive, hash)
+            );
+            CREATE TABLE IF NOT EXISTS commands (
+                hash TEXT PRIMARY KEY,
+                command TEXT,
+                status TEXT,
+                description TEXT,
+                done_at REAL
+            );
+        """)
+
+    def close(self):
+        self.conn.close()
+
+    def archive_done(self, path: str, output: str) -> bool:
+        # Whether path was converted to output before, hasn't changed since and output is still there.
+        # Archives without a Posts.xml have no output.
+        stat = os.stat(path)
+        row = self.conn.execute("SELECT size, mtime_ns, output FROM archives WHERE name = ?", (os.path.basename(path),)).fetchone()
+        if row is None or row[:2] != (stat.st_size, stat.st_mtime_ns):
+            return False
+        return row[2] is None or (row[2] == os.path.basename(output) and os.path.exists(output))
+
+    def record_archive(self, path: str, output: str, commands) -> None:
+        name = os.path.basename(path)
+        stat = os.stat(path)
+        with self.conn:
+            self.conn.execute("DELETE FROM archive_commands WHERE archive = ?", (name,))
+            self.conn.executemany("INSERT OR IGNORE INTO archive_commands VALUES (?, ?, ?)", [(name, command_hash(command), command) for command in commands])
+            self.conn.execute("INSERT OR REPLACE INTO archives VALUES (?, ?, ?, ?, ?)", (name, stat.st_size, stat.st_mtime_ns, output and os.path.basename(output), time.time()))
+
+    def all_commands(self) -> list:
+        # Commands found in every archive converted so far, deduplicated
+        return [command for command, in self.conn.execute("SELECT command FROM archive_commands GROUP BY hash")]
+
+    def command_status(self, command: str):
+        # 'described' or 'unknown' once the API has been asked about the command, None before
+        row = self.conn.execute("SELECT status FROM commands WHERE hash = ?", (command_hash(command),)).fetchone()
+        return row[0] if row else None
+
+    def record_command(self, command: str, status: str, description: str = None) -> None:
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO commands VALUES (?, ?, ?, ?, ?)", (command_hash(command), command, status, description, time.time()))
+
+    def record_described(self, pairs) -> int:
+        # Marks (command, description) pairs already in the output as described, for output written without the state
+        with self.conn:
+            cursor = self.conn.executemany(
+                "INSERT OR IGNORE INTO commands VALUES (?, ?, 'described', ?, ?)",
+                [(command_hash(command), command, description, time.time()) for command, description in pairs],
+            )
+        return cursor.rowcount
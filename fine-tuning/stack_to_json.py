@@ -8,7 +8,15 @@ from io import StringIO
 import json
 from typing import List, Dict
 import shutil
+import sqlite3
+import subprocess
 import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import groupby
+
+from pipeline_state import DEFAULT_STATE_FILE, PipelineState
 
 # Global list to store all valid terminal commands encountered
 commands_list = []
@@ -163,49 +171,275 @@ def convert_xml_to_json(xml_data: str) -> str:
 
     return json_str
 
+def output_path(file: str, folder: str, stream: bool) -> str:
+    return os.path.join(folder, os.path.splitext(os.path.basename(file))[0] + ('.jsonl' if stream else '.json'))
+
+def convert_7z_file(file: str, folder: str):
+    # Create a temporary directory
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # Open the 7z archive
+        with py7zr.SevenZipFile(file, mode='r') as archive:
+            # Get the list of files in the archive
+            file_list = archive.getnames()
+            # Find the Posts.xml file in the archive
+            posts_xml_file = next((f for f in file_list if f.endswith('Posts.xml')), None)
+            if posts_xml_file:
+                # Extract the Posts.xml file to the temporary directory
+                archive.extractall(path=temp_dir)
+                # Determine the output JSON file name
+                output_json_file = os.path.splitext(os.path.basename(file))[0] + '.json'
+                # Get the full path of the extracted Posts.xml file
+                extracted_posts_xml_file = os.path.join(temp_dir, posts_xml_file)
+                # Read XML data from the extracted Posts.xml file
+                with open(extracted_posts_xml_file, 'r') as xml_file:
+                    xml_data = xml_file.read()
+                # Convert XML data to JSON
+                json_str = convert_xml_to_json(xml_data)
+                # Write JSON string to output file
+                with open(os.path.join(folder, output_json_file), 'w') as json_file:
+                    json_file.write(json_str)
+                # Remove the extracted Posts.xml file
+                os.remove(extracted_posts_xml_file)
+                # Output message
+                print(f"XML data from '{file}' has been successfully converted to JSON and saved in '{output_json_file}'.")
+                return os.path.join(folder, output_json_file)
+    return None
+
 def process_7z_files(folder: str) -> None:
     # Walk through the directory to find all 7z files
     for file in glob.glob(os.path.join(folder, '*.7z')):
-        # Create a temporary directory
-        with tempfile.TemporaryDirectory() as temp_dir:
-            # Open the 7z archive
-            with py7zr.SevenZipFile(file, mode='r') as archive:
-                # Get the list of files in the archive
-                file_list = archive.getnames()
-                # Find the Posts.xml file in the archive
-                posts_xml_file = next((f for f in file_list if f.endswith('Posts.xml')), None)
-                if posts_xml_file:
-                    # Extract the Posts.xml file to the temporary directory
-                    archive.extractall(path=temp_dir)
-                    # Determine the output JSON file name
-                    output_json_file = os.path.splitext(os.path.basename(file))[0] + '.json'
-                    # Get the full path of the extracted Posts.xml file
-                    extracted_posts_xml_file = os.path.join(temp_dir, posts_xml_file)
-                    # Read XML data from the extracted Posts.xml file
-                    with open(extracted_posts_xml_file, 'r') as xml_file:
-                        xml_data = xml_file.read()
-                    # Convert XML data to JSON
-                    json_str = convert_xml_to_json(xml_data)
-                    # Write JSON string to output file
-                    with open(os.path.join(folder, output_json_file), 'w') as json_file:
-                        json_file.write(json_str)
-                    # Remove the extracted Posts.xml file
-                    os.remove(extracted_posts_xml_file)
-                    # Output message
-                    print(f"XML data from '{file}' has been successfully converted to JSON and saved in '{output_json_file}'.")
+        convert_7z_file(file, folder)
+
+def find_posts_xml(archive_path: str):
+    # Name of the Posts.xml member, read from the archive header without decompressing anything
+    with py7zr.SevenZipFile(archive_path, mode='r') as archive:
+        return next((f for f in archive.getnames() if f.endswith('Posts.xml')), None)
+
+class PipeWriter(py7zr.io.Py7zIO):
+    # Hands what py7zr decompresses to the write end of a pipe instead of keeping it
+    def __init__(self, fd):
+        self.file = os.fdopen(fd, 'wb')
+        self.length = 0
+
+    def write(self, s):
+        self.file.write(s)
+        self.length += len(s)
+        return len(s)
+
+    def read(self, size=None):
+        return b''
+
+    def seek(self, offset, whence=0):
+        return self.length
+
+    def flush(self):
+        self.file.flush()
+
+    def size(self):
+        return self.length
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+class PipeWriterFactory(py7zr.io.WriterFactory):
+    # Sends the target member to the pipe and discards the rest of its solid block
+    def __init__(self, target, fd):
+        self.target = target
+        self.writer = PipeWriter(fd)
+
+    def create(self, filename):
+        return self.writer if filename == self.target else py7zr.io.NullIO()
+
+def open_member_stream(archive_path: str, member: str):
+    """
+    Opens a member of a 7z archive for reading as it is decompressed, without extracting
+    it to disk or holding it in memory. Uses the 7z command if it is installed, which is
+    much faster, and py7zr in a background thread otherwise. Returns the stream and a
+    function to call once done reading it.
+    """
+    seven_zip = shutil.which('7z') or shutil.which('7za')
+    if seven_zip:
+        process = subprocess.Popen([seven_zip, 'e', '-so', archive_path, member], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+        def finish():
+            process.stdout.close()
+            process.wait()
+
+        return process.stdout, finish
+
+    read_fd, write_fd = os.pipe()
+    factory = PipeWriterFactory(member, write_fd)
+
+    def extract():
+        try:
+            with py7zr.SevenZipFile(archive_path, mode='r') as archive:
+                archive.extract(targets=[member], factory=factory)
+        except (BrokenPipeError, OSError):
+            # The reader stopped early and closed its end
+            pass
+        finally:
+            factory.writer.close()
+
+    thread = threading.Thread(target=extract, daemon=True)
+    thread.start()
+    stream = os.fdopen(read_fd, 'rb')
+
+    def finish():
+        stream.close()
+        thread.join()
+
+    return stream, finish
+
+def iter_posts(xml_stream):
+    # Yields the attributes of each row as it is parsed, dropping it straight after
+    context = ET.iterparse(xml_stream, events=("start", "end"))
+    _, root = next(context)
+    for event, elem in context:
+        if event == "end" and elem.tag == "row":
+            yield elem.attrib
+            # Clearing the row isn't enough, the root would still hold on to every one of them
+            root.clear()
+
+def group_posts(posts, db_path: str, batch_size: int = 10000):
+    """
+    Groups answers under their questions through a SQLite database on disk, so memory use
+    doesn't depend on the size of the dump. Answers come anywhere after their question in
+    Posts.xml, so a group is only complete once every post has been read. Yields question
+    objects in the same form as convert_xml_to_objects(), one at a time.
+    """
+    conn = sqlite3.connect(db_path)
+    # Scratch data: no need to survive a crash
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("CREATE TABLE questions (id INTEGER PRIMARY KEY, body TEXT, accepted_answer_id INTEGER)")
+    conn.execute("CREATE TABLE answers (id INTEGER PRIMARY KEY, parent_id INTEGER, body TEXT, score INTEGER)")
+
+    questions = []
+    answers = []
+
+    def flush():
+        conn.executemany("INSERT OR REPLACE INTO questions VALUES (?, ?, ?)", questions)
+        conn.executemany("INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?)", answers)
+        questions.clear()
+        answers.clear()
+
+    for attributes in posts:
+        post_type_id = int(attributes.get('PostTypeId', 0))
+        if post_type_id == 1:  # Question
+            questions.append((int(attributes.get('Id', 0)), attributes.get('Body', ''), int(attributes.get('AcceptedAnswerId', 0))))
+        elif post_type_id == 2:  # Answer
+            answers.append((int(attributes.get('Id', 0)), int(attributes.get('ParentId', 0)), attributes.get('Body', ''), int(attributes.get('Score', 0))))
+        if len(questions) + len(answers) >= batch_size:
+            flush()
+    flush()
+    conn.commit()
+    conn.execute("CREATE INDEX answers_by_parent ON answers (parent_id, id)")
+
+    # One pass over questions and their answers in order; answers without a question are dropped
+    rows = conn.execute(
+        "SELECT q.id, q.body, q.accepted_answer_id, a.id, a.body, a.score "
+        "FROM questions q LEFT JOIN answers a ON a.parent_id = q.id ORDER BY q.id, a.id"
+    )
+    for _, group in groupby(rows, key=lambda row: row[0]):
+        group = list(group)
+        _, body, accepted_answer_id, _, _, _ = group[0]
+        yield {
+            'question': body,
+            'answers': [
+                {'answer': answer_body, 'score': score, 'accepted': answer_id == accepted_answer_id}
+                for _, _, _, answer_id, answer_body, score in group if answer_id is not None
+            ],
+        }
+    conn.close()
+
+def stream_7z_file(file: str, folder: str, temp_dir: str = None):
+    # Same output as convert_7z_file(), as JSON lines, in memory that stays flat however big the dump is
+    posts_xml_file = find_posts_xml(file)
+    if not posts_xml_file:
+        return None
+    output_jsonl_file = os.path.basename(output_path(file, folder, True))
+    stream, finish = open_member_stream(file, posts_xml_file)
+    count = 0
+    try:
+        with tempfile.TemporaryDirectory(dir=temp_dir) as db_dir, open(os.path.join(folder, output_jsonl_file), 'w') as jsonl_file:
+            for question_obj in group_posts(iter_posts(stream), os.path.join(db_dir, 'posts.db')):
+                identify_terminal_commands([question_obj])
+                jsonl_file.write(json.dumps(question_obj) + '\n')
+                count += 1
+    finally:
+        finish()
+    print(f"{count} questions from '{file}' have been converted and saved in '{output_jsonl_file}'.")
+    return os.path.join(folder, output_jsonl_file)
+
+def convert_archive(file: str, folder: str, stream: bool, temp_dir: str = None):
+    # Converts one archive, in this process or a pool one. Returns the output, the commands found in it as its shard of commands_list and the time taken.
+    commands_list.clear()
+    start = time.perf_counter()
+    if stream:
+        output = stream_7z_file(file, folder, temp_dir)
+    else:
+        output = convert_7z_file(file, folder)
+    return output, set(commands_list), time.perf_counter() - start
+
+def process_in_parallel(files, folder: str, jobs: int, stream: bool, temp_dir: str = None, on_done=None) -> None:
+    """
+    Converts the archives in files in a pool of `jobs` processes, printing progress as
+    each one finishes. on_done(file, output, commands) is called in this process for every
+    archive converted.
+    """
+    # Biggest first, so a large archive doesn't start last and hold everything up
+    files = sorted(files, key=os.path.getsize, reverse=True)
+    total_bytes = sum(os.path.getsize(file) for file in files)
+    done_bytes = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(convert_archive, file, folder, stream, temp_dir): file for file in files}
+        for done, future in enumerate(as_completed(futures), 1):
+            file = futures[future]
+            done_bytes += os.path.getsize(file)
+            try:
+                output, shard, seconds = future.result()
+            except Exception as e:
+                print(f"[{done}/{len(files)}] {os.path.basename(file)} failed: {e}")
+                continue
+            if on_done is not None:
+                on_done(file, output, shard)
+            elapsed = time.perf_counter() - start
+            rate = done_bytes / elapsed
+            remaining = (total_bytes - done_bytes) / rate if rate else 0
+            print(f"[{done}/{len(files)}] {os.path.basename(file)} took {seconds:.1f}s. "
+                  f"{done_bytes / 1024**2:.0f} of {total_bytes / 1024**2:.0f} MB in {elapsed:.0f}s, {rate / 1024**2:.1f} MB/s, about {remaining:.0f}s left.")
 
 def main():
     # Create the argument parser
     parser = argparse.ArgumentParser(description='Convert XML data in 7z files to JSON')
     parser.add_argument('folder', type=str, help='Folder containing 7z files')
+    parser.add_argument('--stream', action='store_true', help='Decompress Posts.xml as it is parsed and write JSON lines, in memory that doesn\'t grow with the dump')
+    parser.add_argument('--jobs', type=int, default=1, help='Archives to convert at once, each in its own process. Without --stream, each one needs its Posts.xml in memory several times over.')
+    parser.add_argument('--temp-dir', type=str, default=None, help='Where --stream keeps its scratch database, about the size of the posts text (default: the system temp directory)')
+    parser.add_argument('--state', type=str, default=DEFAULT_STATE_FILE, help='Database recording the archives already converted, which are skipped unless they have changed')
+    parser.add_argument('--force', action='store_true', help='Convert every archive, even ones already converted')
     args = parser.parse_args()
 
-    # Process all 7z files in the specified folder
-    process_7z_files(args.folder)
-
-    # Write the commands_list to a JSON file
+    state = PipelineState(args.state)
+    files = glob.glob(os.path.join(args.folder, '*.7z'))
+    pending = [file for file in files if args.force or not state.archive_done(file, output_path(file, args.folder, args.stream))]
+    if len(pending) < len(files):
+        print(f"Skipping {len(files) - len(pending)} archives converted before.")
+
+    # Process the new and changed 7z files in the specified folder, recording each as soon as it is done
+    if args.jobs > 1:
+        process_in_parallel(pending, args.folder, args.jobs, args.stream, args.temp_dir, on_done=state.record_archive)
+    else:
+        for file in pending:
+            output, shard, _ = convert_archive(file, args.folder, args.stream, args.temp_dir)
+            state.record_archive(file, output, shard)
+
+    # Write the commands found in every archive, including ones skipped this time, to a JSON file
     with open('commands.json', 'w') as json_file:
-        json.dump(list(set(commands_list)), json_file, indent=4)
+        json.dump(state.all_commands(), json_file, indent=4)
+    state.close()
 
     print("All valid terminal commands have been saved to 'commands.json'.")
 
@@ -0,0 +1,89 @@
+"""
+Local stand-in for the OpenAI completions API, to try make_questions.py without an API
+key or budget.
+
+Answers every POST ending in /completions after --latency seconds with a made-up
+description per command, numbered when the prompt packs several commands. Some commands
+get ##DONTKNOW##, and --error-rate of the requests get a 429 so retries can be tested.
+
+    python stub_completions.py --port 5792 --latency 0.5 --error-rate 0.05
+    OPENAI_API_KEY=stub python make_questions.py --api-base http://127.0.0.1:5792/v1 --concurrency 8 --pack 5
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+VERBS = ["show", "print", "find", "list", "remove", "copy", "start", "check"]
+
+
+def describe(command):
+    # Stable for a given command: about one in ten is unknown
+    digest = hashlib.sha256(command.encode("utf-8")).digest()
+    if digest[0] % 10 == 0:
+        return "##DONTKNOW##"
+    return f"{VERBS[digest[1] % len(VERBS)]} something using {len(command.split())} words"
+
+
+def answer(prompt):
+    packed = re.search(r"Commands:\n(.*?)\n\nDescriptions:", prompt, re.S)
+    if packed:
+        lines = [re.match(r"(\d+)\. (.*)", line) for line in packed.group(1).splitlines()]
+        return "\n".join(f"{match.group(1)}. {describe(match.group(2))}" for match in lines if match)
+    single = re.search(r"Command: (.*)\n\nDescription:", prompt, re.S)
+    return " " + describe(single.group(1) if single else prompt)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not self.path.endswith("/completions"):
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+            return
+        time.sleep(self.server.latency)
+        if random.random() < self.server.error_rate:
+            self.send_json(429, {"error": {"message": "Rate limit reached (stub)", "type": "requests"}})
+            return
+        text = answer(request.get("prompt", ""))
+        self.send_json(200, {
+            "id": f"cmpl-stub-{time.monotonic_ns()}",
+            "object": "text_completion",
+            "created": int(time.time()),
+            "model": request.get("model", "stub"),
+            "choices": [{"text": text, "index": 0, "logprobs": None, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": len(request.get("prompt", "")) // 4, "completion_tokens": len(text) // 4, "total_tokens": (len(request.get("prompt", "")) + len(text)) // 4},
+        })
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stub completions API for testing make_questions.py')
+    parser.add_argument('--port', type=int, default=5792, help='Port to listen on')
+    parser.add_argument('--latency', type=float, default=0.5, help='Seconds to wait before answering each request')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests answered with a 429')
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), Handler)
+    server.latency = args.latency
+    server.error_rate = args.error_rate
+    print(f"Stub completions API on http://127.0.0.1:{args.port}/v1")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
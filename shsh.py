@@ -1,9 +1,17 @@
-import argparse
-import openai
 import os
+import shsh_client
+from shsh_cache import DEFAULT_CACHE_FILE, ResponseCache
+from shsh_context import collect as collect_context
+from shsh_history import ConversationHistory
+from shsh_retrieval import detect_os, shared_index
 
 API_KEY = os.environ.get("OPENAI_API_KEY")
-openai.api_key = API_KEY
+
+def load_openai():
+    # Imported on first use, so answers from the cache don't pay for loading it
+    import openai
+    openai.api_key = API_KEY
+    return openai
 
 examples = """
 prompt: What is using port 5050?
@@ -37,56 +45,8 @@ prompt: list all the existing connections using port 22
 netstat -nt | grep :22
 """
 
-def select_option(options):
-    while True:
-        # Enumerate and display the strings
-        print("0. Exit")
-        for index, string in enumerate(options, start=1):
-            print(f"{index}. {string}")
-        print(f"{len(options) + 1}. None of these work. I need to provide more context.")
-
-        user_input = input("Choice: ")
-
-        if user_input == '':
-            # Default to the first option if no input is given
-            selected_index = 1
-            break
-        else:
-            try:
-                # Convert the user input to an integer
-                selected_index = int(user_input)
-                # Ensure the user selects a valid option
-                if selected_index < 0 or selected_index > len(options) + 1:
-                    raise ValueError
-                # Exit option
-                if selected_index == 0:
-                    return 0
-                if selected_index == len(options) + 1:
-                    return -1
-                break
-            except ValueError:
-                # If the input is invalid, inform the user and prompt to try again
-                print("Invalid selection. Please try again.")
-
-    # Return the selected string
-    return options[selected_index - 1]
-
-def breakup_response(input_string):
-    # Step 1: Split the string into lines
-    lines = input_string.splitlines()
-
-    # Step 2: Filter out unwanted lines
-    filtered_lines = [line for line in lines if line.strip() and line.strip() != "```" and not line.startswith("Option")]
-
-    # Step 3: Remove "```" from the beginning and end
-    if filtered_lines and filtered_lines[0] == "```":
-        filtered_lines.pop(0)
-    if filtered_lines and filtered_lines[-1] == "```":
-        filtered_lines.pop(-1)
-
-    return filtered_lines
-
 def generate_response(messages):
+    openai = load_openai()
     response = openai.ChatCompletion.create(
         model="gpt-3.5-turbo",
         messages=messages
@@ -94,7 +54,120 @@ def generate_response(messages):
 
     return response.choices[0].message['content']
 
+def stream_response(messages, timeout=None):
+    # Yield the completion text in pieces as the API sends them
+    openai = load_openai()
+    response = openai.ChatCompletion.create(
+        model="gpt-3.5-turbo",
+        messages=messages,
+        stream=True,
+        request_timeout=timeout,
+    )
+
+    for chunk in response:
+        content = chunk.choices[0].delta.get('content')
+        if content:
+            yield content
+
+def local_response(prompts):
+    # Offline answer: the commands whose descriptions in fine-tuning/commandpairs.jsonl best match the prompts so far
+    index = shared_index()
+    return "\n".join(index.commands(" ".join(prompts)))
+
+def select_examples(prompts, context, count=4, budget=200):
+    # Few-shot examples picked for this request from the command pairs, instead of the static block
+    selected = shared_index().examples(" ".join(prompts), k=count, budget=budget, os_family=detect_os(context))
+    # Nothing in the prompt matched any pair, so keep the model on track with the usual examples
+    return selected or examples
+
+def build_messages(examples_block, context, history, user_prompt):
+    # Messages for the next request, with as much of the earlier conversation as fits the history's token budget
+    system_messages = [
+        {"role": "system", "content": f"You are ConsoleGPT, a command line terminal user assistant. You take descriptions of things to do and respond only with console commands. Examples:\n{examples_block}"},
+        {"role": "system", "content": f"System information context: {context}"},
+    ]
+    return history.messages(system_messages, user_prompt)
+
+class InProcess:
+    """
+    Answers prompts in this process. shsh_client.DaemonClient has the same ask() and
+    answered() and hands them to shsh_daemon.py, which keeps an InProcess loaded between calls.
+    """
+
+    def context(self):
+        context, identity, _ = collect_context()
+        return context, identity
+
+    def cache(self, options):
+        if options["no_cache"]:
+            return None
+        return ResponseCache(options["cache_file"] or DEFAULT_CACHE_FILE, max_entries=options["cache_size"], threshold=options["cache_threshold"])
+
+    def ask(self, prompt, history, context, options):
+        """
+        Answers one prompt of a session, whose earlier turns are the [prompt, response] pairs
+        of history. Yields where the answer comes from along with the context used, then the
+        text of the answer in chunks as it arrives.
+        """
+        # Responses are cached per system. With collected context only the probes that identify the system count,
+        # so changes to things like the journal don't throw the cache away.
+        cache_context = context
+        if context is None:
+            context, cache_context = self.context()
+        conversation = ConversationHistory(options["max_tokens"])
+        for earlier_prompt, earlier_response in history:
+            conversation.add(earlier_prompt, earlier_response)
+        prompts = conversation.prompts + [prompt]
+        used = {"context": context, "cache_context": cache_context}
+
+        # Only first prompts are cached, refinements depend on the rest of the conversation
+        cache = self.cache(options) if not history else None
+        response = cache.get(prompt, cache_context) if cache is not None else None
+        if response is not None:
+            yield dict(used, source="cache")
+            yield {"chunk": response}
+            return
+        if options["backend"] == "local":
+            yield dict(used, source="local")
+            yield {"chunk": local_response(prompts)}
+            return
+
+        if options["examples"] == "retrieved":
+            examples_block = select_examples(prompts, context, options["example_count"], options["example_budget"])
+        else:
+            examples_block = examples
+        messages, tokens = build_messages(examples_block, context, conversation, prompt)
+        yield dict(used, source="api", tokens=tokens)
+
+        chunks = stream_response(messages, options["api_timeout"])
+        started = False
+        try:
+            for chunk in chunks:
+                started = True
+                yield {"chunk": chunk}
+        except Exception as e:
+            if started:
+                raise
+            # The API is down or too slow, answer from the local index instead
+            yield {"fallback": f"API request failed ({type(e).__name__}). Using local command index."}
+            yield {"chunk": local_response(prompts)}
+        finally:
+            chunks.close()
+
+    def answered(self, prompt, cache_context, options, response, source, finished, selection):
+        # Keeps the cache in line with how the first prompt of a session went
+        cache = self.cache(options)
+        if cache is None:
+            return
+        if source == "cache" and selection == -1:
+            # None of the cached commands worked, ask the model next time
+            cache.invalidate(prompt, cache_context)
+        elif source == "api" and finished and selection not in (0, -1):
+            # Picking early stops the stream, and a cut short response would later show only its first options
+            cache.put(prompt, cache_context, response)
+
 def finetuned_response(prompt):
+    openai = load_openai()
     response = openai.Completion.create(
         engine="curie:ft-personal-2023-04-09-00-11-21",
         prompt=prompt,
@@ -111,54 +184,6 @@ def generate_using_bart(prompt):
     output = model.generate(input_tokens)
     return tokenizer.decode(output[0], skip_special_tokens=True)
 
-def main():
-    parser = argparse.ArgumentParser(description='A command line guide.')
-    parser.add_argument("--tempfile", type=str, required=True, help="Delimiter string to mark the relevant output.")
-    parser.add_argument("--context", type=str, help='System info context')
-    parser.add_argument("--prompt", type=str, help='Prompt to use for the command')
-    args = parser.parse_args()
-
-    prompts = []
-    command_responses = []
-
-    while True:
-        messages = [
-            {"role": "system", "content": f"You are ConsoleGPT, a command line terminal user assistant. You take descriptions of things to do and respond only with console commands. Examples:\n{examples}"},
-            {"role": "system", "content": f"System information context: {args.context}"},
-        ]
-
-        for index, prompt in enumerate(prompts):
-            messages.append({"role": "user", "content": prompts[index]})
-            messages.append({"role": "system", "content": command_responses[index]})
-
-        if args.prompt:
-            user_prompt = args.prompt
-        else:
-            user_prompt = input("Prompt: ")
-        messages.append({"role": "user", "content": user_prompt})
-        messages.append({"role": "system", "content": "Remember, only answer with console commands. Do not enumerate them, describe them, or provide any context. Only give commands. If there are several suggestions, put them on separate lines. Again, only the commands themselves. No context. No enumerations. Don't surround with quotes. Just the commands."})
-
-        response = generate_response(messages)
-        #response = generate_using_bart(user_prompt)
-        response = response.replace("\\n", "\n")
-
-        command_responses.append(response)
-        prompts.append(user_prompt)
-
-        commands = breakup_response(response)
-        selection = select_option(commands)
-        if selection == -1:
-            print("Please provide more context.")
-        elif selection == 0:
-            print("Exiting.")
-            exit()
-        else:
-            break
-
-    #print("Selected command: " + selection)
-    with open(args.tempfile, "w") as file:
-        file.write(selection)
-
-
 if __name__ == '__main__':
-    main()
+    # Same as shsh_client.py, which only loads this module when there is no daemon to answer
+    shsh_client.main()
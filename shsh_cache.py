@@ -0,0 +1,127 @@
+import hashlib
+import os
+import re
+import sqlite3
+import time
+
+DEFAULT_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".cache", "shsh", "responses.sqlite3")
+
+
+def normalize_prompt(prompt):
+    # Case, spacing and trailing punctuation don't change what is being asked for
+    return re.sub(r"\s+", " ", prompt.lower()).strip().rstrip(".?!")
+
+
+def context_hash(context):
+    return hashlib.sha256((context or "").encode()).hexdigest()[:16]
+
+
+# Words that can differ between two prompts without changing what they ask for
+STOPWORDS = frozenset("""
+a an the all any some this that these those my me i you your it its of in on at to for from with by into
+and or is are be please can could would how do does what which show list
+""".split())
+
+
+def content_words(prompt):
+    # Every other word, path, name and number, which must all match for a cached answer to be reused
+    return {word.strip(".,;:!?'\"") for word in prompt.split()} - STOPWORDS - {""}
+
+
+def trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def similarity(a, b):
+    # Dice coefficient of the two trigram sets
+    if not a or not b:
+        return 0.0
+    return 2 * len(a & b) / (len(a) + len(b))
+
+
+class ResponseCache:
+    """
+    On-disk cache of model responses, keyed by the normalized prompt and a hash of the
+    system context.
+
+    A prompt matches a cached one when they are identical after normalization, or when
+    their character trigram similarity is at least `threshold` and they differ only in
+    stopwords. Names, paths and numbers have to match: "remove the docker container web"
+    must not answer for the container db, nor port 5050 for port 8080. Only entries with
+    the same context are compared. The least recently used entries are dropped once there
+    are more than `max_entries`.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_FILE, max_entries=500, threshold=0.85):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                prompt TEXT NOT NULL,
+                context_hash TEXT NOT NULL,
+                response TEXT NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (prompt, context_hash)
+            )
+        """)
+        self.max_entries = max_entries
+        self.threshold = threshold
+
+    def _match(self, prompt, context):
+        # Returns the cached prompt this one matches and its response, or None
+        prompt = normalize_prompt(prompt)
+        ctx = context_hash(context)
+
+        row = self.db.execute(
+            "SELECT prompt, response FROM responses WHERE prompt = ? AND context_hash = ?", (prompt, ctx)
+        ).fetchone()
+        if row or self.threshold >= 1:
+            return row
+
+        grams = trigrams(prompt)
+        words = content_words(prompt)
+        best, best_score = None, self.threshold
+        for cached_prompt, response in self.db.execute(
+            "SELECT prompt, response FROM responses WHERE context_hash = ?", (ctx,)
+        ):
+            if content_words(cached_prompt) != words:
+                continue
+            score = similarity(grams, trigrams(cached_prompt))
+            if score >= best_score:
+                best, best_score = (cached_prompt, response), score
+        return best
+
+    def get(self, prompt, context):
+        match = self._match(prompt, context)
+        if match is None:
+            return None
+
+        with self.db:
+            self.db.execute(
+                "UPDATE responses SET last_used = ? WHERE prompt = ? AND context_hash = ?",
+                (time.time(), match[0], context_hash(context)),
+            )
+        return match[1]
+
+    def put(self, prompt, context, response):
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses (prompt, context_hash, response, last_used) VALUES (?, ?, ?, ?)",
+                (normalize_prompt(prompt), context_hash(context), response, time.time()),
+            )
+            self.db.execute(
+                "DELETE FROM responses WHERE rowid NOT IN (SELECT rowid FROM responses ORDER BY last_used DESC LIMIT ?)",
+                (self.max_entries,),
+            )
+
+    def invalidate(self, prompt, context):
+        # Forget whichever entry answered this prompt, e.g. when none of its commands worked
+        match = self._match(prompt, context)
+        if match is None:
+            return
+
+        with self.db:
+            self.db.execute(
+                "DELETE FROM responses WHERE prompt = ? AND context_hash = ?", (match[0], context_hash(context))
+            )
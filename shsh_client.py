@@ -0,0 +1,230 @@
+"""
+Thin client for shsh.sh. Runs the menu and hands each prompt to a running shsh_daemon.py,
+so a call only loads this module and shsh_menu.py. Without a daemon, or with --no-daemon,
+shsh.py is loaded and the prompts are answered in this process instead.
+
+    python shsh_client.py --tempfile /tmp/selected --prompt "Show me disk space usage"
+"""
+import argparse
+import json
+import os
+import socket
+import stat
+import sys
+import threading
+
+from shsh_menu import select_streamed_option, stream_commands
+
+
+def default_socket():
+    # In $XDG_RUNTIME_DIR, which only this user can use, or in a private directory in /tmp.
+    # None where there are no Unix sockets for the daemon to listen on.
+    if sys.platform == "win32":
+        return None
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "shsh.sock")
+    return os.path.join("/tmp", f"shsh-{os.getuid()}", "shsh.sock")
+
+
+def is_private_directory(path):
+    # Owned by this user and closed to everyone else, so nobody else can put a socket in it
+    try:
+        info = os.stat(path)
+    except OSError:
+        return False
+    return stat.S_ISDIR(info.st_mode) and info.st_uid == os.getuid() and not info.st_mode & 0o077
+
+
+def is_private_socket(path):
+    # Whether only this user can have bound path. shsh.sh runs the commands it gets back, so the daemon must be this user's.
+    try:
+        info = os.stat(path)
+    except OSError:
+        return False
+    return stat.S_ISSOCK(info.st_mode) and info.st_uid == os.getuid() and is_private_directory(os.path.dirname(os.path.abspath(path)))
+
+
+class DaemonError(Exception):
+    # The daemon can't be reached, stopped answering or failed to answer
+    pass
+
+
+class DaemonClient:
+    """
+    Talks to a running shsh_daemon.py over its Unix socket.
+
+    Has the same ask() and answered() as shsh.InProcess, so either can answer prompts. Each
+    call is one connection: the request is sent as a JSON line and the replies come back as
+    JSON lines. No reply may take longer than timeout seconds, so a hung daemon can't hang shsh.
+    """
+
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.timeout = timeout
+
+    @classmethod
+    def connect(cls, path, timeout=30):
+        # A client for the daemon if this user's daemon is answering on path, otherwise None
+        if path is None or not os.path.exists(path):
+            return None
+        if not is_private_socket(path):
+            print(f"Ignoring {path}: it or its directory isn't private to this user.", file=sys.stderr)
+            return None
+        client = cls(path, timeout)
+        try:
+            client._call({"op": "ping"}, timeout=5)
+        except DaemonError:
+            return None
+        return client
+
+    def _replies(self, request, timeout=None):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout or self.timeout)
+        try:
+            sock.connect(self.path)
+            sock.sendall(json.dumps(request).encode() + b"\n")
+            with sock.makefile("r") as replies:
+                for line in replies:
+                    reply = json.loads(line)
+                    if "error" in reply:
+                        raise DaemonError(reply["error"])
+                    if reply.get("done"):
+                        return
+                    yield reply
+        except (OSError, ValueError) as e:
+            raise DaemonError(f"{type(e).__name__}: {e}") from e
+        finally:
+            # Closing the connection early tells the daemon to stop, e.g. once a command has been picked
+            sock.close()
+
+    def _call(self, request, timeout=None):
+        for reply in self._replies(request, timeout):
+            return reply
+        raise DaemonError("No reply from shsh daemon")
+
+    def ask(self, prompt, history, context, options):
+        # The daemon may wait on the API for up to --api-timeout before the first chunk
+        return self._replies({"op": "ask", "prompt": prompt, "history": history, "context": context, "options": options}, self.timeout + options["api_timeout"])
+
+    def answered(self, prompt, cache_context, options, response, source, finished, selection):
+        try:
+            self._call({"op": "answered", "prompt": prompt, "cache_context": cache_context, "options": options, "response": response, "source": source, "finished": finished, "selection": selection})
+        except DaemonError as e:
+            # The commands have been shown already, all that is lost is the cache update
+            print(f"Couldn't update the shsh cache: {e}", file=sys.stderr)
+
+
+def in_process():
+    # Loads everything it takes to answer prompts into this process
+    import shsh
+    return shsh.InProcess()
+
+
+def show_answer(backend, prompt, history, context, options, show_tokens=False):
+    """
+    Shows the commands of the answer to prompt as they arrive and lets the user pick one.
+    Returns the selection, the first reply of the backend, the whole response and whether
+    all of it was read.
+    """
+    replies = backend.ask(prompt, history, context, options)
+    answer = next(replies, None)
+    if answer is None:
+        raise DaemonError("No reply from shsh daemon")
+    if show_tokens and "tokens" in answer:
+        print(f"Request: {answer['tokens']} tokens", file=sys.stderr)
+
+    def chunks():
+        try:
+            for reply in replies:
+                if "fallback" in reply:
+                    print(reply["fallback"])
+                    answer["source"] = "local"
+                else:
+                    yield reply["chunk"]
+        finally:
+            replies.close()
+
+    # Commands are shown as they are generated, and picking one stops the rest of the response
+    received = []
+    finished = threading.Event()
+    selection = select_streamed_option(stream_commands(chunks(), received, finished))
+    return selection, answer, "\n".join(received), finished.is_set()
+
+
+def options_of(args):
+    # The settings a backend needs to answer like shsh.py would. The daemon runs elsewhere, so paths are made absolute.
+    options = {name: getattr(args, name) for name in ("no_cache", "cache_size", "cache_threshold", "backend", "api_timeout", "examples", "example_count", "example_budget", "max_tokens")}
+    options["cache_file"] = os.path.abspath(args.cache_file) if args.cache_file else None
+    return options
+
+
+def run(backend, args):
+    options = options_of(args)
+    context = args.context
+    # Turns of the session so far, as [prompt, response]
+    history = []
+
+    while True:
+        if args.prompt:
+            user_prompt = args.prompt
+        else:
+            user_prompt = input("Prompt: ")
+
+        while True:
+            try:
+                selection, answer, response, finished = show_answer(backend, user_prompt, history, context, options, args.show_tokens)
+                break
+            except DaemonError as e:
+                # The daemon went away or stopped answering before showing anything, carry on without it
+                print(f"shsh daemon failed ({e}). Answering in this process.", file=sys.stderr)
+                backend = in_process()
+
+        # Collected once per session
+        context = answer["context"]
+        # Only first prompts are cached, refinements depend on the rest of the conversation
+        if not history:
+            backend.answered(user_prompt, answer["cache_context"], options, response, answer["source"], finished, selection)
+        history.append([user_prompt, response])
+
+        if selection == -1:
+            print("Please provide more context.")
+        elif selection == 0:
+            print("Exiting.")
+            exit()
+        else:
+            break
+
+    with open(args.tempfile, "w") as file:
+        file.write(selection)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='A command line guide.')
+    parser.add_argument("--tempfile", type=str, required=True, help="File to write the selected command to")
+    parser.add_argument("--context", type=str, help='System info context. Collected by shsh_context.py when not given.')
+    parser.add_argument("--prompt", type=str, help='Prompt to use for the command')
+    parser.add_argument("--no-cache", action="store_true", help="Always ask the model, don't use or update the response cache")
+    parser.add_argument("--cache-file", type=str, default=None, help="Response cache location. Defaults to ~/.cache/shsh/responses.sqlite3.")
+    parser.add_argument("--cache-size", type=int, default=500, help="Number of responses to keep in the cache")
+    parser.add_argument("--cache-threshold", type=float, default=0.85, help="How similar (0-1) a previous prompt must be to reuse its response. 1 only reuses exact matches.")
+    parser.add_argument("--backend", choices=["openai", "local"], default="openai", help="Where commands come from. local looks them up in fine-tuning/commandpairs.jsonl without network access.")
+    parser.add_argument("--api-timeout", type=float, default=15, help="Seconds to wait on the API before falling back to the local index")
+    parser.add_argument("--examples", choices=["retrieved", "static"], default="retrieved", help="Few-shot examples to send: the pairs most similar to the prompt, or the fixed set")
+    parser.add_argument("--example-count", type=int, default=4, help="Maximum number of retrieved examples")
+    parser.add_argument("--example-budget", type=int, default=200, help="Maximum tokens of retrieved examples")
+    parser.add_argument("--max-tokens", type=int, default=1500, help="Token budget for each request. Older refinements are summarized or dropped to stay under it.")
+    parser.add_argument("--show-tokens", action="store_true", help="Print the token count of each request to stderr")
+    parser.add_argument("--socket", type=str, default=default_socket(), help="Socket of a running shsh_daemon.py")
+    parser.add_argument("--no-daemon", action="store_true", help="Do everything in this process even if the daemon is running")
+    args = parser.parse_args()
+
+    # Hand the prompts to the daemon when it is running, it has everything loaded already
+    backend = None if args.no_daemon else DaemonClient.connect(args.socket)
+    if backend is None:
+        backend = in_process()
+    run(backend, args)
+
+
+if __name__ == '__main__':
+    main()
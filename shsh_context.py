@@ -0,0 +1,158 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".cache", "shsh", "context.json")
+
+# A system information probe.
+#   label:    heading the output is printed under
+#   command:  shell command producing the output
+#   files:    files whose modification time invalidates the cached output
+#   boot:     the cached output is only valid until the next reboot
+#   ttl:      seconds the cached output stays valid, None for no limit
+#   identity: part of what identifies the system, for keying the response cache
+Probe = namedtuple("Probe", ["name", "label", "command", "files", "boot", "ttl", "identity"])
+
+LINUX_PROBES = [
+    Probe("lsb", "LSB", "lsb_release -a 2>/dev/null | grep -E 'Distributor ID:|Description:|Release:|Codename:'", ["/etc/os-release", "/etc/lsb-release"], False, None, True),
+    Probe("hostname", "Hostname", "hostname", ["/etc/hostname"], True, None, True),
+    Probe("username", "Username", "whoami", [], False, None, True),
+    Probe("journal", "Journal", "journalctl -n 20 -p 3 --no-tail --no-pager", [], True, 300, False),
+    Probe("resolv", "Resolv.conf", "grep -v '^#' /etc/resolv.conf", ["/etc/resolv.conf"], False, None, False),
+    Probe("fstab", "fstab", "grep -v '^#' /etc/fstab", ["/etc/fstab"], False, None, False),
+    Probe("ip", "IP", "ip -br addr show", [], True, 60, False),
+    Probe("lspci", "LSPCI", "lspci | grep -vE 'System peripheral|Performance counters|PCI bridge|USB controller|SATA controller|Communication controller|PIC|Serial Attached SCSI|ISA bridge|SMBus'", [], True, None, False),
+    Probe("lsblk", "LSBLK", "lsblk -d --output name,size --noheadings --bytes | awk '{printf \"%s %0.2fG\\n\", $1, $2/(1024*1024*1024)}'", [], True, None, False),
+]
+
+MACOS_PROBES = [
+    Probe("hostname", "Hostname", "hostname", [], True, None, True),
+    Probe("username", "User", "whoami", [], False, None, True),
+    Probe("resolv", "resolv.conf", "grep -v '^#' /etc/resolv.conf", ["/etc/resolv.conf"], False, None, False),
+    Probe("diskutil", "Diskutil", "diskutil list", [], True, None, False),
+    Probe("system_profiler", "system_profiler", "system_profiler SPSoftwareDataType SPHardwareDataType", ["/System/Library/CoreServices/SystemVersion.plist"], True, None, True),
+]
+
+
+def boot_id():
+    # Changes on every boot. Linux exposes it directly; on macOS the boot time serves the same purpose.
+    try:
+        with open("/proc/sys/kernel/random/boot_id", "r") as f:
+            return f.read().strip()
+    except OSError:
+        return subprocess.run(["sysctl", "-n", "kern.boottime"], capture_output=True, text=True).stdout.strip()
+
+
+def signature(probe, boot):
+    # Cheap to compute stand-in for the probe's output: it changes whenever the output may have
+    parts = {"uid": os.getuid() if hasattr(os, "getuid") else None}
+    for path in probe.files:
+        try:
+            parts[path] = os.stat(path).st_mtime
+        except OSError:
+            parts[path] = None
+    if probe.boot:
+        parts["boot"] = boot
+    return json.dumps(parts, sort_keys=True)
+
+
+def run_probe(probe):
+    start = time.perf_counter()
+    try:
+        result = subprocess.run(probe.command, shell=True, capture_output=True, text=True, timeout=10)
+        output = result.stdout.strip()
+    except subprocess.TimeoutExpired:
+        output = ""
+    return output, time.perf_counter() - start
+
+
+def load_cache(cache_file):
+    try:
+        with open(cache_file, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(cache, cache_file):
+    # Written to a temporary file first so concurrent shsh runs never read half a file
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    temp_file = f"{cache_file}.{os.getpid()}"
+    with open(temp_file, "w") as f:
+        json.dump(cache, f)
+    os.replace(temp_file, cache_file)
+
+
+def collect(cache_file=DEFAULT_CACHE_FILE, refresh=False):
+    """
+    Runs the probes for this OS and returns (context, identity, timings).
+
+    Probes whose cached output is still valid are not run; the rest run concurrently.
+    context is the full text passed to the model, identity only the probes that
+    identify the system, and timings a list of (probe name, seconds, cached).
+    """
+    probes = MACOS_PROBES if platform.system() == "Darwin" else LINUX_PROBES
+    cache = {} if refresh else load_cache(cache_file)
+    boot = boot_id() if any(probe.boot for probe in probes) else None
+    now = time.time()
+
+    outputs = {}
+    timings = []
+    stale = []
+    for probe in probes:
+        start = time.perf_counter()
+        sig = signature(probe, boot)
+        entry = cache.get(probe.name)
+        if entry and entry["signature"] == sig and (probe.ttl is None or now - entry["collected"] < probe.ttl):
+            outputs[probe.name] = entry["output"]
+            timings.append((probe.name, time.perf_counter() - start, True))
+        else:
+            stale.append((probe, sig))
+
+    if stale:
+        with ThreadPoolExecutor(max_workers=len(stale)) as executor:
+            results = executor.map(lambda item: run_probe(item[0]), stale)
+            for (probe, sig), (output, seconds) in zip(stale, results):
+                outputs[probe.name] = output
+                cache[probe.name] = {"signature": sig, "output": output, "collected": now}
+                timings.append((probe.name, seconds, False))
+        save_cache(cache, cache_file)
+
+    # Same layout the shell probes used to print
+    context = f"Shell:{os.environ.get('SHELL', '')}\n" if probes is LINUX_PROBES else ""
+    identity = context
+    for probe in probes:
+        section = f"{probe.label}:{outputs[probe.name]}\n"
+        context += section
+        if probe.identity:
+            identity += section
+
+    return context, identity, timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Collect the system information context for shsh")
+    parser.add_argument("--cache-file", type=str, default=DEFAULT_CACHE_FILE, help="Probe output cache location")
+    parser.add_argument("--refresh", action="store_true", help="Ignore cached output and run every probe")
+    parser.add_argument("--timings", action="store_true", help="Print how long each probe took to stderr")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    context, _, timings = collect(args.cache_file, args.refresh)
+    total = time.perf_counter() - start
+
+    print(context, end="")
+    if args.timings:
+        for name, seconds, cached in timings:
+            print(f"{name:>16}: {seconds * 1000:8.1f} ms{' (cached)' if cached else ''}", file=sys.stderr)
+        print(f"{'total':>16}: {total * 1000:8.1f} ms", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import argparse
+import json
+import os
+import socketserver
+import sys
+from shsh_client import DaemonClient, default_socket, is_private_directory
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def send(self, reply):
+        self.wfile.write(json.dumps(reply).encode() + b"\n")
+        self.wfile.flush()
+
+    def handle(self):
+        backend = self.server.backend
+        request = json.loads(self.rfile.readline())
+        op = request.get("op")
+        try:
+            if op == "ping":
+                self.send({"ok": True})
+            elif op == "ask":
+                replies = backend.ask(request["prompt"], request["history"], request["context"], request["options"])
+                try:
+                    for reply in replies:
+                        self.send(reply)
+                finally:
+                    # Stops the API stream when the client has hung up
+                    replies.close()
+                self.send({"done": True})
+            elif op == "answered":
+                backend.answered(request["prompt"], request["cache_context"], request["options"], request["response"], request["source"], request["finished"], request["selection"])
+                self.send({"ok": True})
+            else:
+                self.send({"error": f"Unknown request {op!r}"})
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        except Exception as e:
+            try:
+                self.send({"error": f"{type(e).__name__}: {e}"})
+            except OSError:
+                pass
+
+
+class Server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def serve(path):
+    # Everything slow to set up is done once here and kept warm for every request
+    import requests
+    import shsh
+    from shsh_retrieval import shared_index
+
+    openai = shsh.load_openai()
+    # One shared session keeps the TLS connection to the API open between requests
+    openai.requestssession = requests.Session()
+    shared_index()
+    backend = shsh.InProcess()
+    backend.context()
+
+    # Clients only trust a socket in a directory nobody else can write to
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    if not is_private_directory(directory):
+        sys.exit(f"{directory} has to belong to you and be closed to other users (mode 0700), otherwise they could answer in the daemon's place")
+
+    if os.path.exists(path):
+        if DaemonClient.connect(path):
+            sys.exit(f"shsh daemon is already running on {path}")
+        os.remove(path)
+
+    old_umask = os.umask(0o177)
+    try:
+        server = Server(path, Handler)
+    finally:
+        os.umask(old_umask)
+    server.backend = backend
+
+    print(f"shsh daemon listening on {path}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Keep shsh warm in the background so each shsh call starts fast")
+    parser.add_argument("--socket", type=str, default=default_socket(), help="Unix socket to listen on")
+    args = parser.parse_args()
+    if args.socket is None:
+        sys.exit("The shsh daemon needs Unix sockets, which this platform doesn't have.")
+
+    serve(args.socket)
+
+
+if __name__ == "__main__":
+    main()
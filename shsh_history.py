@@ -0,0 +1,67 @@
+from shsh_tokens import count_message_tokens, count_tokens
+
+REMINDER = "Remember, only answer with console commands. Do not enumerate them, describe them, or provide any context. Only give commands. If there are several suggestions, put them on separate lines. Again, only the commands themselves. No context. No enumerations. Don't surround with quotes. Just the commands."
+
+
+class ConversationHistory:
+    """
+    Earlier prompts and responses of a refinement session, fitted into a token budget.
+
+    Each request always carries the system messages, the latest prompt and the reminder.
+    Earlier turns are added newest first while they fit in max_tokens. Turns that don't
+    fit are replaced by a one-line summary of what was asked, which drops their command
+    lists; if even that doesn't fit, the oldest prompts are left out of the summary.
+    """
+
+    def __init__(self, max_tokens=1500):
+        self.max_tokens = max_tokens
+        self.prompts = []
+        self.responses = []
+
+    def add(self, prompt, response):
+        self.prompts.append(prompt)
+        self.responses.append(response)
+
+    def messages(self, system_messages, user_prompt):
+        """
+        Returns the messages for the next request and their token count.
+        """
+        head = list(system_messages)
+        tail = [
+            {"role": "user", "content": user_prompt},
+            {"role": "system", "content": REMINDER},
+        ]
+        used = count_message_tokens(head + tail)
+
+        # Newest turns are the most useful, keep as many of them as fit
+        kept = []
+        turn = len(self.prompts)
+        while turn > 0:
+            pair = [
+                {"role": "user", "content": self.prompts[turn - 1]},
+                {"role": "system", "content": self.responses[turn - 1]},
+            ]
+            cost = sum(4 + count_tokens(message["content"]) for message in pair)
+            if used + cost > self.max_tokens:
+                break
+            kept = pair + kept
+            used += cost
+            turn -= 1
+
+        # Whatever is older only survives as a summary of the prompts
+        dropped = self.prompts[:turn]
+        while dropped:
+            summary = {"role": "system", "content": self._summary(dropped)}
+            cost = 4 + count_tokens(summary["content"])
+            if used + cost <= self.max_tokens:
+                kept = [summary] + kept
+                used += cost
+                break
+            dropped = dropped[1:]
+
+        return head + kept + tail, used
+
+    @staticmethod
+    def _summary(prompts):
+        asked = "; ".join(f'"{prompt}"' for prompt in prompts)
+        return f"Earlier the user asked: {asked}. None of the commands suggested for those worked."
@@ -0,0 +1,175 @@
+"""
+The command menu of shsh: the commands of a response, and picking one of them while the
+response is still arriving. Kept apart from shsh.py so the thin client in shsh_client.py
+can show the menu without loading anything else.
+"""
+import queue
+import select
+import sys
+import threading
+
+
+def select_option(options):
+    while True:
+        # Enumerate and display the strings
+        print("0. Exit")
+        for index, string in enumerate(options, start=1):
+            print(f"{index}. {string}")
+        print(f"{len(options) + 1}. None of these work. I need to provide more context.")
+
+        user_input = input("Choice: ")
+
+        if user_input == '':
+            # Default to the first option if no input is given
+            selected_index = 1
+            break
+        else:
+            try:
+                # Convert the user input to an integer
+                selected_index = int(user_input)
+                # Ensure the user selects a valid option
+                if selected_index < 0 or selected_index > len(options) + 1:
+                    raise ValueError
+                # Exit option
+                if selected_index == 0:
+                    return 0
+                if selected_index == len(options) + 1:
+                    return -1
+                break
+            except ValueError:
+                # If the input is invalid, inform the user and prompt to try again
+                print("Invalid selection. Please try again.")
+
+    # Return the selected string
+    return options[selected_index - 1]
+
+def select_streamed_option(commands):
+    # Same menu as select_option, but options are shown as they arrive from the commands iterator
+    if sys.platform == "win32":
+        # select() can't wait on the console here, so fall back to waiting for the whole list
+        options = list(commands)
+        return select_option(options) if options else -1
+
+    arrivals = queue.Queue()
+    cancelled = threading.Event()
+
+    def read_commands():
+        try:
+            for command in commands:
+                if cancelled.is_set():
+                    break
+                arrivals.put(command)
+        except Exception as e:
+            arrivals.put(e)
+        finally:
+            # Stop the rest of the stream once a choice has been made
+            if hasattr(commands, "close"):
+                commands.close()
+            arrivals.put(None)
+
+    threading.Thread(target=read_commands, daemon=True).start()
+
+    options = []
+    finished = False
+    # A number typed before that option has arrived is kept until it does
+    pending = None
+    print("0. Exit")
+    try:
+        while True:
+            # Show any options that have arrived since the last pass
+            try:
+                item = arrivals.get(timeout=0.05) if not finished else None
+            except queue.Empty:
+                item = ""
+            if isinstance(item, Exception):
+                if not options:
+                    raise item
+                item = None
+            if item is None and not finished:
+                finished = True
+                print(f"{len(options) + 1}. None of these work. I need to provide more context.")
+                print("Choice: ", end="", flush=True)
+            elif item:
+                options.append(item)
+                print(f"{len(options)}. {item}", flush=True)
+
+            if pending is not None:
+                if pending <= len(options):
+                    return options[pending - 1]
+                if finished:
+                    if pending == len(options) + 1:
+                        return -1
+                    pending = None
+                    print("Invalid selection. Please try again.")
+                    print("Choice: ", end="", flush=True)
+                continue
+
+            # The user can pick as soon as an option is on screen, without waiting for the rest
+            readable, _, _ = select.select([sys.stdin], [], [], 0 if not finished else 0.05)
+            if not readable:
+                continue
+
+            user_input = sys.stdin.readline()
+            if not user_input:
+                # End of input
+                return 0
+            user_input = user_input.strip()
+
+            if user_input == '':
+                # Default to the first option if no input is given
+                pending = 1
+                continue
+            try:
+                selected_index = int(user_input)
+                if selected_index < 0:
+                    raise ValueError
+                if selected_index == 0:
+                    return 0
+                pending = selected_index
+            except ValueError:
+                print("Invalid selection. Please try again.")
+                if finished:
+                    print("Choice: ", end="", flush=True)
+    finally:
+        cancelled.set()
+
+def is_command_line(line):
+    # Lines that breakup_response keeps: not blank, not a code fence and not an "Option N:" heading
+    return line.strip() and line.strip() != "```" and not line.startswith("Option")
+
+def breakup_response(input_string):
+    # Step 1: Split the string into lines
+    lines = input_string.splitlines()
+
+    # Step 2: Filter out unwanted lines
+    filtered_lines = [line for line in lines if is_command_line(line)]
+
+    # Step 3: Remove "```" from the beginning and end
+    if filtered_lines and filtered_lines[0] == "```":
+        filtered_lines.pop(0)
+    if filtered_lines and filtered_lines[-1] == "```":
+        filtered_lines.pop(-1)
+
+    return filtered_lines
+
+def stream_commands(chunks, received, finished=None):
+    # Turn streamed text into command lines as soon as each line is complete.
+    # Every complete line read, kept or not, is also appended to received so the response can be kept for the conversation.
+    # finished is set once the whole response has been read, rather than cut short by a choice.
+    buffer = ""
+    try:
+        for chunk in chunks:
+            buffer = (buffer + chunk).replace("\\n", "\n")
+            *lines, buffer = buffer.split("\n")
+            for line in lines:
+                received.append(line)
+                if is_command_line(line):
+                    yield line
+        received.append(buffer)
+        if finished is not None:
+            finished.set()
+        if is_command_line(buffer):
+            yield buffer
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
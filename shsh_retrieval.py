@@ -0,0 +1,244 @@
+import argparse
+import gzip
+import heapq
+import json
+import math
+import os
+import re
+import time
+from collections import Counter
+from shsh_tokens import count_tokens
+
+PAIRS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fine-tuning", "commandpairs.jsonl")
+DEFAULT_INDEX_FILE = os.path.join(os.path.expanduser("~"), ".cache", "shsh", "commandpairs.index.json.gz")
+
+# Words that show up in most descriptions and only slow scoring down
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "in", "into", "is", "it", "its",
+    "of", "on", "or", "that", "the", "this", "to", "with", "all", "me", "my", "i",
+}
+
+# Commands that only exist on one kind of system, used to prefer examples that fit the user's OS
+OS_COMMANDS = {
+    "debian": {"apt", "apt-get", "apt-cache", "dpkg", "add-apt-repository", "update-rc.d"},
+    "fedora": {"dnf", "yum", "rpm"},
+    "arch": {"pacman", "yay", "makepkg"},
+    "macos": {"brew", "launchctl", "diskutil", "defaults", "pbcopy", "pbpaste", "osascript", "sw_vers"},
+    "windows": {"findstr", "netsh", "ipconfig", "tasklist", "taskkill", "powershell", "wmic"},
+}
+
+# Names found in the system information context, and the OS_COMMANDS family they belong to
+OS_NAMES = {
+    "ubuntu": "debian", "debian": "debian", "linuxmint": "debian", "raspbian": "debian",
+    "fedora": "fedora", "centos": "fedora", "rhel": "fedora", "red hat": "fedora", "rocky": "fedora", "almalinux": "fedora",
+    "arch": "arch", "archlinux": "arch", "manjaro": "arch", "endeavouros": "arch",
+    "darwin": "macos", "macos": "macos", "mac os": "macos", "system_profiler": "macos",
+    "windows": "windows",
+}
+
+
+def tokenize(text):
+    return [word for word in re.findall(r"[a-z0-9]+", text.lower()) if word not in STOPWORDS]
+
+
+def detect_os(context):
+    # The OS_COMMANDS family named in the system context, if any
+    context = (context or "").lower()
+    for name, family in OS_NAMES.items():
+        if re.search(rf"\b{re.escape(name)}\b", context):
+            return family
+    return None
+
+
+def os_weight(command, family):
+    # Favour commands made for the user's OS and play down ones made for another
+    words = set(re.findall(r"[\w.-]+", command.lower()))
+    if any(word.endswith(".exe") or word.startswith(("get-", "set-", "new-")) for word in words):
+        words.add("powershell")
+
+    weight = 1.0
+    for other, commands in OS_COMMANDS.items():
+        if words & commands:
+            weight *= 1.5 if other == family else 0.5
+    return weight
+
+
+def format_example(prompt, command):
+    # Same layout as the static examples block in shsh.py
+    return f"\nprompt: {prompt}\n{command}\n"
+
+
+def build_index(pairs_file=PAIRS_FILE):
+    """
+    Builds a BM25 index over the prompt field of a commandpairs JSONL file.
+
+    Postings are stored per term as two flat lists, document numbers followed by term
+    frequencies, which keeps the serialized index small and quick to load.
+    """
+    prompts = []
+    completions = []
+    postings = {}
+    doc_lengths = []
+
+    with open(pairs_file, "r") as f:
+        for line in f:
+            pair = json.loads(line)
+            terms = tokenize(pair["prompt"])
+            doc = len(prompts)
+            prompts.append(pair["prompt"])
+            completions.append(pair["completion"])
+            doc_lengths.append(len(terms))
+            for term, tf in Counter(terms).items():
+                postings.setdefault(term, ([], []))
+                postings[term][0].append(doc)
+                postings[term][1].append(tf)
+
+    return {
+        "prompts": prompts,
+        "completions": completions,
+        "doc_lengths": doc_lengths,
+        "postings": {term: docs + tfs for term, (docs, tfs) in postings.items()},
+    }
+
+
+def save_index(index, index_file=DEFAULT_INDEX_FILE):
+    os.makedirs(os.path.dirname(index_file), exist_ok=True)
+    with gzip.open(index_file, "wt") as f:
+        json.dump(index, f, separators=(",", ":"))
+
+
+class CommandIndex:
+    """
+    Looks up commands for a description in a prebuilt BM25 index of description->command pairs.
+    """
+
+    def __init__(self, index, k1=1.2, b=0.75):
+        self.prompts = index["prompts"]
+        self.completions = index["completions"]
+        self.doc_lengths = index["doc_lengths"]
+        self.postings = index["postings"]
+        self.k1 = k1
+        self.b = b
+        self.avg_length = sum(self.doc_lengths) / max(len(self.doc_lengths), 1)
+
+    @classmethod
+    def load(cls, index_file=DEFAULT_INDEX_FILE, pairs_file=PAIRS_FILE):
+        # Build the index on first use, and rebuild it if the pairs file has changed since
+        if not os.path.exists(index_file) or os.path.getmtime(index_file) < os.path.getmtime(pairs_file):
+            save_index(build_index(pairs_file), index_file)
+        with gzip.open(index_file, "rt") as f:
+            return cls(json.load(f))
+
+    def search(self, query, k=5):
+        """
+        Returns the document numbers and scores of the k best matches for query, best first.
+        """
+        scores = {}
+        n_docs = len(self.doc_lengths)
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            n = len(posting) // 2
+            idf = math.log(1 + (n_docs - n + 0.5) / (n + 0.5))
+            for doc, tf in zip(posting[:n], posting[n:]):
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc] / self.avg_length)
+                scores[doc] = scores.get(doc, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+    def commands(self, query, k=5):
+        # The k best matching commands, without repeats
+        commands = []
+        for doc, _ in self.search(query, k * 2):
+            if self.completions[doc] not in commands:
+                commands.append(self.completions[doc])
+            if len(commands) == k:
+                break
+        return commands
+
+    def examples(self, query, k=4, budget=200, os_family=None, exclude=()):
+        """
+        Picks up to k description->command pairs similar to query as few-shot examples,
+        formatted like the static examples block and at most budget tokens long in total.
+        Pairs whose commands fit os_family rank higher. Document numbers in exclude are skipped.
+        """
+        candidates = self.search(query, k * 5)
+        if os_family:
+            candidates.sort(key=lambda item: item[1] * os_weight(self.completions[item[0]], os_family), reverse=True)
+
+        chosen = []
+        seen = set()
+        used = 0
+        for doc, _ in candidates:
+            if doc in exclude or self.completions[doc] in seen:
+                continue
+            example = format_example(self.prompts[doc], self.completions[doc])
+            tokens = count_tokens(example)
+            if used + tokens > budget:
+                continue
+            chosen.append(example)
+            seen.add(self.completions[doc])
+            used += tokens
+            if len(chosen) == k:
+                break
+        return "".join(chosen)
+
+
+_shared_index = None
+
+
+def shared_index():
+    # Loaded on first use and kept for the rest of the process
+    global _shared_index
+    if _shared_index is None:
+        _shared_index = CommandIndex.load()
+    return _shared_index
+
+
+def benchmark(index, pairs_file, queries):
+    # Time lookups for descriptions taken from the pairs file
+    with open(pairs_file, "r") as f:
+        prompts = [json.loads(line)["prompt"] for _, line in zip(range(queries), f)]
+
+    latencies = []
+    for prompt in prompts:
+        start = time.perf_counter()
+        index.commands(prompt)
+        latencies.append(time.perf_counter() - start)
+
+    latencies.sort()
+    print(f"Queries: {len(latencies)}")
+    for label, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+        print(f"{label}: {latencies[min(int(len(latencies) * fraction), len(latencies) - 1)] * 1000:.2f} ms")
+    print(f"max: {latencies[-1] * 1000:.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline command lookup over fine-tuning/commandpairs.jsonl")
+    parser.add_argument("--pairs", type=str, default=PAIRS_FILE, help="Description->command pairs to index")
+    parser.add_argument("--index", type=str, default=DEFAULT_INDEX_FILE, help="Index file location")
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    subparsers.add_parser("build", help="Build the index")
+    query_parser = subparsers.add_parser("query", help="Print the best matching commands for a description")
+    query_parser.add_argument("prompt", type=str)
+    query_parser.add_argument("-k", type=int, default=5, help="Number of commands to return")
+    bench_parser = subparsers.add_parser("bench", help="Measure query latency")
+    bench_parser.add_argument("--queries", type=int, default=1000, help="Number of descriptions to look up")
+    args = parser.parse_args()
+
+    if args.action == "build":
+        start = time.perf_counter()
+        save_index(build_index(args.pairs), args.index)
+        print(f"Index written to {args.index} in {time.perf_counter() - start:.2f}s ({os.path.getsize(args.index) / 1024:.0f} KB).")
+        return
+
+    index = CommandIndex.load(args.index, args.pairs)
+    if args.action == "query":
+        for command in index.commands(args.prompt, args.k):
+            print(command)
+    else:
+        benchmark(index, args.pairs, args.queries)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+import re
+import threading
+
+# Loaded by the first count_tokens call, so calls answered from the cache never pay for it
+_encoding = None
+_loaded = False
+# The daemon counts tokens from several threads
+_lock = threading.Lock()
+
+
+def _get_encoding():
+    global _encoding, _loaded
+    with _lock:
+        if not _loaded:
+            try:
+                import tiktoken
+                _encoding = tiktoken.get_encoding("cl100k_base")
+            except Exception:
+                # tiktoken is optional, or its encoding may not be downloadable offline
+                _encoding = None
+            _loaded = True
+    return _encoding
+
+
+def count_tokens(text):
+    """
+    Number of tokens in text for gpt-3.5-turbo. Without tiktoken this is an estimate:
+    one token per word or punctuation mark, plus one per 4 characters past the first 4
+    of long words, which lands close to the real count for English and shell commands.
+    """
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return sum(1 + max(len(piece) - 4, 0) // 4 for piece in re.findall(r"\w+|[^\w\s]", text))
+
+
+def count_message_tokens(messages):
+    # Every message costs a few tokens of framing, and the reply is primed with 3 more
+    return sum(4 + count_tokens(message["content"]) for message in messages) + 3
@@ -0,0 +1,103 @@
+"""
+Admission slots and the per-worker metric slots of alpaca-web.py, without loading a model.
+
+    python -m pytest tests
+"""
+import importlib.util
+import os
+import sys
+
+import pytest
+import torch
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, ROOT)
+from alpaca_metrics import Registry
+
+
+def sample(registry, name):
+    # Value of an unlabelled sample in the rendered metrics
+    for line in registry.render().splitlines():
+        if line.startswith(name + " "):
+            return float(line.split()[1])
+    raise KeyError(name)
+
+
+@pytest.fixture
+def load_web(monkeypatch, tmp_path):
+    # Imports alpaca-web.py with the given options. Its log file goes to a temporary directory.
+    monkeypatch.chdir(tmp_path)
+    threads = torch.get_num_threads()
+    loaded = []
+
+    def load(*options):
+        monkeypatch.setattr(sys, "argv", ["alpaca-web.py", "--stub-model", *options])
+        spec = importlib.util.spec_from_file_location("alpaca_web", os.path.join(ROOT, "alpaca-web.py"))
+        web = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(web)
+        loaded.append(web)
+        return web
+
+    yield load
+    for web in loaded:
+        web.log_handler.stop()
+    torch.set_num_threads(threads)
+
+
+def test_each_worker_admits_its_share_of_the_queue(load_web):
+    web = load_web("--workers", "2", "--max-queue", "5", "--max-batch-size", "1")
+    web.metrics.allocate(2)
+    web.start_worker(1)
+
+    assert web.admit() and web.admit()
+    # 5 // 2 for this worker
+    assert not web.admit()
+    assert sample(web.metrics, "alpaca_requests_in_flight") == 2
+    web.release()
+    assert web.admit()
+    web.release()
+    web.release()
+    assert sample(web.metrics, "alpaca_requests_in_flight") == 0
+
+
+def test_requests_of_a_dead_worker_stop_counting_as_in_flight(load_web):
+    web = load_web("--workers", "2", "--max-queue", "4", "--max-batch-size", "1")
+    web.metrics.allocate(2)
+    web.start_worker(0)
+    web.admit()
+    web.metrics.use_slot(1)
+    web.in_flight.inc(3)
+    assert sample(web.metrics, "alpaca_requests_in_flight") == 4
+
+    # Worker 1 was killed with requests in flight; worker 0's still count
+    web.worker_exited(1)
+    assert sample(web.metrics, "alpaca_requests_in_flight") == 1
+
+
+def test_without_a_limit_every_request_is_admitted(load_web):
+    web = load_web("--max-queue", "0", "--max-batch-size", "1")
+    web.start_worker()
+    assert all(web.admit() for _ in range(100))
+    assert sample(web.metrics, "alpaca_requests_in_flight") == 100
+
+
+def test_worker_slots_add_up_across_forks():
+    registry = Registry()
+    counter = registry.counter("requests_total", "Requests")
+    registry.allocate(3)
+    children = []
+    for slot in range(3):
+        pid = os.fork()
+        if pid == 0:
+            registry.use_slot(slot)
+            counter.inc(slot + 1)
+            os._exit(0)
+        children.append(pid)
+    for pid in children:
+        os.waitpid(pid, 0)
+
+    assert sample(registry, "requests_total") == 6
+    registry.reset(2)
+    assert sample(registry, "requests_total") == 3
+    registry.reset()
+    assert sample(registry, "requests_total") == 0
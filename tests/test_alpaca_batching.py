@@ -0,0 +1,82 @@
+"""
+BatchScheduler's batching and request timeouts, with a generate function that can be held up.
+
+    python -m pytest tests
+"""
+import os
+import sys
+import threading
+from concurrent.futures import TimeoutError
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from alpaca_batching import BatchScheduler
+
+
+class HeldGenerate:
+    # Records every batch and blocks in each one until release() is called
+    def __init__(self):
+        self.batches = []
+        self.started = threading.Event()
+        self.gate = threading.Event()
+
+    def release(self):
+        self.gate.set()
+
+    def __call__(self, items):
+        self.batches.append(list(items))
+        self.started.set()
+        self.gate.wait(5)
+        return [item * 2 for item in items]
+
+
+def test_requests_arriving_together_share_a_batch():
+    generate = HeldGenerate()
+    generate.release()
+    scheduler = BatchScheduler(generate, max_batch_size=4, batch_window=0.2)
+    futures = [scheduler.submit(item) for item in range(6)]
+    assert [future.result(5) for future in futures] == [0, 2, 4, 6, 8, 10]
+    # A full batch goes at once, the rest after the window
+    assert generate.batches == [[0, 1, 2, 3], [4, 5]]
+
+
+def test_timed_out_request_is_dropped_before_it_generates():
+    generate = HeldGenerate()
+    scheduler = BatchScheduler(generate, max_batch_size=1, batch_window=0)
+    running = scheduler.submit(1)
+    assert generate.started.wait(5)
+
+    # Queued behind a batch that is still generating
+    with pytest.raises(TimeoutError):
+        scheduler(2, timeout=0.05)
+    waiting = scheduler.submit(3)
+    generate.release()
+
+    assert running.result(5) == 2
+    assert waiting.result(5) == 6
+    # The request nobody waits for any more never reached the model
+    assert generate.batches == [[1], [3]]
+
+
+def test_timed_out_request_already_generating_still_finishes():
+    generate = HeldGenerate()
+    scheduler = BatchScheduler(generate, max_batch_size=1, batch_window=0)
+    future = scheduler.submit(1)
+    assert generate.started.wait(5)
+    with pytest.raises(TimeoutError):
+        future.result(0.05)
+    # Cancelling fails once it is running, so the scheduler can still hand it its result
+    assert not future.cancel()
+    generate.release()
+    assert future.result(5) == 2
+
+
+def test_generate_failure_fails_the_whole_batch():
+    def generate(items):
+        raise RuntimeError("out of memory")
+    scheduler = BatchScheduler(generate, max_batch_size=2, batch_window=0.2)
+    futures = [scheduler.submit(item) for item in range(2)]
+    for future in futures:
+        with pytest.raises(RuntimeError):
+            future.result(5)
@@ -0,0 +1,85 @@
+"""
+The command grammar, and its logits processor during generation with the stub model.
+
+    python -m pytest tests
+"""
+import os
+import sys
+
+import pytest
+import torch
+from transformers import GenerationConfig, LogitsProcessor, LogitsProcessorList
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from alpaca_grammar import IN_BACKTICKS, LINE_START, MID_LINE, RESPONSE_START, CommandGrammar, scan
+from alpaca_stub import stub_model, stub_tokenizer
+
+
+@pytest.fixture(scope="module")
+def stub():
+    tokenizer = stub_tokenizer()
+    return tokenizer, stub_model(tokenizer, "alpaca").eval()
+
+
+def test_scan_keeps_to_plain_command_lines():
+    assert scan("ls -la\ndf -h", RESPONSE_START) == (True, 1, MID_LINE, True)
+    assert scan("\n  ls\n", RESPONSE_START) == (True, 1, LINE_START, True)
+    # Numbered lists, bullets, prompts and code fences aren't commands
+    for text in ("1. ls", "- ls", "> ls", "```\nls"):
+        assert not scan(text, RESPONSE_START)[0]
+    assert not scan("ls\n\ndf", RESPONSE_START)[0]
+
+
+def test_scan_allows_backticks_closed_on_their_line():
+    assert scan("echo `date`", RESPONSE_START) == (True, 0, MID_LINE, True)
+    assert scan("echo `date", RESPONSE_START)[2] == IN_BACKTICKS
+    assert not scan("echo `date\nls", RESPONSE_START)[0]
+    assert not scan("`date`", RESPONSE_START)[0]
+
+
+def test_end_of_response_needs_a_command_outside_backticks(stub):
+    tokenizer, _ = stub
+    grammar = CommandGrammar(tokenizer, max_commands=2)
+    eos = tokenizer.eos_token_id
+    vocab_size = len(tokenizer)
+    assert not grammar.allowed(grammar.start, vocab_size, "cpu")[eos]
+    assert grammar.allowed(grammar.state(tokenizer("ls").input_ids), vocab_size, "cpu")[eos]
+    assert not grammar.allowed(grammar.state(tokenizer("echo `da").input_ids), vocab_size, "cpu")[eos]
+    # Only the end of the response is left after --max-commands lines
+    finished = grammar.allowed(grammar.state(tokenizer("ls\ndf\n").input_ids), vocab_size, "cpu")
+    assert finished[eos] and finished.sum() == 1
+
+
+class FullRecompute(LogitsProcessor):
+    # Checks the processor's masks against the grammar state recomputed from each row's whole output
+    def __init__(self, grammar, prompt_length):
+        self.grammar = grammar
+        self.processor = grammar.processor(prompt_length)
+        self.prompt_length = prompt_length
+        self.calls = 0
+
+    def __call__(self, input_ids, scores):
+        masked = self.processor(input_ids, scores.clone())
+        for row, token_ids in enumerate(input_ids[:, self.prompt_length:].tolist()):
+            allowed = self.grammar.allowed(self.grammar.state(token_ids), scores.shape[-1], scores.device)
+            already_masked = torch.isneginf(scores[row])
+            assert torch.equal(torch.isneginf(masked[row]), ~allowed | already_masked), (row, token_ids)
+        self.calls += 1
+        return masked
+
+
+@pytest.mark.parametrize("num_beams, do_sample", [(1, False), (4, False), (3, True)])
+def test_processor_tracks_every_row_through_generation(stub, num_beams, do_sample):
+    tokenizer, model = stub
+    grammar = CommandGrammar(tokenizer, max_commands=3)
+    input_ids = tokenizer("### Response:\n", return_tensors="pt").input_ids
+    check = FullRecompute(grammar, input_ids.shape[1])
+    torch.manual_seed(0)
+    output = model.generate(
+        input_ids=input_ids,
+        logits_processor=LogitsProcessorList([check]),
+        generation_config=GenerationConfig(num_beams=num_beams, do_sample=do_sample, max_new_tokens=40, pad_token_id=0),
+    )
+    assert check.calls > 1
+    text = tokenizer.decode(output[0, input_ids.shape[1]:], skip_special_tokens=True)
+    assert scan(text, RESPONSE_START)[0]
@@ -0,0 +1,69 @@
+"""
+PrefixCache with the stub model: lookups, eviction, and generating from a cached prefix.
+
+    python -m pytest tests
+"""
+import os
+import sys
+
+import pytest
+import torch
+from transformers import GenerationConfig
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from alpaca_prefix_cache import PrefixCache
+from alpaca_stub import stub_model, stub_tokenizer
+
+PREAMBLE = "Below is an instruction that describes a task. Write a response that appropriately completes the request.\n\n"
+
+
+@pytest.fixture(scope="module")
+def stub():
+    tokenizer = stub_tokenizer()
+    return tokenizer, stub_model(tokenizer, "alpaca").eval()
+
+
+def generate(model, input_ids, past_key_values=None):
+    config = GenerationConfig(num_beams=1, do_sample=False, max_new_tokens=20, pad_token_id=0)
+    with torch.no_grad():
+        return model.generate(input_ids=input_ids, past_key_values=past_key_values, generation_config=config)
+
+
+def test_generating_from_a_cached_prefix_matches_a_full_prefill(stub):
+    tokenizer, model = stub
+    cache = PrefixCache(model, tokenizer, "cpu")
+    cache.add(PREAMBLE, pinned=True)
+    input_ids = tokenizer(PREAMBLE + "### Instruction:\nList the files\n\n### Response:\n", return_tensors="pt").input_ids
+
+    expected = generate(model, input_ids)
+    assert torch.equal(generate(model, input_ids, cache.lookup(input_ids[0])), expected)
+    # generate() extended the copy it was given, not the cached entry
+    assert torch.equal(generate(model, input_ids, cache.lookup(input_ids[0])), expected)
+
+
+def test_lookup_returns_the_longest_stored_prefix(stub):
+    tokenizer, model = stub
+    cache = PrefixCache(model, tokenizer, "cpu")
+    cache.add(PREAMBLE)
+    cache.add(PREAMBLE + "### Instruction:\n")
+    input_ids = tokenizer(PREAMBLE + "### Instruction:\nList the files", return_tensors="pt").input_ids[0]
+    longest = tokenizer(PREAMBLE + "### Instruction:\n", return_tensors="pt").input_ids.shape[1]
+    assert cache.lookup(input_ids).get_seq_length() == longest
+
+    assert cache.lookup(tokenizer("Something else", return_tensors="pt").input_ids[0]) is None
+    # The whole prompt can't come from the cache, generate needs a token to start from
+    assert cache.lookup(tokenizer(PREAMBLE, return_tensors="pt").input_ids[0]) is None
+
+
+def test_least_recently_used_unpinned_entries_are_evicted(stub):
+    tokenizer, model = stub
+    cache = PrefixCache(model, tokenizer, "cpu")
+    cache.add(PREAMBLE, pinned=True)
+    cache.add("first prefix ")
+    cache.add("second prefix ")
+    # Room for the pinned entry and two more of the same length as "first prefix "
+    cache.max_bytes = cache.entries[PREAMBLE][2] + 2 * cache.entries["first prefix "][2]
+    cache.lookup(tokenizer("first prefix and more", return_tensors="pt").input_ids[0])
+    cache.add("third prefix ")
+    assert list(cache.entries) == [PREAMBLE, "first prefix ", "third prefix "]
+    assert cache.nbytes <= cache.max_bytes
@@ -0,0 +1,67 @@
+"""
+Near-duplicate detection in fine-tuning/dedupe_pairs.py.
+
+    python -m pytest tests
+"""
+import os
+import random
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'fine-tuning'))
+import dedupe_pairs
+
+
+def command_pairs(count, seed=0):
+    # Variations on a few commands, so there are pairs at every level of similarity
+    rng = random.Random(seed)
+    programs = ["ls", "grep", "find", "tar", "apt-get", "docker", "git", "ssh"]
+    words = ["files", "directory", "recursively", "archive", "package", "container", "remote", "hidden", "size", "name"]
+    flags = ["-l", "-a", "-r", "-n", "-v", "-x", "-z", "-f", "--all", "--force"]
+    pairs = []
+    for _ in range(count):
+        program = rng.choice(programs)
+        prompt = " ".join(rng.sample(words, 4))
+        completion = " ".join([program] + rng.sample(flags, rng.randint(1, 4)) + [f"path/to/{rng.choice(words)}"])
+        pairs.append((prompt, completion))
+    return pairs
+
+
+def test_similar_pairs_are_all_above_threshold():
+    pairs = command_pairs(2000)
+    signatures, hashes, offsets = dedupe_pairs.minhash_signatures(pairs)
+    firsts, seconds = dedupe_pairs.similar_pairs(signatures, hashes, offsets, bands=16, threshold=0.6)
+    assert len(firsts) > 0
+    assert (firsts < seconds).all()
+    # The signatures only propose candidates, every pair returned is similar enough by its exact features
+    for first, second in zip(firsts.tolist(), seconds.tolist()):
+        exact = dedupe_pairs.features(*pairs[first]), dedupe_pairs.features(*pairs[second])
+        assert len(exact[0] & exact[1]) / len(exact[0] | exact[1]) >= 0.6
+
+
+def test_jaccard_matches_the_feature_sets():
+    pairs = command_pairs(200, seed=2)
+    _, hashes, offsets = dedupe_pairs.minhash_signatures(pairs)
+    firsts = np.arange(0, 199)
+    seconds = np.arange(1, 200)
+    similarities = dedupe_pairs.jaccard(hashes, offsets, firsts, seconds)
+    for first, second, similarity in zip(firsts, seconds, similarities):
+        exact = dedupe_pairs.features(*pairs[first]), dedupe_pairs.features(*pairs[second])
+        assert similarity == pytest.approx(len(exact[0] & exact[1]) / len(exact[0] | exact[1]))
+
+
+def test_exact_duplicates_are_found_and_collapsed():
+    pairs = command_pairs(300, seed=1)
+    pairs += pairs[:50]
+    signatures, hashes, offsets = dedupe_pairs.minhash_signatures(pairs)
+    firsts, seconds = dedupe_pairs.similar_pairs(signatures, hashes, offsets, bands=16, threshold=0.99)
+    found = set(zip(firsts.tolist(), seconds.tolist()))
+    for index in range(50):
+        # A copy always lands in the bucket of the first pair with the same features
+        assert any((first, 300 + index) in found for first in range(300 + index) if pairs[first] == pairs[index])
+
+    labels = dedupe_pairs.cluster(pairs, threshold=0.99)
+    assert (labels[300:] < 300).all()
+    assert np.array_equal(labels[labels], labels)
@@ -0,0 +1,96 @@
+"""
+shsh's streamed menu, driven by a stand-in for the chat completion stream.
+
+    python -m pytest tests
+"""
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import shsh_menu
+
+
+class FakeStream:
+    """
+    Chunks as the API would send them, pausing after the first `pause_after` chunks until
+    resume() is called. Records how many chunks were read and whether it was closed.
+    """
+
+    def __init__(self, chunks, pause_after=None):
+        self.chunks = chunks
+        self.pause_after = pause_after
+        self.gate = threading.Event()
+        self.sent = 0
+        self.closed = threading.Event()
+
+    def resume(self):
+        self.gate.set()
+
+    def __iter__(self):
+        try:
+            for chunk in self.chunks:
+                if self.sent == self.pause_after:
+                    self.gate.wait(5)
+                self.sent += 1
+                yield chunk
+        finally:
+            self.closed.set()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_stream_commands_filters_lines_split_across_chunks():
+    chunks = ["Option 1:\n`", "``\nls -", "la\n\n", "df -h\\n", "```"]
+    received = []
+    finished = threading.Event()
+    commands = list(shsh_menu.stream_commands(iter(chunks), received, finished))
+    # Same lines breakup_response keeps from the whole text
+    assert commands == ["ls -la", "df -h"]
+    assert commands == shsh_menu.breakup_response("".join(chunks).replace("\\n", "\n"))
+    assert finished.is_set()
+
+
+def test_first_option_shown_before_stream_ends_and_choice_cancels_it(monkeypatch, capsys):
+    stream = FakeStream(["```\n", "ls -la\n", "df -h\n", "free -m\n", "du -sh .\n", "```"], pause_after=2)
+    read_end, write_end = os.pipe()
+    monkeypatch.setattr(sys, "stdin", os.fdopen(read_end, "r"))
+
+    received = []
+    finished = threading.Event()
+    result = {}
+    menu = threading.Thread(target=lambda: result.update(selection=shsh_menu.select_streamed_option(shsh_menu.stream_commands(iter(stream), received, finished))))
+    menu.start()
+    try:
+        # Option 1 is on screen while the rest of the response is still to come
+        output = ""
+        def first_option_shown():
+            nonlocal output
+            output += capsys.readouterr().out
+            return "1. ls -la" in output
+        assert wait_for(first_option_shown)
+        assert "```" not in output
+        assert "2." not in output
+        assert stream.sent == 2
+
+        # Enter picks option 1 straight away
+        os.write(write_end, b"\n")
+        menu.join(5)
+        assert result["selection"] == "ls -la"
+    finally:
+        stream.resume()
+        os.close(write_end)
+        menu.join(5)
+
+    # The stream is closed without reading the rest of the response
+    assert stream.closed.wait(5)
+    assert stream.sent < len(stream.chunks)
+    assert not finished.is_set()